@@ -0,0 +1,111 @@
+# Admission control for searches.
+#
+# Before a search runs, the number of matching paragraphs is estimated from gutenberg.lexeme_stats
+# (document frequencies from ts_stat, built in server-process-2.sql). Every lexeme of the query has
+# to match, so the rarest one bounds the number of matches. Without that table, the planner's
+# row estimate from EXPLAIN is used instead.
+#
+# Searches below heavy_paragraphs run normally. Heavier ones run capped: only the first
+# capped_paragraphs matches are ranked, and only a few of them may run at once, both per process
+# and across all workers (through transaction-level advisory locks). Anything above
+# too_broad_paragraphs is refused outright. Every search runs with a statement_timeout, and
+# Postgres cancels it cleanly when the timeout is reached. Queries whose cost doesn't grow with the
+# number of matches, like Discovery mode's sampling, only need the timeout (see timed).
+
+import json
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from sqlalchemy.exc import OperationalError
+
+ESTIMATE_QUERY = """with lexemes as (select unnest(tsvector_to_array(to_tsvector(%(language)s::regconfig, %(search_terms)s))) as word)
+select case when count(s.word) < (select count(*) from lexemes) then 0 else coalesce(min(s.ndoc), 0) end
+from lexemes l
+left join gutenberg.lexeme_stats s on s.language = %(language)s::regconfig and s.word = l.word;"""
+
+EXPLAIN_QUERY = """explain (format json) select 1 from gutenberg.paragraphs where language = %(language)s::regconfig and textsearchable_index_col @@ plainto_tsquery(%(language)s::regconfig, %(search_terms)s);"""
+
+HAS_STATS_QUERY = """select to_regclass('gutenberg.lexeme_stats') is not null;"""
+
+# First key of the advisory locks that count heavy searches across workers; the slot is the second.
+ADVISORY_LOCK_CLASS = 7001
+
+# Postgres' SQLSTATE for query_canceled, which is what statement_timeout raises.
+QUERY_CANCELED = '57014'
+
+class TooBroad(Exception):
+    def __init__(self, estimate):
+        super().__init__(estimate)
+        self.estimate = estimate
+
+class Busy(Exception):
+    pass
+
+class Timeout(Exception):
+    pass
+
+class Admission:
+    def __init__(self, heavy_paragraphs=100000, too_broad_paragraphs=5000000, capped_paragraphs=100000,
+                 statement_timeout_ms=30000, heavy_statement_timeout_ms=120000, max_heavy_per_process=1, max_heavy_global=4):
+        self.heavy_paragraphs = heavy_paragraphs
+        self.too_broad_paragraphs = too_broad_paragraphs
+        self.capped_paragraphs = capped_paragraphs
+        self.statement_timeout_ms = statement_timeout_ms
+        self.heavy_statement_timeout_ms = heavy_statement_timeout_ms
+        self.max_heavy_global = max_heavy_global
+        self.heavy = threading.BoundedSemaphore(max_heavy_per_process)
+        self.has_stats = None
+
+    def estimate(self, connection, language, search_terms):
+        params = {'language': language, 'search_terms': search_terms}
+        if self.has_stats is None:
+            self.has_stats = connection.execute(HAS_STATS_QUERY).scalar()
+        if self.has_stats:
+            return connection.execute(ESTIMATE_QUERY, params).scalar()
+        plan = connection.execute(EXPLAIN_QUERY, params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def global_slot(self, connection):
+        for slot in range(self.max_heavy_global):
+            if connection.execute("""select pg_try_advisory_xact_lock(%(class)s, %(slot)s);""", {'class': ADVISORY_LOCK_CLASS, 'slot': slot}).scalar():
+                return True
+        return False
+
+    def timeout_ms(self, heavy):
+        return self.heavy_statement_timeout_ms if heavy else self.statement_timeout_ms
+
+    # Runs the block in a transaction with the given statement_timeout, raising Timeout if Postgres
+    # cancels a statement because of it.
+    @contextmanager
+    def timed(self, connection, timeout_ms=None):
+        with connection.begin():
+            connection.execute('set local statement_timeout = {:d};'.format(int(timeout_ms or self.statement_timeout_ms)))
+            try:
+                yield
+            except (OperationalError, psycopg2.OperationalError) as e:
+                # From SQLAlchemy, or from psycopg2 directly for queries run on the cursor (pool.fetch).
+                if getattr(getattr(e, 'orig', e), 'pgcode', None) == QUERY_CANCELED:
+                    raise Timeout() from e
+                raise
+
+    # Yields the number of paragraphs to cap the search at, or None to run it in full. share scales
+    # the estimate when only part of the language's books are searched (see bookfilters.py).
+    @contextmanager
+    def admit(self, connection, language, search_terms, share=1.0):
+        estimate = int(self.estimate(connection, language, search_terms) * share)
+        if estimate >= self.too_broad_paragraphs:
+            raise TooBroad(estimate)
+        heavy = estimate >= self.heavy_paragraphs
+        if heavy and not self.heavy.acquire(blocking=False):
+            raise Busy()
+        try:
+            with self.timed(connection, self.timeout_ms(heavy)):
+                if heavy and not self.global_slot(connection):
+                    raise Busy()
+                yield self.capped_paragraphs if heavy else None
+        finally:
+            if heavy:
+                self.heavy.release()
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-# The first section creates datasets and figures to be used by the tabs.
+# The first section loads datasets and figures to be used by the tabs.
 # The second section defines the layout. 
 # The third section consists of the callbacks that make the app interactive.
 
@@ -12,11 +12,26 @@ import pandas as pd
 import numpy as np
 import yaml
 import psycopg2
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from psycopg2 import OperationalError, sql
 from dash.dependencies import Input, Output, State
 import plotly.graph_objects as go
-import networkx as nx
+from flask import jsonify, request, Response
+from search import search_params, view_from_table, EXPORT_MODES
+from admission import Admission, TooBroad, Busy, Timeout
+from cache import ResultCache
+from querylog import QueryLogWriter
+import snapshot
+import export
+import invindex
+import bookfilters
+from shards import Shards
+from metrics import Metrics
+from pool import Pool
+from searcher import Searcher
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
@@ -24,77 +39,213 @@ app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
 server = app.server
 
+# The results table is paged on the server, this many rows at most per page.
+MAX_PAGE_SIZE = 100
+
 # ------------- Set up connection to DB ------------------
 with open('/path/to/gutensearch/dbconfig.yml', 'r') as ymlfile: 
     cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
 
-engine = create_engine(cfg['Postgres']['constring'])
-
-# ------------- Get data into Pandas dataframes ----------
-supported_languages = pd.DataFrame(engine.execute("""select distinct language from gutenberg.all_data where lower(language) in (SELECT cfgname FROM pg_ts_config) order by language asc;"""))
-supported_languages.columns =['language']
-authors = pd.DataFrame(engine.execute("""select distinct author from gutenberg.all_data where lower(language) in (SELECT cfgname FROM pg_ts_config) order by author asc;"""))
-authors.columns =['author']
-unsupported_languages = pd.DataFrame(engine.execute("""with languages as (select distinct language from gutenberg.all_data where lower(language) not in (SELECT cfgname FROM pg_ts_config) order by language asc) select string_agg(language, ', ') as languages from languages;"""))
-unsupported_languages.columns =['languages']
-
-mentioned_authors = pd.DataFrame(engine.execute("""select mentioned_author, mentioned_by, books_mentioned_in from gutenberg.mentioned_authors;"""))
-mentioned_authors.columns = ['mentioned_author', 'mentioned_by', 'books_mentioned_in']
-mentioned_authors_graph = nx.from_pandas_edgelist(mentioned_authors, "mentioned_author", "mentioned_by", ["books_mentioned_in"])
-
-book_length = pd.DataFrame(engine.execute("""select num, case when language in ('English', 'French', 'German') then language else 'Other' end as language, length from gutenberg.all_data where length <> 0;"""))
-book_length.columns = ['num', 'language', 'length']
-
-book_length['log_length'] = np.log10(book_length['length']) 
-book_length[' index'] = book_length['num']
-
-# ------------- Create figures for Statistics tab --------
-fig1 = px.histogram(book_length, x="log_length", color="language", facet_col="language", category_orders={"language": ["English", "French", "German", "Other"]}, labels={
-                     "log_length": "log(Total characters in book)",
-                     "count": "Count of books with this length",
-                     "language": "Language"
-                 })
-
-# Books per (supported) language
-books_per_language = pd.DataFrame(engine.execute("""select language, count(*) as books, case when lower(language) in (SELECT cfgname FROM pg_ts_config) then 'Yes' else 'No' end as supported from gutenberg.all_data where language is not null group by language order by books desc, supported desc, language asc;"""))
-books_per_language.columns = ['language', 'books', 'supported']
-
-fig2 = px.bar(books_per_language, x='language', y='books', color='supported', log_y=True, hover_name='books', labels={
-                     "language": "Language",
-                     "books": "Number of books",
-                     "supported": "Language is supported by PostgreSQL Full Text Search"
-                 })
-fig2.update_layout(legend=dict(
-    orientation="h",
-    yanchor="bottom",
-    y=1.02,
-    xanchor="right",
-    x=1
-))
-
-trace1 = go.Bar(x=books_per_language[books_per_language.supported == 'Yes']['language'], y=books_per_language[books_per_language.supported == 'Yes']['books'], name='Supported languages')
-trace2 = go.Bar(x=books_per_language[books_per_language.supported == 'No']['language'], y=books_per_language[books_per_language.supported == 'No']['books'], name='Unsupported languages')
-df3 = [trace1, trace2]
-
-updatemenus = list([
-    dict(active=1,
-         buttons=list([
-            dict(label='Log Scale',
-                 method='update',
-                 args=[{'visible': [True, True]},
-                       {'title': 'Number of books (log scale)',
-                        'yaxis': {'type': 'log'}}]),
-            dict(label='Linear Scale',
-                 method='update',
-                 args=[{'visible': [True, True]},
-                       {'title': 'Number of books (linear scale)',
-                        'yaxis': {'type': 'linear'}}])
-            ]),
-        )
-    ])
+# Sized per gunicorn worker and warmed up after the fork, see pool.py.
+db_pool = Pool(cfg['Postgres']['constring'], **cfg['Pool'])
+engine = db_pool.engine
+
+# Without --preload the workers aren't forked from a process that loaded the app: warm up on the
+# first request instead.
+@server.before_request
+def warm_pool():
+    db_pool.warm()
+
+@server.route('/pool-stats')
+def pool_stats():
+    return jsonify(db_pool.stats())
+
+# ------------- Result cache shared by the workers -------
+# Discovery results are random, so they are kept for a shorter time.
+result_cache = ResultCache(cfg['Cache']['path'], max_bytes=cfg['Cache']['max_megabytes'] * 1024 * 1024, ttl=cfg['Cache']['ttl_seconds'], flush_interval=cfg['Cache']['flush_seconds'],
+                           tab_ttls={'Discovery': cfg['Cache']['discovery_ttl_seconds']})
+discovery_books = cfg['Discovery']['books']
+
+# ------------- Callback latency metrics ----------------
+metrics = Metrics(**cfg['Metrics'])
+metrics.install(server)
+
+# Local only: nginx adds X-Forwarded-For to whatever it proxies.
+@server.route('/metrics')
+def metrics_page():
+    if request.remote_addr not in ('127.0.0.1', '::1') or request.headers.get('X-Forwarded-For'):
+        return Response('Not found', status=404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@server.route('/cache-stats')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+# ------------- Query log, written in the background -----
+query_log = QueryLogWriter(cfg['Postgres']['constring'], batch_rows=cfg['QueryLog']['batch_rows'], flush_interval=cfg['QueryLog']['flush_milliseconds'] / 1000, max_queued_rows=cfg['QueryLog']['max_queued_rows'])
+
+@server.route('/query-log-stats')
+def query_log_stats():
+    return jsonify(query_log.stats())
+
+# ------------- Admission control for broad searches -----
+admission = Admission(**cfg['Admission'])
+
+def admission_message(error):
+    if isinstance(error, TooBroad):
+        return 'This search matches about {:,} paragraphs, which is too many to rank. Try adding more words or less common words.'.format(error.estimate)
+    if isinstance(error, Busy):
+        return 'Too many broad searches are running right now. Please try again in a minute, or add more words or less common words.'
+    return 'This search took too long and was cancelled. Try adding more words or less common words.'
+
+# Fetches the next page in the background while the current one is being read.
+prefetcher = ThreadPoolExecutor(max_workers=1)
+
+def prefetch_page(language, search_terms, page_size, view, after, filters=None):
+    def prefetch():
+        connection = engine.connect()
+        try:
+            searcher.fetch_page(connection, language, search_terms, page_size, view, after, 0, filters)
+        except Exception as e:
+            print(f"Prefetch failed: '{e}'")
+        finally:
+            connection.close()
+    prefetcher.submit(prefetch)
+
+def capped_notice(capped):
+    if not capped:
+        return html.Div()
+    return dcc.Markdown('''
+        *This phrase is very common: only the first {:,} matching paragraphs were ranked.*
+        '''.format(capped))
+
+# ------------- Load datasets and figures ---------------
+# Built by server-snapshot.py (or on first start) and reused until the data changes. See snapshot.py.
+startup = snapshot.load(engine, cfg['Snapshot']['path'])
+supported_languages = startup['supported_languages']
+authors = startup['authors']
+unsupported_languages = startup['unsupported_languages']
+mentioned_authors = startup['mentioned_authors']
+author_graph = startup['author_graph']
+author_index = startup['author_index']
+fig1 = startup['fig1']
+fig3 = startup['fig3']
+book_filters = startup['book_filters']
 
-layout = dict(updatemenus=updatemenus, title='Number of books (Linear scale)')
-fig3 = go.Figure(data=df3, layout=layout)
+# ------------- Searches ---------------------------------
+# With Search: backend: index, the index built by server-build-index.py ranks the default view of
+# the languages it has been built for (see invindex.py). With Shards: constrings, the ranked view is
+# ranked on every shard in parallel (see shards.py). See searcher.py for the rest.
+search_index = invindex.Index(cfg['Search']['index_path']) if cfg['Search']['backend'] == 'index' else None
+shards = Shards(cfg['Shards']['constrings']) if cfg['Shards']['constrings'] else None
+searcher = Searcher(admission, discovery=cfg['Discovery'], cache=result_cache, stage=metrics.stage, book_filters=book_filters, search_index=search_index, shards=shards,
+                    dedup=cfg['Search']['dedup'], hot_searches=cfg['HotSearches']['serve'], pushdown_books=cfg['Filters']['pushdown_books'])
+
+# With gunicorn --preload this ran in the master: don't let the workers inherit its connections.
+engine.dispose()
+
+# ------------- Full result export ----------------------
+# /export?language=English&q=bellows+to+mend&mode=phrase&format=csv streams every matching book.
+# mode is phrase (as the Search tab) or plain (as Discovery mode), format csv or ndjson.
+@server.route('/export')
+def export_results():
+    start = time.perf_counter()
+    language = request.args.get('language', 'English')
+    search_terms = request.args.get('q', '')
+    mode = request.args.get('mode', 'phrase')
+    format = request.args.get('format', 'csv')
+    if language not in set(supported_languages['language']) or mode not in EXPORT_MODES or format not in export.FORMATS or not search_terms.strip():
+        return jsonify({'error': 'Expected language (one of the supported languages), q, mode (phrase or plain) and format (csv or ndjson).'}), 400
+    tab = 'Export' if mode == 'phrase' else 'Discovery export'
+    def logged(rows):
+        query_log.log(tab, language, search_terms, None, None, 1000 * (time.perf_counter() - start), rows)
+    connection = engine.connect()
+    try:
+        body, finish, max_paragraphs = searcher.export(connection, language, search_terms, mode, format, chunk_rows=cfg['Export']['chunk_rows'], on_close=logged)
+    except (TooBroad, Busy, Timeout) as e:
+        connection.close()
+        return jsonify({'error': admission_message(e)}), 503 if isinstance(e, Busy) else 422
+    except Exception:
+        connection.close()
+        raise
+    response = Response(body, mimetype=export.FORMATS[format])
+    response.call_on_close(finish)
+    response.headers['Content-Disposition'] = 'attachment; filename="gutensearch.{}"'.format(format)
+    if max_paragraphs:
+        response.headers['X-Capped-Paragraphs'] = str(max_paragraphs)
+    return response
+
+# ------------- Batch search API ------------------------
+# POST /api/search with {"queries": [{"language": "English", "q": "bellows to mend", "mode": "phrase",
+# "limit": 10}, ...]} returns the first page of each search, ranked and with headlines as in the
+# Search tab, as newline-delimited JSON: one {"index": i, "records": [...], "capped": ...} or
+# {"index": i, "error": "..."} line per query, in the order they finish. Searches run at most
+# Batch: workers at a time, on the connection pool, and a search repeated within a batch (same
+# language, mode, limit and normalised tsquery) runs once.
+batch_pool = ThreadPoolExecutor(max_workers=cfg['Batch']['workers'])
+BATCH_VIEW = {'sort': 'rank', 'descending': True, 'filters': []}
+
+def batch_entry(entry):
+    if not isinstance(entry, dict):
+        raise ValueError('Expected an object.')
+    language, search_terms, mode, limit = entry.get('language', 'English'), entry.get('q'), entry.get('mode', 'phrase'), entry.get('limit', 10)
+    if language not in set(supported_languages['language']) or mode not in EXPORT_MODES or not isinstance(search_terms, str) or not search_terms.strip() or isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError('Expected language (one of the supported languages), q, mode (phrase or plain) and limit (1 to {}).'.format(MAX_PAGE_SIZE))
+    return language, search_terms, mode, limit
+
+def batch_search_one(language, search_terms, mode, limit):
+    start = time.perf_counter()
+    connection = engine.connect()
+    try:
+        page = searcher.fetch_page(connection, language, search_terms, limit, BATCH_VIEW, None, 0, mode=mode)
+    except (TooBroad, Busy, Timeout):
+        query_log.log('API', language, search_terms, limit, 1, 1000 * (time.perf_counter() - start), 0)
+        raise
+    finally:
+        connection.close()
+    query_log.log('API', language, search_terms, limit, 1, 1000 * (time.perf_counter() - start), len(page['records']))
+    return {'records': page['records'], 'capped': page['capped']}
+
+@server.route('/api/search', methods=['POST'])
+def batch_search():
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not 1 <= len(queries) <= cfg['Batch']['max_queries']:
+        return jsonify({'error': 'Expected {{"queries": [...]}} with 1 to {} queries.'.format(cfg['Batch']['max_queries'])}), 400
+    errors, searches = [], {}
+    connection = engine.connect()
+    try:
+        for index, entry in enumerate(queries):
+            try:
+                language, search_terms, mode, limit = batch_entry(entry)
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+                continue
+            key = (language, mode, limit, searcher.normalize(connection, mode, search_params(language, search_terms, limit, 1)))
+            searches.setdefault(key, ((language, search_terms, mode, limit), []))[1].append(index)
+    finally:
+        connection.close()
+    futures = {batch_pool.submit(batch_search_one, *search): indexes for search, indexes in searches.values()}
+
+    def lines():
+        try:
+            for error in errors:
+                yield json.dumps(error) + '\n'
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except (TooBroad, Busy, Timeout) as e:
+                    result = {'error': admission_message(e)}
+                except Exception as e:
+                    print(f"Batch search failed: '{e}'")
+                    result = {'error': 'This search failed.'}
+                for index in futures[future]:
+                    yield json.dumps(dict(result, index=index)) + '\n'
+        finally:
+            # The client went away: don't start what's still queued.
+            for future in futures:
+                future.cancel()
+    return Response(lines(), mimetype='application/x-ndjson; charset=utf-8')
 
 # ------------- Define layout for the app ----------------
 
@@ -139,22 +290,43 @@ def render_content(tab):
                     '''),
                 dcc.Input(id='search-terms-input', type='text', value='bellows to mend'),
                 dcc.Markdown('''
-                    **Show this many rows:**
+                    **Rows per page:**
                     '''
                 ),
                 dcc.Input(
                         id="range-limit", type="number", placeholder="input with range",
-                        min=1, max=60000000, step=1, value=10,
+                        min=1, max=MAX_PAGE_SIZE, step=1, value=10,
                 ),
+            ], style={'columnCount': 3}),    
+            html.Div([
                 dcc.Markdown('''
-                    **Starting with row:**
+                    **Author:**
                     '''
                 ),
-                dcc.Input(
-                    id="range-offset", type="number", placeholder="input with range",
-                    min=1, max=60000000, step=1, value=1,
+                dcc.Dropdown(id='filter-author', options=[], searchable=True, placeholder='Any author'),
+                dcc.Markdown('''
+                    **Author born between:**
+                    '''
                 ),
-            ], style={'columnCount': 4}),    
+                dcc.Input(id='filter-born-from', type='number', step=1, placeholder='year'),
+                dcc.Input(id='filter-born-to', type='number', step=1, placeholder='year'),
+                dcc.Markdown('''
+                    **Author died between:**
+                    '''
+                ),
+                dcc.Input(id='filter-died-from', type='number', step=1, placeholder='year'),
+                dcc.Input(id='filter-died-to', type='number', step=1, placeholder='year'),
+                dcc.Markdown('''
+                    **Library of Congress class:**
+                    '''
+                ),
+                dcc.Dropdown(id='filter-loc-class', options=[], placeholder='Any class'),
+                dcc.Markdown('''
+                    **Subject contains:**
+                    '''
+                ),
+                dcc.Input(id='filter-subject', type='text', placeholder='e.g. sea stories'),
+            ], style={'columnCount': 3}),
             html.Div([
                 dcc.Markdown('''
                     ###### Press to run:
@@ -166,7 +338,7 @@ def render_content(tab):
             dcc.Markdown('''
                 ###### Notes:
                 - Stopwords ("to", "the", "a", etc.) will be ignored. "to be or not to be" will thus return nothing.
-                - (English only) a common enough query ("once upon a time") may time out due to too many matches. Try adding more words or less common words.
+                - (English only) a very common query ("once upon a time") matches too many paragraphs to rank them all: only the first matches are ranked, or the search is refused. Try adding more words or less common words.
                 - If you just want to look up an author or a title, head to [Project Gutenberg](https://www.gutenberg.org/ebooks/) or [Google](https://www.google.com/search?q=site%3Agutenberg.org) instead.
                 
                 '''
@@ -216,7 +388,7 @@ def render_content(tab):
                 dcc.Markdown('''
                     #### Shortest Path
                     
-                    Authors mentioning other authors count as a link between the two, whatever the direction. Find the shortest path between two authors. Because this function does not yet use autocomplete, please check your author name spelling on Project Gutenberg.
+                    Authors mentioning other authors count as a link between the two, whatever the direction. Find the shortest path between two authors. Start typing a name for suggestions; misspelled names are matched to the closest author.
                 
                     Press to find the shortest path between two authors:
                     '''
@@ -224,8 +396,8 @@ def render_content(tab):
                 dcc.Markdown('''
                     **From:**
                     '''),
-                dcc.Input(id='from-author', type='text', value='Marcel Proust'),
-                dcc.Input(id='to-author', type='text', value='Walter Scott'),
+                dcc.Dropdown(id='from-author', options=[{'label': 'Marcel Proust', 'value': 'Marcel Proust'}], value='Marcel Proust', searchable=True),
+                dcc.Dropdown(id='to-author', options=[{'label': 'Walter Scott', 'value': 'Walter Scott'}], value='Walter Scott', searchable=True),
                 html.Button(id='from-to-author-button', n_clicks=0, children='Submit'),
                 html.Div(id='author-path'),
             ], style={'columnCount': 1}),
@@ -262,7 +434,7 @@ def render_content(tab):
                     
                     #### Search
                     
-                    The search uses the language in metadata to phraseto_query the indexed column to preserve ordering of the lexemes, which gave far more precise and less numerous results. [Textsearch headline](https://www.postgresql.org/docs/11/textsearch-controls.html#TEXTSEARCH-HEADLINE) with MaxFragments=1000 was used to generate a quote around matched terms which were aggregated per book with the ts_rank_cd averaged across all matched paragraphs. 
+                    The search uses the language in metadata to phraseto_query the indexed column to preserve ordering of the lexemes, which gave far more precise and less numerous results. Books are first ranked by the ts_rank_cd averaged across all matched paragraphs, using only the index. [Textsearch headline](https://www.postgresql.org/docs/11/textsearch-controls.html#TEXTSEARCH-HEADLINE) with MaxFragments=1000 is then used to generate a quote around matched terms for the best few paragraphs of each book on the requested page only. 
                 
                     '''
                 ),
@@ -363,7 +535,6 @@ def render_content(tab):
                 #### WIP
                 
                 - Move to the raw data (rsync Project Gutenberg directly).
-                - Add where clause parameters (author, year of birth and death, etc.)
                 - Resolve search edge cases.
                 - Option to use plainto_tsquery for fuzzier matching with more results.
                 - Optimisation of Dash.
@@ -383,46 +554,29 @@ def render_content(tab):
         ], style={'width': '70%', 'margin': 'auto'})
 
 # ------------- Make the app interactive -----------------
+# The search results table is paged, sorted and filtered on the server: update_table only lays it
+# out, and update_page fetches each page by keyset (see page_query in search.py).
 @app.callback(
     Output('tableDiv', 'children'),
     Input('submit-button-state', 'n_clicks'), 
     State('language-dropdown', 'value'), 
     State('search-terms-input', 'value'),
     State('range-limit', 'value'),
-    State('range-offset', 'value')
+    State('filter-author', 'value'),
+    State('filter-born-from', 'value'),
+    State('filter-born-to', 'value'),
+    State('filter-died-from', 'value'),
+    State('filter-died-to', 'value'),
+    State('filter-loc-class', 'value'),
+    State('filter-subject', 'value')
 )
-def update_table(n_clicks, language, search_terms, limit, offset):             
-    query = """with paragraphs as (
-                select 
-                num
-                , paragraph
-                , ts_rank_cd(textsearchable_index_col, phraseto_tsquery(%s::regconfig, %s), 32) as rank 
-                , ts_headline(%s, paragraph, phraseto_tsquery(%s::regconfig, %s), 'MaxFragments=1000, StartSel=**, StopSel=**') as highlighted_result 
-                from gutenberg.paragraphs 
-                where language = %s::regconfig and textsearchable_index_col @@ phraseto_tsquery(%s::regconfig, %s)
-            )
-            select b.author
-            , '[' || b.title::text || '](https://www.gutenberg.org/ebooks/' || b.num::text || ')' as title
-            , '  ...' || substr(string_agg(distinct highlighted_result, E'\n[...]\n'), 1, 10000) || E'...  ' as relevant_paragraphs
-            , to_char(100*avg(rank), '99D9') as rank
-            from paragraphs a
-            inner join gutenberg.all_data b on a.num = b.num
-            group by b.author, b.title, b.num
-            order by rank desc
-            limit %s offset %s;
-    """
-    # Make sure to leave a space after :language or sqlalchemy won't insert the string correctly.
-    insert = text("""insert into gutenberg.query_log (tab, time, language, query, rows_returned_aka_limit, start_row_aka_offset) values ('Search', now(), :language ::regconfig, :query, :rows_returned_aka_limit, :start_row_aka_offset);""")
-    connection = engine.connect()
-    results = pd.read_sql_query(query, connection, params=[language, search_terms, language, language, search_terms, language, language, search_terms, limit, offset-1])
-    connection.execute(insert, ({"language": language, "query": search_terms, "rows_returned_aka_limit": limit, "start_row_aka_offset": offset}))
-    connection.close()
-
-    #turn df back into dictionary 
-    dict_results= results.iloc[:, 0:3].to_dict('records')
+@metrics.callback('update_table')
+def update_table(n_clicks, language, search_terms, limit, author, born_from, born_to, died_from, died_to, loc_class, subject):             
+    page_size = min(max(limit or 10, 1), MAX_PAGE_SIZE)
+    filters = bookfilters.normalize(author, [born_from, born_to], [died_from, died_to], loc_class, subject)
     #Create Table
     tbl = dash_table.DataTable(
-        id = 'table',
+        id = 'search-table',
         style_cell={
                 'whiteSpace': 'normal',
                 'height': 'auto',
@@ -435,54 +589,92 @@ def update_table(n_clicks, language, search_terms, limit, offset):
                     'textAlign': 'left'
                 }
             ],
-        data=dict_results,
+        data=[],
         columns=[
             {'name': 'Author', 'id':'author', 'type':'text', 'presentation':'markdown'}, 
             {'name': 'Title', 'id':'title', 'type':'text', 'presentation':'markdown'}, 
             {'name': 'Relevant paragraphs', 'id':'relevant_paragraphs', 'type':'text', 'presentation':'markdown'}, 
         ],
         markdown_options={'link_target': '_blank'},
-        filter_action = 'native',
-        sort_action = 'native',
-        sort_mode = 'multi',
+        page_action = 'custom',
+        page_current = 0,
+        page_size = page_size,
+        filter_action = 'custom',
+        filter_query = '',
+        sort_action = 'custom',
+        sort_mode = 'single',
+        sort_by = [],
         export_format="csv",
         
     )
-    return html.Div([tbl])
-    
+    # boundaries holds the keyset of the last row of every page fetched so far, for the current view.
+    state = {'language': language, 'search_terms': search_terms, 'filters': filters, 'view': None, 'boundaries': {}}
+    return html.Div([dcc.Store(id='search-state', data=state), html.Div(id='search-notice'), tbl])
+
+@app.callback(
+    Output('search-table', 'data'),
+    Output('search-table', 'page_count'),
+    Output('search-notice', 'children'),
+    Output('search-state', 'data'),
+    Input('search-table', 'page_current'),
+    Input('search-table', 'sort_by'),
+    Input('search-table', 'filter_query'),
+    State('search-table', 'page_size'),
+    State('search-state', 'data')
+)
+@metrics.callback('update_page')
+def update_page(page_current, sort_by, filter_query, page_size, state):
+    start = time.perf_counter()
+    language, search_terms = state['language'], state['search_terms']
+    page_current = page_current or 0
+    view = view_from_table(sort_by, filter_query)
+    if view != state['view']:
+        state['view'] = view
+        state['boundaries'] = {}
+    # Keyset from the previous page when we have it; only a jump to an unseen page uses an offset.
+    after = state['boundaries'].get(str(page_current - 1)) if page_current else None
+    offset = page_current * page_size if page_current and after is None else 0
+    with metrics.stage('connect'):
+        connection = engine.connect()
+    try:
+        page = searcher.fetch_page(connection, language, search_terms, page_size, view, after, offset, state['filters'])
+    except (TooBroad, Busy, Timeout) as e:
+        query_log.log('Search', language, search_terms, page_size, page_current * page_size + 1, 1000 * (time.perf_counter() - start), 0)
+        return [], 1, dcc.Markdown(admission_message(e)), state
+    finally:
+        connection.close()
+    records = page['records']
+    if page['last'] is not None:
+        state['boundaries'][str(page_current)] = page['last']
+    if len(records) < page_size:
+        page_count = max(page_current + (1 if records else 0), 1)
+    else:
+        # Unknown: counting every match would cost as much as ranking them all.
+        page_count = None
+        if not page['capped']:
+            prefetch_page(language, search_terms, page_size, view, page['last'], state['filters'])
+    query_log.log('Search', language, search_terms, page_size, page_current * page_size + 1, 1000 * (time.perf_counter() - start), len(records))
+    return records, page_count, capped_notice(page['capped']), state
+
 @app.callback(
     Output('discovery-tableDiv', 'children'),
     Input('discovery-submit-button-state', 'n_clicks'), 
     State('discovery-language-dropdown', 'value'), 
     State('discovery-search-terms-input', 'value')
 )
+@metrics.callback('update_discovery_table')
 def update_discovery_table(n_clicks, language, search_terms):             
-    query = """with paragraphs as (
-                select 
-                num
-                , paragraph
-                , ts_headline(%s, paragraph, plainto_tsquery(%s::regconfig, %s), 'MaxFragments=1000, StartSel=**, StopSel=**') as highlighted_result
-                from gutenberg.paragraphs 
-                where language = %s::regconfig and textsearchable_index_col @@ plainto_tsquery(%s::regconfig, %s)
-            )
-            select b.author
-            , '[' || b.title::text || '](https://www.gutenberg.org/ebooks/' || b.num::text || ')' as title
-            , '  ...' || substr(string_agg(distinct highlighted_result, E'\n[...]\n'), 1, 10000) || '...  ' as relevant_paragraphs
-            , random() as rand
-            from paragraphs a
-            inner join gutenberg.all_data b on a.num = b.num
-            group by b.author, b.title, b.num
-            order by rand desc
-            limit 30;
-    """
-    # Make sure to leave a space after :language or sqlalchemy won't insert the string correctly.
-    insert = text("""insert into gutenberg.query_log (tab, time, language, query, rows_returned_aka_limit, start_row_aka_offset) values ('Discovery', now(), :language ::regconfig, :query, 30, 0);""")
-    connection = engine.connect()
-    results = pd.read_sql_query(query, connection, params=[language, language, search_terms, language, language, search_terms])[["author", "title", "relevant_paragraphs"]]
-    connection.execute(insert, ({"language": language, "query": search_terms}))
-    connection.close()
-    #turn df back into dictionary 
-    dict_results= results.to_dict('records')
+    start = time.perf_counter()
+    with metrics.stage('connect'):
+        connection = engine.connect()
+    try:
+        dict_results = searcher.fetch_discovery(connection, language, search_terms)
+    except Timeout as e:
+        query_log.log('Discovery', language, search_terms, discovery_books, 0, 1000 * (time.perf_counter() - start), 0)
+        return html.Div([dcc.Markdown(admission_message(e))])
+    finally:
+        connection.close()
+    query_log.log('Discovery', language, search_terms, discovery_books, 0, 1000 * (time.perf_counter() - start), len(dict_results))
     #Create Table
     tbl = dash_table.DataTable(
         id = 'table',
@@ -518,12 +710,11 @@ def update_discovery_table(n_clicks, language, search_terms):
               Input('submit-button-state', 'n_clicks'),
               State('language-dropdown', 'value'),
               State('search-terms-input', 'value'),
-              State('range-limit', 'value'),
-              State('range-offset', 'value'))
-def update_output(n_clicks, language, input, range_limit, range_offset):
+              State('range-limit', 'value'))
+def update_output(n_clicks, language, input, range_limit):
     return u'''
-        Current selection: "{}", "{}" starting with result no. {} for {} rows. Matched words are highlighted. May take up to 30 seconds to load.
-    '''.format(language, input, range_offset, range_limit)
+        Current selection: "{}", "{}", {} rows per page, with the filters above. Matched words are highlighted. Sort by author or title and filter with the table headers. May take up to 30 seconds to load.
+    '''.format(language, input, range_limit)
     
 @app.callback(Output('discovery-search-terms-active', 'children'),
               Input('discovery-submit-button-state', 'n_clicks'),
@@ -538,11 +729,54 @@ def update_output(n_clicks, language, input):
               Input('from-to-author-button', 'n_clicks'),
               State('from-author', 'value'),
               State('to-author', 'value'))
+@metrics.callback('update_author_path')
 def update_author_path(n_clicks, from_author, to_author):
-    path = nx.dijkstra_path(mentioned_authors_graph, from_author, to_author)
+    with metrics.stage('resolve'):
+        source = author_index.resolve(from_author)
+        target = author_index.resolve(to_author)
+    if source is None or target is None:
+        return u'''
+        No author found for "{}".
+    '''.format(from_author if source is None else to_author)
+    with metrics.stage('path'):
+        path = author_graph.shortest_path(source, target)
+    if path is None:
+        return u'''
+        No path between "{}" and "{}".
+    '''.format(source, target)
     return u'''
         Shortest path: "{}".
-    '''.format(path, input)
+    '''.format(path)
+
+# Suggestions for the author dropdowns, keeping the current value selectable.
+def author_options(search_value, value):
+    names = author_index.suggest(search_value) if search_value else []
+    if value and value not in names:
+        names = [value] + names
+    return [{'label': name, 'value': name} for name in names]
+
+@app.callback(Output('filter-author', 'options'),
+              Input('filter-author', 'search_value'),
+              State('filter-author', 'value'))
+def update_filter_author_options(search_value, value):
+    return author_options(search_value, value)
+
+@app.callback(Output('filter-loc-class', 'options'),
+              Input('language-dropdown', 'value'))
+def update_loc_class_options(language):
+    return [{'label': loc_class, 'value': loc_class} for loc_class in book_filters.loc_class_options(language or '')]
+
+@app.callback(Output('from-author', 'options'),
+              Input('from-author', 'search_value'),
+              State('from-author', 'value'))
+def update_from_author_options(search_value, value):
+    return author_options(search_value, value)
+
+@app.callback(Output('to-author', 'options'),
+              Input('to-author', 'search_value'),
+              State('to-author', 'value'))
+def update_to_author_options(search_value, value):
+    return author_options(search_value, value)
 
 # if running locally, just use localhost (127.0.0.1). You can then run the app by clicking http://127.0.0.1:port/ 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+# Author graph and name index for the Shortest Path feature.
+#
+# The graph is kept as CSR arrays (indptr, indices, costs) over integer author ids, which is compact,
+# pickles quickly into the startup snapshot and is shared by the workers forked from the gunicorn
+# master. Paths are found with a bidirectional Dijkstra. Authors mentioning each other in either
+# direction are linked. A link costs 1 + 1/(books_mentioned_in * authors): a path has fewer hops
+# than there are authors, so what the second terms add up to along it stays under one hop, and the
+# path with the fewest hops always wins, then among those the one through the most often mentioned
+# links.
+#
+# NameIndex backs the author autocomplete: prefix matches on the full name or any of its later words
+# (so "scott" finds "Walter Scott"), then trigram similarity for misspellings.
+
+import heapq
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+import numpy as np
+
+class AuthorGraph:
+    def __init__(self, names, indptr, indices, costs):
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
+        self.indptr = indptr
+        self.indices = indices
+        self.costs = costs
+
+    @classmethod
+    def from_edges(cls, mentioned_author, mentioned_by, books_mentioned_in):
+        names = sorted(set(mentioned_author) | set(mentioned_by))
+        ids = {name: i for i, name in enumerate(names)}
+        books = defaultdict(int)
+        for a, b, count in zip(mentioned_author, mentioned_by, books_mentioned_in):
+            a, b = ids[a], ids[b]
+            if a != b:
+                books[min(a, b), max(a, b)] += int(count)
+        pairs = np.array(list(books.keys()), dtype=np.int32).reshape(-1, 2)
+        counts = np.array(list(books.values()), dtype=np.float64)
+        sources = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        targets = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        counts = np.concatenate([counts, counts])
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(len(names) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(names)), out=indptr[1:])
+        # float64: the second terms are too small for float32 next to 1.
+        return cls(names, indptr, targets[order].astype(np.int32), 1.0 + 1.0 / (counts[order] * max(len(names), 1)))
+
+    @classmethod
+    def from_frame(cls, mentioned_authors):
+        return cls.from_edges(mentioned_authors['mentioned_author'].tolist(), mentioned_authors['mentioned_by'].tolist(), mentioned_authors['books_mentioned_in'].tolist())
+
+    def degree(self, name):
+        i = self.ids.get(name)
+        return 0 if i is None else int(self.indptr[i + 1] - self.indptr[i])
+
+    def neighbours(self, node):
+        start, stop = self.indptr[node], self.indptr[node + 1]
+        return zip(self.indices[start:stop].tolist(), self.costs[start:stop].tolist())
+
+    # Returns the list of names from source to target, or None if they are not connected.
+    def shortest_path(self, source, target):
+        if source not in self.ids or target not in self.ids:
+            return None
+        source, target = self.ids[source], self.ids[target]
+        if source == target:
+            return [self.names[source]]
+        dist = ({source: 0.0}, {target: 0.0})
+        prev = ({source: None}, {target: None})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        settled = (set(), set())
+        best, meet = float('inf'), None
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+            side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+            d, node = heapq.heappop(heaps[side])
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+            for neighbour, cost in self.neighbours(node):
+                candidate = d + cost
+                if candidate < dist[side].get(neighbour, float('inf')):
+                    dist[side][neighbour] = candidate
+                    prev[side][neighbour] = node
+                    heapq.heappush(heaps[side], (candidate, neighbour))
+                    other = dist[1 - side].get(neighbour)
+                    if other is not None and candidate + other < best:
+                        best, meet = candidate + other, neighbour
+        if meet is None:
+            return None
+        path = []
+        node = meet
+        while node is not None:
+            path.append(node)
+            node = prev[0][node]
+        path.reverse()
+        node = prev[1][meet]
+        while node is not None:
+            path.append(node)
+            node = prev[1][node]
+        return [self.names[i] for i in path]
+
+NON_WORD = re.compile(r'[\W_]+')
+
+def normalize(name):
+    return NON_WORD.sub(' ', name.lower()).strip()
+
+def trigrams(name):
+    grams = set()
+    for word in normalize(name).split():
+        padded = '  ' + word + ' '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class NameIndex:
+    def __init__(self, names, weights=None):
+        self.names = list(names)
+        # Higher weight first among equally good matches, e.g. how connected an author is.
+        self.weights = np.asarray(weights if weights is not None else np.zeros(len(self.names)), dtype=np.float64)
+        self.exact = {}
+        keys = []
+        grams = defaultdict(list)
+        self.gram_counts = np.zeros(len(self.names), dtype=np.int32)
+        for i, name in enumerate(self.names):
+            normalized = normalize(name)
+            self.exact.setdefault(normalized, i)
+            words = normalized.split()
+            keys.extend((' '.join(words[k:]), i) for k in range(len(words)))
+            name_grams = trigrams(name)
+            self.gram_counts[i] = len(name_grams)
+            for gram in name_grams:
+                grams[gram].append(i)
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.key_ids = np.array([i for _, i in keys], dtype=np.int32)
+        self.grams = {gram: np.array(ids, dtype=np.int32) for gram, ids in grams.items()}
+
+    def prefix(self, query, limit=10):
+        query = normalize(query)
+        if not query:
+            return []
+        start = bisect_left(self.keys, query)
+        stop = bisect_left(self.keys, query + '￿')
+        ids = np.unique(self.key_ids[start:stop])
+        ids = ids[np.argsort(-self.weights[ids], kind='stable')]
+        return ids[:limit].tolist()
+
+    # Trigram similarity as in pg_trgm: shared trigrams over the trigrams of both names.
+    def fuzzy(self, query, limit=10, threshold=0.3):
+        query_grams = [self.grams[gram] for gram in trigrams(query) if gram in self.grams]
+        if not query_grams:
+            return []
+        shared = np.bincount(np.concatenate(query_grams), minlength=len(self.names))
+        candidates = np.nonzero(shared)[0]
+        similarity = shared[candidates] / (len(trigrams(query)) + self.gram_counts[candidates] - shared[candidates])
+        keep = similarity >= threshold
+        candidates, similarity = candidates[keep], similarity[keep]
+        order = np.lexsort((-self.weights[candidates], -similarity))[:limit]
+        return candidates[order].tolist()
+
+    def suggest(self, query, limit=10):
+        ids = self.prefix(query, limit)
+        if len(ids) < limit:
+            ids += [i for i in self.fuzzy(query, limit) if i not in ids][:limit - len(ids)]
+        return [self.names[i] for i in ids]
+
+    # The author a typed name most likely refers to, or None.
+    def resolve(self, query):
+        if not query:
+            return None
+        i = self.exact.get(normalize(query))
+        if i is None:
+            ids = self.prefix(query, 1) or self.fuzzy(query, 1)
+            i = ids[0] if ids else None
+        return None if i is None else self.names[i]
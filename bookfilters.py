@@ -0,0 +1,112 @@
+# Book metadata filters for the Search tab: author, author's years of birth and death, LoC class and
+# subject.
+#
+# The metadata of every book in a supported language is kept per language as numpy columns (codes
+# into shared value lists for the text ones), pickled into the startup snapshot like the author
+# graph. A filter is a few vectorized comparisons into a mask over the language's books, so the
+# matching book nums are known before Postgres ranks anything (see page_query in search.py). share is
+# the part of the language's text those books hold, which scales the admission estimate.
+
+import re
+
+import numpy as np
+
+YEAR = re.compile(r'-?\d+')
+
+BOOKS_QUERY = """select a.num, b.cfgname::text, a.author, a.author_birth, a.author_death, a.loc_class, a.subject, a.length
+from gutenberg.all_data a
+inner join pg_ts_config b on lower(a.language) = b.cfgname
+order by a.num;"""
+
+def year(value):
+    match = YEAR.search(value or '')
+    return float(match.group()) if match else np.nan
+
+# The filters that are set, from the Search tab's inputs. born and died are [from, to], either
+# end may be None.
+def normalize(author=None, born=None, died=None, loc_class=None, subject=None):
+    filters = {}
+    if author:
+        filters['author'] = author
+    for name, years in (('born', born), ('died', died)):
+        if years and any(value is not None for value in years):
+            filters[name] = [years[0], years[1]]
+    if loc_class:
+        filters['loc_class'] = loc_class
+    if subject and subject.strip():
+        filters['subject'] = subject.strip().lower()
+    return filters
+
+class Codes:
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+
+    def code(self, value):
+        if value is None:
+            return -1
+        if value not in self.ids:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        return self.ids[value]
+
+class BookFilters:
+    def __init__(self, languages, authors, loc_classes, subjects):
+        # language: {'num', 'author', 'born', 'died', 'loc_class', 'subject', 'length'} arrays, by num.
+        self.languages = languages
+        self.authors = authors
+        self.author_ids = {author: i for i, author in enumerate(authors)}
+        self.loc_classes = loc_classes
+        self.subjects = subjects
+        self.lower_subjects = [subject.lower() for subject in subjects]
+
+    @classmethod
+    def from_rows(cls, rows):
+        authors, loc_classes, subjects = Codes(), Codes(), Codes()
+        columns = {}
+        for num, language, author, birth, death, loc_class, subject, length in rows:
+            books = columns.setdefault(language, {'num': [], 'author': [], 'born': [], 'died': [], 'loc_class': [], 'subject': [], 'length': []})
+            books['num'].append(num)
+            books['author'].append(authors.code(author))
+            books['born'].append(year(birth))
+            books['died'].append(year(death))
+            books['loc_class'].append(loc_classes.code(loc_class))
+            books['subject'].append(subjects.code(subject))
+            books['length'].append(length or 0)
+        types = {'num': np.int32, 'author': np.int32, 'born': np.float32, 'died': np.float32, 'loc_class': np.int32, 'subject': np.int32, 'length': np.float64}
+        languages = {language: {name: np.array(values, dtype=types[name]) for name, values in books.items()} for language, books in columns.items()}
+        return cls(languages, authors.values, loc_classes.values, subjects.values)
+
+    @classmethod
+    def from_engine(cls, engine):
+        return cls.from_rows(engine.execute(BOOKS_QUERY))
+
+    def loc_class_options(self, language):
+        books = self.languages.get(language.lower())
+        if books is None:
+            return []
+        return sorted(self.loc_classes[code] for code in np.unique(books['loc_class']) if code >= 0)
+
+    # (nums, share): the sorted nums of the books of language matching filters, and the part of the
+    # language's text they hold.
+    def books(self, language, filters):
+        books = self.languages.get(language.lower())
+        if books is None:
+            return np.zeros(0, dtype=np.int32), 0.0
+        mask = np.ones(len(books['num']), dtype=bool)
+        if 'author' in filters:
+            mask &= books['author'] == self.author_ids.get(filters['author'], -2)
+        for name in ('born', 'died'):
+            if name in filters:
+                start, stop = filters[name]
+                if start is not None:
+                    mask &= books[name] >= start
+                if stop is not None:
+                    mask &= books[name] <= stop
+        if 'loc_class' in filters:
+            mask &= books['loc_class'] == (self.loc_classes.index(filters['loc_class']) if filters['loc_class'] in self.loc_classes else -2)
+        if 'subject' in filters:
+            codes = [code for code, subject in enumerate(self.lower_subjects) if filters['subject'] in subject]
+            mask &= np.isin(books['subject'], codes)
+        total = books['length'].sum()
+        return books['num'][mask], float(books['length'][mask].sum() / total) if total else 0.0
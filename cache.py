@@ -0,0 +1,225 @@
+# Result cache shared by all gunicorn workers through a local SQLite file.
+#
+# Keys are built from the normalised tsquery (what phraseto_tsquery/plainto_tsquery return), so
+# "to be or not to be" variants that only differ by stopwords or inflection share one entry.
+# Entries expire after a TTL, which tab_ttls can shorten for a tab (Discovery draws new books), and
+# the least recently used ones are evicted once the stored results exceed max_bytes. Hits, misses,
+# evictions and errors are counted in the same file so they add up across workers.
+#
+# A lookup only reads: each process keeps its counts and the last use of the entries it served in
+# memory, and a background thread writes them in one transaction every flush_interval seconds (and on
+# exit), so the workers don't queue on SQLite's write lock for every search. Expired entries are
+# skipped by lookups and deleted at the flush. The total size is kept as a counter, updated in the
+# transaction that changes it, rather than summed over the table on every write.
+#
+# The cache must never fail a search: a lookup that hits an SQLite error is a miss, a write that does
+# is skipped, and both are counted as errors.
+
+import atexit
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Part of every key, bump it when the cached values change shape.
+FORMAT = 2
+
+SCHEMA = """create table if not exists results
+  (key text primary key
+    , value text not null
+    , size integer not null
+    , created real not null
+    , last_used real not null);
+create index if not exists results_last_used_idx on results (last_used);
+create index if not exists results_created_idx on results (created);
+create table if not exists counters
+  (name text primary key
+    , value integer not null);
+insert or ignore into counters (name, value) values ('hits', 0), ('misses', 0), ('evictions', 0), ('expirations', 0), ('errors', 0);
+insert or ignore into counters (name, value) select 'bytes', coalesce(sum(size), 0) from results;
+"""
+
+class ResultCache:
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, ttl=86400, flush_interval=5.0, tab_ttls=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.tab_ttls = tab_ttls or {}
+        self.flush_interval = flush_interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    # Threads don't survive gunicorn's fork, so each worker starts its own flusher on first use. It
+    # also starts what this process hasn't written yet: counter increments and the last use of entries.
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.counts = {}
+            self.used = {}
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self.run, name='cache-flusher', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    # One connection per process and thread: SQLite connections must not cross a fork.
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('pragma journal_mode=wal;')
+            connection.execute('pragma synchronous=normal;')
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def key(tab, language, tsquery, limit, offset):
+        return json.dumps([FORMAT, tab, language, tsquery, limit, offset])
+
+    # The keys of a tab sort between these two, so the primary key finds them.
+    @staticmethod
+    def key_range(tab):
+        prefix = json.dumps([FORMAT, tab])[:-1] + ', '
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def ttl_for(self, key):
+        for tab, ttl in self.tab_ttls.items():
+            low, high = self.key_range(tab)
+            if low <= key < high:
+                return ttl
+        return self.ttl
+
+    def count(self, name, increment=1):
+        self.start()
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + increment
+
+    def get(self, key):
+        now = time.time()
+        try:
+            row = self.connection().execute('select value, created from results where key = ?;', (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Could not read the result cache: '{e}'")
+            self.count('errors')
+            return None
+        if row is not None and now - row[1] > self.ttl_for(key):
+            self.count('expirations')
+            row = None
+        if row is None:
+            self.count('misses')
+            return None
+        self.count('hits')
+        with self.lock:
+            self.used[key] = now
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value)
+        now = time.time()
+        if len(data) > self.max_bytes:
+            return
+        connection = None
+        try:
+            connection = self.connection()
+            connection.execute('begin immediate;')
+            old = connection.execute('select size from results where key = ?;', (key,)).fetchone()
+            connection.execute('insert or replace into results (key, value, size, created, last_used) values (?, ?, ?, ?, ?);', (key, data, len(data), now, now))
+            self.add_bytes(connection, len(data) - (old[0] if old else 0))
+            self.evict(connection)
+            connection.execute('commit;')
+        except sqlite3.Error as e:
+            print(f"Could not write the result cache: '{e}'")
+            if connection is not None and connection.in_transaction:
+                connection.execute('rollback;')
+            self.count('errors')
+
+    def add_bytes(self, connection, increment):
+        connection.execute("update counters set value = value + ? where name = 'bytes';", (increment,))
+
+    def evict(self, connection):
+        total = connection.execute("select value from counters where name = 'bytes';").fetchone()[0]
+        evicted = 0
+        while total > self.max_bytes:
+            rows = connection.execute('select key, size from results order by last_used asc limit 100;').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                connection.execute('delete from results where key = ?;', (key,))
+                total -= size
+                evicted += 1
+                self.add_bytes(connection, -size)
+        if evicted:
+            self.count('evictions', evicted)
+
+    def run(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    # Writes this process' counts and last uses, and deletes the entries older than their TTL.
+    def flush(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            counts, used = self.counts, self.used
+            self.counts, self.used = {}, {}
+        now = time.time()
+        connection = None
+        try:
+            connection = self.connection()
+            connection.execute('begin immediate;')
+            connection.executemany('update counters set value = value + ? where name = ?;', [(increment, name) for name, increment in counts.items()])
+            connection.executemany('update results set last_used = max(last_used, ?) where key = ?;', [(last_used, key) for key, last_used in used.items()])
+            self.expire(connection, 'created < ?', (now - self.ttl,))
+            for tab, ttl in self.tab_ttls.items():
+                self.expire(connection, 'key >= ? and key < ? and created < ?', self.key_range(tab) + (now - ttl,))
+            connection.execute('commit;')
+        except sqlite3.Error as e:
+            print(f"Could not flush the result cache: '{e}'")
+            if connection is not None and connection.in_transaction:
+                connection.execute('rollback;')
+            # Counted again at the next flush rather than lost.
+            with self.lock:
+                for name, increment in counts.items():
+                    self.counts[name] = self.counts.get(name, 0) + increment
+                for key, last_used in used.items():
+                    self.used[key] = max(self.used.get(key, 0), last_used)
+                self.counts['errors'] = self.counts.get('errors', 0) + 1
+
+    def expire(self, connection, condition, params):
+        size = connection.execute('select coalesce(sum(size), 0) from results where {};'.format(condition), params).fetchone()[0]
+        if size:
+            connection.execute('delete from results where {};'.format(condition), params)
+            self.add_bytes(connection, -size)
+
+    def close(self, timeout=5.0):
+        if self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        self.start()
+        self.flush()
+        connection = self.connection()
+        stats = dict(connection.execute('select name, value from counters;').fetchall())
+        entries = connection.execute('select count(*) from results;').fetchone()[0]
+        size = stats.pop('bytes')
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'tab_ttls': self.tab_ttls,
+            'hit_rate': stats['hits'] / lookups if lookups else None,
+        })
+        return stats
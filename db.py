@@ -0,0 +1,65 @@
+# Database helpers shared by the app, the build scripts and the benchmarks.
+
+import yaml
+import psycopg2
+
+# change this path according to your setup
+CONFIG_PATH = '/path/to/gutensearch/dbconfig.yml'
+
+def load_config(path=CONFIG_PATH):
+    with open(path, 'r') as ymlfile:
+        return yaml.load(ymlfile, Loader=yaml.SafeLoader)
+
+# SQLAlchemy wants postgresql+psycopg2://, psycopg2 only understands postgresql://
+def dsn(constring):
+    return constring.replace('postgresql+psycopg2://', 'postgresql://', 1)
+
+def connect(constring):
+    return psycopg2.connect(dsn(constring))
+
+# Escape a value for COPY ... FROM STDIN in the default text format.
+def copy_escape(value):
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+def copy_line(row):
+    return '\t'.join(copy_escape(value) for value in row) + '\n'
+
+# server-ingest.py logs every batch it writes to gutenberg.ingest_log. A changed book keeps its num,
+# so the count and max(num) of all_data don't show it: the last batch does. The scripts that build
+# from the paragraphs record the batch they were built from in gutenberg.builds, so that
+# server-ingest.py can tell which are behind.
+INGEST_SETUP = """create table if not exists gutenberg.ingest_log
+  (batch bigserial primary key
+    , ingested_at timestamptz default now()
+    , nums integer[]);
+create table if not exists gutenberg.builds
+  (name text primary key
+    , batch bigint
+    , built_at timestamptz default now());
+"""
+INGEST_LOG_EXISTS = """select to_regclass('gutenberg.ingest_log') is not null;"""
+INGEST_VERSION_QUERY = """select coalesce(max(batch), 0) from gutenberg.ingest_log;"""
+
+# The last batch ingested, 0 before any.
+def ingest_version(cursor):
+    cursor.execute(INGEST_LOG_EXISTS)
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute(INGEST_VERSION_QUERY)
+    return cursor.fetchone()[0]
+
+def record_build(cursor, name, batch):
+    cursor.execute(INGEST_SETUP)
+    cursor.execute("""insert into gutenberg.builds (name, batch) values (%s, %s)
+        on conflict (name) do update set batch = excluded.batch, built_at = now();""", (name, batch))
+
+# {name: batch} of the builds whose name starts with prefix.
+def builds(cursor, prefix):
+    cursor.execute("""select name, batch from gutenberg.builds where name like %s;""", (prefix + '%',))
+    return dict(cursor.fetchall())
@@ -0,0 +1,74 @@
+# Paragraphs stored once: gutenberg.unique_paragraphs, built from gutenberg.paragraphs by
+# server-dedup-paragraphs.py and searched instead of it with Search: dedup: true in dbconfig.yml.
+#
+# Gutenberg has many editions of the same book, and famous passages quoted in others, so the same
+# paragraph text is stored, tsvector'd and indexed many times over. Paragraphs are grouped by the md5
+# of their text with runs of whitespace collapsed (editions often differ only in line wrapping, which
+# doesn't change the tsvector), per language since the tsvector depends on it. Each group keeps the
+# text and tsvector of its paragraph in the lowest book num, and in nums the num of every paragraph
+# of the group, so a book that has it twice is there twice (see dedup_query in search.py).
+#
+# Partitioned by language like gutenberg.paragraphs (see partitions.py), without a default partition:
+# paragraphs of books in unsupported languages have no tsvector and are never searched.
+
+import partitions
+
+PARENT = """create table if not exists gutenberg.{table}
+  (paragraph_id uuid not null
+    , paragraph text
+    , paragraph_length integer
+    , textsearchable_index_col tsvector
+    , language regconfig not null
+    , nums integer[] not null)
+  partition by list (language);"""
+
+PARAGRAPH_ID = """md5(regexp_replace(btrim(coalesce(paragraph, '')), '\\s+', ' ', 'g'))::uuid"""
+
+# One sort of the partition by paragraph_id and num serves both the window and distinct on.
+DEDUP = """insert into gutenberg.{table} (paragraph_id, paragraph, paragraph_length, textsearchable_index_col, language, nums)
+select distinct on (paragraph_id) paragraph_id, paragraph, paragraph_length, textsearchable_index_col, language
+, array_agg(num) over (partition by paragraph_id order by num rows between unbounded preceding and unbounded following) as nums
+from (
+    select """ + PARAGRAPH_ID + """ as paragraph_id, num, paragraph, paragraph_length, textsearchable_index_col, language
+    from gutenberg.{source}
+) p
+order by paragraph_id, num;"""
+
+# Named {table}_... like partitions.INDEXES, so that partitions.rename renames them with the table.
+INDEXES = [
+    """create unique index if not exists {table}_paragraph_id_idx on gutenberg.{table} (language, paragraph_id);""",
+    """create index if not exists {table}_nums_idx on gutenberg.{table} using gin (nums);""",
+    """create index if not exists {table}_textsearch_idx on gutenberg.{table} using gin (textsearchable_index_col);""",
+]
+
+# Bytes of the tables (with their TOAST) and of the indexes of a table and its partitions.
+SIZES = """with tree as (""" + partitions.TREE.rstrip(';') + """)
+select
+coalesce(sum(pg_table_size(('gutenberg.' || quote_ident(relname))::regclass)) filter (where relkind = 'r'), 0)::bigint
+, coalesce(sum(pg_relation_size(('gutenberg.' || quote_ident(relname))::regclass)) filter (where relkind = 'i'), 0)::bigint
+from tree;"""
+
+# Creates the parent table and a partition per language, and returns the partition names.
+def create(cursor, table):
+    cursor.execute(PARENT.format(table=table))
+    names = []
+    for config in partitions.languages(cursor):
+        names.append(partitions.partition(table, config))
+        cursor.execute("""create table if not exists gutenberg.{} partition of gutenberg.{} for values in (%s);""".format(names[-1], table), (config,))
+    return names
+
+# Fills the partition of config in table from gutenberg.paragraphs, and returns how many paragraphs
+# it read and how many it kept.
+def fill(cursor, table, config):
+    cursor.execute(DEDUP.format(table=partitions.partition(table, config), source=partitions.partition('paragraphs', config)))
+    kept = cursor.rowcount
+    cursor.execute("""select coalesce(sum(cardinality(nums)), 0) from gutenberg.{};""".format(partitions.partition(table, config)))
+    return cursor.fetchone()[0], kept
+
+def sizes(cursor, table):
+    cursor.execute(SIZES, {'table': 'gutenberg.' + table})
+    return cursor.fetchone()
+
+def exists(cursor):
+    cursor.execute("""select to_regclass('gutenberg.unique_paragraphs') is not null;""")
+    return cursor.fetchone()[0]
@@ -0,0 +1,80 @@
+# Streams full search results for the /export route, as CSV or newline-delimited JSON.
+#
+# The query runs on a server-side (named) psycopg2 cursor through SQLAlchemy's stream_results, and
+# rows are fetched and written chunk_rows at a time, so memory per request stays the same whatever
+# the number of results. When the client goes away, the WSGI server closes the generator: the
+# running statement is cancelled and the transaction, with its cursor, rolled back.
+
+import csv
+import io
+import json
+from decimal import Decimal
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+def to_json(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+def csv_chunk(rows, header=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header is not None:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+def ndjson_chunk(rows, columns):
+    return ''.join(json.dumps({column: to_json(value) for column, value in zip(columns, row)}) + '\n' for row in rows)
+
+# Ends an export once, however it ends: from the stream when it finishes or fails, or from the
+# response's close when the body is never iterated (a HEAD request, or a client gone before the first
+# chunk), where the generator's finally never runs. stack is an ExitStack holding the connection's
+# transaction and admission slots (see Admission.admit). on_close is called with the number of rows
+# sent.
+class Finish:
+    def __init__(self, connection, stack, on_close=None):
+        self.connection = connection
+        self.stack = stack
+        self.on_close = on_close
+        self.sent = 0
+        self.done = False
+
+    def __call__(self, error=None):
+        if self.done:
+            return
+        self.done = True
+        try:
+            if error is None:
+                self.stack.close()
+            else:
+                # Client disconnected (GeneratorExit) or the query failed: stop Postgres working on
+                # it and roll back.
+                try:
+                    self.connection.connection.cancel()
+                except Exception:
+                    pass
+                self.stack.__exit__(type(error), error, error.__traceback__)
+        finally:
+            self.connection.close()
+            if self.on_close is not None:
+                self.on_close(self.sent)
+
+def stream(connection, finish, query, params, columns, format, chunk_rows=100):
+    try:
+        result = connection.execution_options(stream_results=True).execute(query, params)
+        if format == 'csv':
+            yield csv_chunk([], header=columns)
+        while True:
+            rows = result.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield csv_chunk(rows) if format == 'csv' else ndjson_chunk(rows, columns)
+            finish.sent += len(rows)
+    except BaseException as e:
+        finish(e)
+        raise
+    else:
+        finish()
@@ -0,0 +1,143 @@
+# Results of the most frequent searches, precomputed from gutenberg.query_log by
+# server-hot-searches.py so that the Search and Discovery tabs don't run ts_headline for them again.
+#
+# Searches are counted by their normalised tsquery, which is what the result cache keys on too,
+# reading only the log rows added since the last run. For the top searches of each language and tab,
+# gutenberg.hot_results keeps the rows of the page query (see search.py) for the first `books` books,
+# ranked in full (never capped), and for Discovery mode the headlines of a random pool of matching
+# books to draw from. An entry is rebuilt when the books change or once it's older than max_age, and
+# server-ingest.py drops them all when it changes books, so that they are searched live until then.
+#
+# With HotSearches: serve: true in dbconfig.yml, the default view of the Search tab and Discovery mode
+# are served from there when the page asked for was precomputed, and searched live otherwise.
+
+SCHEMA = """create table if not exists gutenberg.hot_search_counts
+  (tab text
+    , language regconfig
+    , normalized text
+    , search_terms text
+    , hits bigint
+    , primary key (tab, language, normalized));
+create table if not exists gutenberg.hot_search_log
+  (counted_until timestamptz);
+create table if not exists gutenberg.hot_searches
+  (tab text
+    , language regconfig
+    , normalized text
+    , search_terms text
+    , books integer
+    , complete boolean
+    , data_version text
+    , refreshed_at timestamptz default now()
+    , primary key (tab, language, normalized));
+create table if not exists gutenberg.hot_results
+  (tab text
+    , language regconfig
+    , normalized text
+    , position integer
+    , author text
+    , title text
+    , relevant_paragraphs text
+    , rank text
+    , num integer
+    , sort_key double precision
+    , primary key (tab, language, normalized, position));
+"""
+
+# Rows logged in the last minute may still be on their way from the workers' log writers.
+COUNT_QUERY = """insert into gutenberg.hot_search_counts (tab, language, normalized, search_terms, hits)
+select tab, language, normalized, min(query), count(*)
+from (
+    select tab, language, query, (case when tab = 'Search' then phraseto_tsquery(language, query) else plainto_tsquery(language, query) end)::text as normalized
+    from gutenberg.query_log
+    where tab in ('Search', 'Discovery') and language is not null and query is not null and time > %(since)s and time <= %(until)s
+) logged
+where normalized <> ''
+group by tab, language, normalized
+on conflict (tab, language, normalized) do update set hits = gutenberg.hot_search_counts.hits + excluded.hits;"""
+
+TOP_QUERY = """select tab, language::text, normalized, search_terms from (
+    select tab, language, normalized, search_terms, row_number() over (partition by tab, language order by hits desc, normalized) as place
+    from gutenberg.hot_search_counts
+) counts
+where place <= %(top)s;"""
+
+DATA_VERSION_QUERY = """select concat_ws('-', count(*), max(num)) from gutenberg.all_data;"""
+
+# Entries that are up to date.
+FRESH_QUERY = """select tab, language::text, normalized from gutenberg.hot_searches where data_version = %(data_version)s and refreshed_at > now() - %(max_age)s::interval;"""
+
+# ------------- Served by app.py ------------------------
+ENTRY_QUERY = """select books, complete from gutenberg.hot_searches where tab = %(tab)s and language = %(language)s::regconfig and normalized = %(normalized)s;"""
+
+# The columns of the page query, after the keyset of the last row shown or from an offset.
+PAGE_TEMPLATE = """select author, title, relevant_paragraphs, rank, num, sort_key
+from gutenberg.hot_results
+where tab = 'Search' and language = %(language)s::regconfig and normalized = %(normalized)s and {after}
+order by position
+limit %(limit)s;"""
+
+PAGE_AFTER = PAGE_TEMPLATE.format(after='(sort_key, num) < (%(after_key)s::float8, %(after_num)s::integer)')
+PAGE_OFFSET = PAGE_TEMPLATE.format(after='position > %(offset)s')
+
+# The columns of DISCOVERY_QUERY, books drawn at random from the pool.
+DISCOVERY_QUERY = """select author, title, relevant_paragraphs, rand from (
+    select author, title, relevant_paragraphs, random() as rand
+    from gutenberg.hot_results
+    where tab = 'Discovery' and language = %(language)s::regconfig and normalized = %(normalized)s
+) pool
+order by rand desc
+limit %(books)s;"""
+
+def entry_params(tab, language, normalized):
+    return {'tab': tab, 'language': language, 'normalized': normalized}
+
+# Query and parameters for a page of the default view, keyset after or offset like page_query.
+def page_query(language, normalized, limit, after=None, offset=0):
+    params = dict(entry_params('Search', language, normalized), limit=limit, offset=offset)
+    if after is None:
+        return PAGE_OFFSET, params
+    params['after_key'], params['after_num'] = after
+    return PAGE_AFTER, params
+
+# A page can be served if it's full, or if the entry holds every matching book.
+def servable(entry, rows, limit):
+    return entry is not None and (len(rows) == limit or entry[1])
+
+# ------------- Built by server-hot-searches.py ---------
+def count(cursor):
+    cursor.execute("""select coalesce(max(counted_until), '-infinity'::timestamptz), now() - interval '1 minute' from gutenberg.hot_search_log;""")
+    since, until = cursor.fetchone()
+    cursor.execute(COUNT_QUERY, {'since': since, 'until': until})
+    counted = cursor.rowcount
+    cursor.execute("""delete from gutenberg.hot_search_log;""")
+    cursor.execute("""insert into gutenberg.hot_search_log (counted_until) values (%s);""", (until,))
+    return counted
+
+# Replaces the entry's rows. rows are those of the page query (or DISCOVERY_QUERY), in order.
+def store(cursor, tab, language, normalized, search_terms, rows, books, data_version):
+    params = entry_params(tab, language, normalized)
+    cursor.execute("""delete from gutenberg.hot_results where tab = %(tab)s and language = %(language)s::regconfig and normalized = %(normalized)s;""", params)
+    for position, row in enumerate(rows, 1):
+        if tab == 'Search':
+            author, title, relevant_paragraphs, rank, num, sort_key = row
+        else:
+            author, title, relevant_paragraphs = row[:3]
+            rank = num = sort_key = None
+        cursor.execute("""insert into gutenberg.hot_results (tab, language, normalized, position, author, title, relevant_paragraphs, rank, num, sort_key)
+            values (%(tab)s, %(language)s::regconfig, %(normalized)s, %(position)s, %(author)s, %(title)s, %(relevant_paragraphs)s, %(rank)s, %(num)s, %(sort_key)s);""",
+            dict(params, position=position, author=author, title=title, relevant_paragraphs=relevant_paragraphs, rank=rank, num=num, sort_key=sort_key))
+    cursor.execute("""insert into gutenberg.hot_searches (tab, language, normalized, search_terms, books, complete, data_version, refreshed_at)
+        values (%(tab)s, %(language)s::regconfig, %(normalized)s, %(search_terms)s, %(books)s, %(complete)s, %(data_version)s, now())
+        on conflict (tab, language, normalized) do update set search_terms = excluded.search_terms, books = excluded.books, complete = excluded.complete, data_version = excluded.data_version, refreshed_at = excluded.refreshed_at;""",
+        dict(params, search_terms=search_terms, books=len(rows), complete=len(rows) < books, data_version=data_version))
+
+# Drops the entries that are no longer among the top searches, and returns how many.
+def prune(cursor, keep):
+    cursor.execute("""select tab, language::text, normalized from gutenberg.hot_searches;""")
+    dropped = [entry for entry in cursor.fetchall() if entry not in keep]
+    for tab, language, normalized in dropped:
+        params = entry_params(tab, language, normalized)
+        cursor.execute("""delete from gutenberg.hot_results where tab = %(tab)s and language = %(language)s::regconfig and normalized = %(normalized)s;""", params)
+        cursor.execute("""delete from gutenberg.hot_searches where tab = %(tab)s and language = %(language)s::regconfig and normalized = %(normalized)s;""", params)
+    return len(dropped)
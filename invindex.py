@@ -0,0 +1,357 @@
+# Positional inverted index over gutenberg.paragraphs, an alternative to Postgres full text search
+# for ranking Search tab results (Search: backend: index in dbconfig.yml). Postgres still provides
+# the query lexemes, the book metadata and the headlines.
+#
+# One directory per text search configuration (english/, french/, ...) holds memory-mapped files:
+#   lexemes.bin, lexemes.idx    the sorted lexemes, and their offsets as uint64
+#   postings.bin, postings.idx  one posting list per lexeme, and their offsets as uint64
+#   docs.bin                    the book num of every paragraph, as int32, by paragraph id
+#   meta.json                   counts and build time
+# A posting list is varint-encoded: the number of paragraphs and the header length, then the
+# header (paragraph id deltas, position counts, and byte offsets of the positions of every
+# BLOCK-th paragraph), then the delta-encoded positions. The block offsets let a search decode the
+# positions of the candidate paragraphs only, which matters for very common lexemes.
+#
+# The index is built from the tsvectors themselves, in one streaming pass over a partition, so its
+# lexemes and positions are exactly the ones Postgres matches against. Phrases match as with
+# phraseto_tsquery, and paragraphs are scored like ts_rank_cd(..., 32): every occurrence of the
+# phrase is a cover worth 0.1 / (1 + noise), where noise is the number of positions in it that are
+# not query lexemes. Books are ranked by the average over their matching paragraphs.
+
+import heapq
+import itertools
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+BLOCK = 128
+
+# Paragraph ids and positions share one int64 key: tsvector positions are at most 16383.
+POSITION_BITS = 16
+
+TSVECTOR_ENTRY = re.compile(r"'((?:[^']|'')*)'(?::([0-9A-D,]+))?")
+
+PARAGRAPHS_QUERY = """select num, textsearchable_index_col::text from gutenberg.paragraphs where language = %s::regconfig and textsearchable_index_col is not null order by num;"""
+
+# The lexemes of the search terms with their positions, which is what phraseto_tsquery builds its
+# phrase from.
+QUERY_TERMS = """select to_tsvector(%(language)s::regconfig, %(search_terms)s)::text;"""
+
+# "'bellow':5 'mend':7" -> [('bellow', [5]), ('mend', [7])]
+def parse_tsvector(text):
+    entries = []
+    for lexeme, positions in TSVECTOR_ENTRY.findall(text or ''):
+        lexeme = lexeme.replace("''", "'").replace('\\\\', '\\')
+        entries.append((lexeme, [int(position.rstrip('ABCD')) for position in positions.split(',')] if positions else []))
+    return entries
+
+# The phrase as (offset, [lexemes]) groups: lexemes at the same position are alternatives.
+def query_terms(tsvector_text):
+    by_position = {}
+    for lexeme, positions in parse_tsvector(tsvector_text):
+        for position in positions:
+            by_position.setdefault(position, []).append(lexeme)
+    if not by_position:
+        return []
+    first = min(by_position)
+    return [(position - first, sorted(lexemes)) for position, lexemes in sorted(by_position.items())]
+
+def varint_lengths(values):
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest = rest >> np.uint64(7)
+    return lengths
+
+def encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return np.zeros(0, dtype=np.uint8)
+    lengths = varint_lengths(values)
+    out = np.zeros(int(lengths.sum()), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    rest = values.copy()
+    for i in range(int(lengths.max())):
+        mask = lengths > i
+        more = (lengths[mask] > i + 1).astype(np.uint8) << np.uint8(7)
+        out[starts[mask] + i] = (rest[mask] & np.uint64(0x7f)).astype(np.uint8) | more
+        rest[mask] >>= np.uint64(7)
+    return out
+
+def decode_varints(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 128)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = (np.arange(len(data)) - np.repeat(starts, ends - starts + 1)) * 7
+    values = (data & np.uint8(0x7f)).astype(np.int64) << shifts
+    return np.add.reduceat(values, starts)
+
+def read_varint(data, start):
+    value = shift = 0
+    while True:
+        byte = int(data[start])
+        value |= (byte & 0x7f) << shift
+        start += 1
+        if byte < 128:
+            return value, start
+        shift += 7
+
+# ids, counts and positions (concatenated per paragraph, ascending) -> posting list bytes.
+def encode_posting(ids, counts, positions):
+    ids, counts, positions = (np.asarray(a, dtype=np.int64) for a in (ids, counts, positions))
+    starts = np.cumsum(counts) - counts
+    deltas = np.diff(positions, prepend=0)
+    deltas[starts] = positions[starts]
+    deltas = deltas.astype(np.uint64)
+    paragraph_bytes = np.add.reduceat(varint_lengths(deltas), starts)
+    block_offsets = (np.cumsum(paragraph_bytes) - paragraph_bytes)[::BLOCK]
+    header = encode_varints(np.concatenate([np.diff(ids, prepend=0), counts, np.diff(block_offsets, prepend=0)]))
+    return np.concatenate([encode_varints([len(ids), len(header)]), header, encode_varints(deltas)])
+
+class Posting:
+    def __init__(self, data):
+        n, start = read_varint(data, 0)
+        header_length, start = read_varint(data, start)
+        header = decode_varints(data[start:start + header_length])
+        self.ids = np.cumsum(header[:n])
+        self.counts = header[n:2 * n]
+        self.block_offsets = np.cumsum(header[2 * n:])
+        self.area = data[start + header_length:]
+
+    # Keys (paragraph id << POSITION_BITS | position) of the given paragraphs, a subset of ids.
+    def keys(self, ids):
+        index = np.searchsorted(self.ids, ids)
+        blocks = np.unique(index // BLOCK)
+        stops = np.append(self.block_offsets, len(self.area))[blocks + 1]
+        values = decode_varints(np.concatenate([self.area[self.block_offsets[b]:stop] for b, stop in zip(blocks, stops)]))
+        paragraphs = np.concatenate([np.arange(b * BLOCK, min((b + 1) * BLOCK, len(self.ids))) for b in blocks])
+        counts = self.counts[paragraphs]
+        starts = np.cumsum(counts) - counts
+        total = np.cumsum(values)
+        positions = total - np.repeat(total[starts] - values[starts], counts)
+        owners = np.repeat(paragraphs, counts)
+        keep = np.isin(owners, index)
+        return (self.ids[owners[keep]] << POSITION_BITS) | positions[keep]
+
+def memmap(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+class LanguageIndex:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.lexemes = memmap(os.path.join(directory, 'lexemes.bin'), np.uint8)
+        self.lexeme_offsets = memmap(os.path.join(directory, 'lexemes.idx'), np.uint64)
+        self.postings = memmap(os.path.join(directory, 'postings.bin'), np.uint8)
+        self.posting_offsets = memmap(os.path.join(directory, 'postings.idx'), np.uint64)
+        self.nums = memmap(os.path.join(directory, 'docs.bin'), np.int32)
+
+    def lexeme(self, i):
+        return self.lexemes[int(self.lexeme_offsets[i]):int(self.lexeme_offsets[i + 1])].tobytes()
+
+    def find(self, lexeme):
+        key = lexeme.encode('utf-8')
+        lo, hi = 0, len(self.lexeme_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.lexeme(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self.lexeme_offsets) - 1 and self.lexeme(lo) == key else None
+
+    def posting(self, lexeme):
+        i = self.find(lexeme)
+        if i is None:
+            return None
+        return Posting(self.postings[int(self.posting_offsets[i]):int(self.posting_offsets[i + 1])])
+
+    # Upper bound of the paragraphs the phrase matches, from the headers only: the rarest position.
+    def estimate(self, terms):
+        bound = None
+        for _, lexemes in terms:
+            total = 0
+            for lexeme in lexemes:
+                i = self.find(lexeme)
+                if i is not None:
+                    total += read_varint(self.postings, int(self.posting_offsets[i]))[0]
+            bound = total if bound is None else min(bound, total)
+        return bound or 0
+
+    # Returns the nums and ranks of the matching books, best first (ties by num, descending, like
+    # the paged results table).
+    def search(self, terms):
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0)
+        if not terms:
+            return empty
+        groups = []
+        for offset, lexemes in terms:
+            postings = [posting for posting in (self.posting(lexeme) for lexeme in lexemes) if posting is not None]
+            if not postings:
+                return empty
+            groups.append((offset, postings))
+        # Paragraphs containing every position of the phrase, rarest first.
+        groups.sort(key=lambda group: sum(len(posting.ids) for posting in group[1]))
+        candidates = None
+        for _, postings in groups:
+            ids = np.unique(np.concatenate([posting.ids for posting in postings]))
+            candidates = ids if candidates is None else np.intersect1d(candidates, ids, assume_unique=True)
+            if not len(candidates):
+                return empty
+        keys = []
+        starts = None
+        for offset, postings in groups:
+            group_keys = np.unique(np.concatenate([posting.keys(candidates[np.isin(candidates, posting.ids)]) for posting in postings]))
+            keys.append(group_keys)
+            shifted = group_keys - offset
+            starts = shifted if starts is None else np.intersect1d(starts, shifted, assume_unique=True)
+        if not len(starts):
+            return empty
+        # Cover density, as ts_rank_cd: each occurrence covers span + 1 positions, of which
+        # `distinct` hold query lexemes.
+        span = max(offset for offset, _ in terms)
+        query_keys = np.unique(np.concatenate(keys))
+        distinct = np.searchsorted(query_keys, starts + span, 'right') - np.searchsorted(query_keys, starts, 'left')
+        noise = span - (distinct - 1)
+        noise = np.where(noise < 0, (distinct - 1) // 2, noise)
+        paragraphs, owner = np.unique(starts >> POSITION_BITS, return_inverse=True)
+        weight = np.bincount(owner, weights=0.1 / (1 + noise))
+        # ts_rank_cd returns a real, which avg() then sums as a double.
+        ranks = (weight / (weight + 1)).astype(np.float32).astype(np.float64)
+        books, book = np.unique(np.asarray(self.nums[paragraphs], dtype=np.int64), return_inverse=True)
+        book_ranks = np.bincount(book, weights=ranks) / np.bincount(book)
+        order = np.lexsort((-books, -book_ranks))
+        return books[order], book_ranks[order]
+
+# All the languages under one path, opened on first use (so after gunicorn forks its workers,
+# which then share the mapped pages through the page cache).
+class Index:
+    def __init__(self, path):
+        self.path = path
+        self.languages = {}
+
+    def language(self, language):
+        config = language.lower()
+        if config not in self.languages:
+            directory = os.path.join(self.path, config)
+            self.languages[config] = LanguageIndex(directory) if os.path.exists(os.path.join(directory, 'meta.json')) else None
+        return self.languages[config]
+
+# ------------- Build -------------------------------------
+
+def write_record(f, lexeme, payload):
+    f.write(struct.pack('<I', len(lexeme)))
+    f.write(lexeme)
+    f.write(struct.pack('<I', len(payload)))
+    f.write(payload)
+
+def read_records(path):
+    with open(path, 'rb') as f:
+        while True:
+            size = f.read(4)
+            if not size:
+                return
+            lexeme = f.read(struct.unpack('<I', size)[0])
+            payload = f.read(struct.unpack('<I', f.read(4))[0])
+            yield lexeme, payload
+
+# Runs in the workers: parse one chunk of tsvectors and write its postings, sorted by lexeme, to a
+# run file as raw arrays (paragraph ids, counts, positions).
+def write_run(task):
+    path, first_id, tsvectors = task
+    postings = {}
+    for i, text in enumerate(tsvectors):
+        for lexeme, positions in parse_tsvector(text):
+            if positions:
+                postings.setdefault(lexeme.encode('utf-8'), []).append((first_id + i, positions))
+    with open(path, 'wb') as f:
+        for lexeme in sorted(postings):
+            entries = postings[lexeme]
+            ids = np.array([entry[0] for entry in entries], dtype=np.int32)
+            counts = np.array([len(entry[1]) for entry in entries], dtype=np.int32)
+            positions = np.array([position for entry in entries for position in entry[1]], dtype=np.uint16)
+            write_record(f, lexeme, struct.pack('<I', len(ids)) + ids.tobytes() + counts.tobytes() + positions.tobytes())
+    return path, len(tsvectors)
+
+def read_run_payload(payload):
+    n = struct.unpack('<I', payload[:4])[0]
+    ids = np.frombuffer(payload, dtype=np.int32, count=n, offset=4)
+    counts = np.frombuffer(payload, dtype=np.int32, count=n, offset=4 + 4 * n)
+    positions = np.frombuffer(payload, dtype=np.uint16, offset=4 + 8 * n)
+    return ids, counts, positions
+
+def chunks(cursor, temp, chunk_paragraphs, docs):
+    first_id = 0
+    for run in itertools.count():
+        rows = cursor.fetchmany(chunk_paragraphs)
+        if not rows:
+            return
+        np.array([row[0] for row in rows], dtype=np.int32).tofile(docs)
+        yield os.path.join(temp, 'run-{:06d}'.format(run)), first_id, [row[1] for row in rows]
+        first_id += len(rows)
+
+# Builds the index of one language from its partition and replaces the previous one.
+def build(connection, path, language, workers=4, chunk_paragraphs=50000, log=print):
+    config = language.lower()
+    begin = time.perf_counter()
+    os.makedirs(path, exist_ok=True)
+    directory = os.path.join(path, config)
+    temp = tempfile.mkdtemp(prefix=config + '.', dir=path)
+    paragraphs = 0
+    with open(os.path.join(temp, 'docs.bin'), 'wb') as docs, connection.cursor(name='invindex_' + config) as cursor, Pool(workers) as pool:
+        cursor.itersize = chunk_paragraphs
+        cursor.execute(PARAGRAPHS_QUERY, (config,))
+        runs = []
+        for run, count in pool.imap(write_run, chunks(cursor, temp, chunk_paragraphs, docs)):
+            runs.append(run)
+            paragraphs += count
+            if len(runs) % 20 == 0:
+                log('{}: {} paragraphs read ({:.1f} s)'.format(config, paragraphs, time.perf_counter() - begin))
+    connection.rollback()
+
+    lexeme_offsets, posting_offsets = [0], [0]
+    with open(os.path.join(temp, 'lexemes.bin'), 'wb') as lexemes, open(os.path.join(temp, 'postings.bin'), 'wb') as postings:
+        # Runs are in paragraph order, and merge keeps that order for equal lexemes.
+        merged = heapq.merge(*[read_records(run) for run in runs], key=lambda record: record[0])
+        for lexeme, records in itertools.groupby(merged, key=lambda record: record[0]):
+            parts = [read_run_payload(payload) for _, payload in records]
+            posting = encode_posting(np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]), np.concatenate([p[2] for p in parts]))
+            lexemes.write(lexeme)
+            postings.write(posting.tobytes())
+            lexeme_offsets.append(lexemes.tell())
+            posting_offsets.append(postings.tell())
+    for run in runs:
+        os.remove(run)
+    np.array(lexeme_offsets, dtype=np.uint64).tofile(os.path.join(temp, 'lexemes.idx'))
+    np.array(posting_offsets, dtype=np.uint64).tofile(os.path.join(temp, 'postings.idx'))
+    meta = {
+        'language': config,
+        'paragraphs': paragraphs,
+        'lexemes': len(lexeme_offsets) - 1,
+        'postings_bytes': posting_offsets[-1],
+        'seconds': time.perf_counter() - begin,
+        'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(os.path.join(temp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    # Workers that already mapped the old files keep reading them until they restart.
+    old = directory + '.old'
+    if os.path.exists(directory):
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(directory, old)
+    os.rename(temp, directory)
+    shutil.rmtree(old, ignore_errors=True)
+    log('{}: {} paragraphs, {} lexemes, {:.1f} MB of postings in {:.1f} s'.format(config, paragraphs, meta['lexemes'], meta['postings_bytes'] / 1e6, meta['seconds']))
+    return meta
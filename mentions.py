@@ -0,0 +1,73 @@
+# Finds which authors are mentioned in which books, for gutenberg.mentioned_authors.
+#
+# All author names are compiled into one Aho-Corasick automaton over words, so each paragraph is
+# read once whatever the number of authors. Words are lowercased runs of letters and digits, much
+# like the 'simple' text search configuration the SQL version matched with.
+
+import re
+from collections import deque
+
+WORD = re.compile(r'\w+')
+
+# Names that are too generic to count as a mention even though they have two words.
+BLOCKLIST = {'British Museum'}
+
+def tokens(text):
+    return WORD.findall(text.lower())
+
+# Single words ("Various", "Baker", "Wu") and initials only ("R. H.", "F.R.G.S.") match all over
+# the place. A name needs at least two words, one of them longer than an initial.
+def is_searchable(author):
+    words = tokens(author)
+    return author not in BLOCKLIST and len(words) >= 2 and any(len(word) > 1 for word in words)
+
+class Automaton:
+    def __init__(self, names):
+        self.names = list(names)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for i, name in enumerate(self.names):
+            node = 0
+            for word in tokens(name):
+                child = self.goto[node].get(word)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                    self.goto[node][word] = child
+                node = child
+            self.out[node] = self.out[node] + (i,)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and word not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(word, 0)
+                self.fail[child] = fail if fail != child else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    # Returns the indexes of the names found in the given words.
+    def search(self, words):
+        found = set()
+        node = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for word in words:
+            while node and word not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(word, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+    # Paragraphs are searched one by one, like the tsvectors of gutenberg.paragraphs, so that a
+    # name is never matched across two paragraphs.
+    def search_book(self, content):
+        found = set()
+        for paragraph in content.split('.\n'):
+            found |= self.search(tokens(paragraph))
+        return found
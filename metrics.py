@@ -0,0 +1,270 @@
+# Latency histograms for the Dash callbacks, shared by all gunicorn workers through a local SQLite
+# file like the result cache, and served on /metrics in the Prometheus text format.
+#
+# A callback decorated with Metrics.callback is timed as a whole and by stage: code inside
+# `with metrics.stage('sql'):` is recorded under that stage of the running callback (and not at all
+# outside one, e.g. in the prefetch thread). Once Flask has the response, the rest of the request,
+# which is Dash decoding the inputs and serializing the outputs, is recorded as the 'dash' stage,
+# along with the size of the payload.
+#
+# Observations are added up in memory, per process, and written in one transaction every
+# flush_seconds by a background thread (and when the worker exits), so requests never wait on
+# SQLite's write lock. A flush that fails keeps its counts for the next one and is counted in
+# gutensearch_metrics_flush_errors_total rather than raised: metrics must never fail a request.
+#
+# With profile_slower_than_ms set, a sampling profiler follows every callback and, when one is
+# slower than that, writes its stacks in the folded format of flamegraph.pl (or speedscope) to
+# profile_path.
+
+import atexit
+import collections
+import functools
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import flask
+
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+BYTES_BUCKETS = [1e3, 1e4, 1e5, 1e6, 1e7]
+
+METRICS = {
+    'seconds': ('gutensearch_callback_seconds', 'Time spent in each stage of the Dash callbacks.', SECONDS_BUCKETS),
+    'bytes': ('gutensearch_callback_payload_bytes', 'Size of the Dash callback responses.', BYTES_BUCKETS),
+}
+
+SCHEMA = """create table if not exists buckets
+  (metric text not null
+    , callback text not null
+    , stage text not null
+    , le text not null
+    , count integer not null
+    , primary key (metric, callback, stage, le));
+create table if not exists totals
+  (metric text not null
+    , callback text not null
+    , stage text not null
+    , sum real not null
+    , count integer not null
+    , primary key (metric, callback, stage));
+create table if not exists counters
+  (name text primary key
+    , value integer not null);
+insert or ignore into counters (name, value) values ('flush_errors', 0);
+"""
+
+def bucket(metric, value):
+    for le in METRICS[metric][2]:
+        if value <= le:
+            return repr(le)
+    return '+Inf'
+
+class Observations:
+    def __init__(self, callback):
+        self.callback = callback
+        self.values = []
+        self.seconds = 0.0
+
+    def observe(self, metric, stage, value):
+        self.values.append((metric, stage, value))
+
+# Samples the stack of one thread every interval seconds until stopped.
+class Sampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.done = threading.Event()
+        self.start()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return self.stacks
+
+class Metrics:
+    def __init__(self, path, flush_seconds=5.0, profile_slower_than_ms=0, profile_path=None, profile_interval_ms=5):
+        self.path = path
+        self.flush_interval = flush_seconds
+        self.profile_slower_than_ms = profile_slower_than_ms
+        self.profile_path = profile_path
+        self.profile_interval = profile_interval_ms / 1000
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    # Threads don't survive gunicorn's fork, so each worker starts its own flusher on first use.
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # What this process hasn't written yet: bucket counts, and the sum and count of totals.
+            self.buckets = collections.Counter()
+            self.totals = collections.defaultdict(lambda: [0.0, 0])
+            self.flush_errors = 0
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self.run, name='metrics-flusher', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    # One connection per process and thread: SQLite connections must not cross a fork.
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('pragma journal_mode=wal;')
+            connection.execute('pragma synchronous=normal;')
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def stage(self, stage):
+        observations = getattr(self.local, 'observations', None)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if observations is not None:
+                observations.observe('seconds', stage, time.perf_counter() - start)
+
+    def callback(self, name):
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                observations = self.local.observations = Observations(name)
+                sampler = Sampler(threading.get_ident(), self.profile_interval) if self.profile_slower_than_ms else None
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    observations.seconds = time.perf_counter() - start
+                    observations.observe('seconds', 'callback', observations.seconds)
+                    self.local.observations = None
+                    if sampler is not None:
+                        stacks = sampler.stop()
+                        if 1000 * observations.seconds >= self.profile_slower_than_ms:
+                            self.dump(name, observations.seconds, stacks)
+                    if flask.has_request_context():
+                        flask.g.metrics = observations
+                    else:
+                        self.write(observations)
+            return wrapper
+        return decorate
+
+    # Adds what happens around the callbacks: Dash's own work and the payload size.
+    def install(self, server):
+        @server.before_request
+        def start_request():
+            flask.g.metrics_start = time.perf_counter()
+
+        @server.after_request
+        def finish_request(response):
+            observations = flask.g.pop('metrics', None)
+            if observations is not None:
+                total = time.perf_counter() - flask.g.metrics_start
+                observations.observe('seconds', 'dash', max(total - observations.seconds, 0.0))
+                observations.observe('seconds', 'request', total)
+                observations.observe('bytes', 'payload', response.calculate_content_length() or 0)
+                self.write(observations)
+            return response
+
+    def write(self, observations):
+        self.start()
+        with self.lock:
+            for metric, stage, value in observations.values:
+                self.buckets[metric, observations.callback, stage, bucket(metric, value)] += 1
+                total = self.totals[metric, observations.callback, stage]
+                total[0] += value
+                total[1] += 1
+
+    def run(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            buckets, totals, flush_errors = self.buckets, self.totals, self.flush_errors
+            if not (buckets or totals or flush_errors):
+                return
+            self.buckets, self.totals, self.flush_errors = collections.Counter(), collections.defaultdict(lambda: [0.0, 0]), 0
+        connection = None
+        try:
+            connection = self.connection()
+            connection.execute('begin immediate;')
+            connection.executemany("""insert into buckets (metric, callback, stage, le, count) values (?, ?, ?, ?, ?)
+                on conflict (metric, callback, stage, le) do update set count = count + excluded.count;""", [key + (count,) for key, count in buckets.items()])
+            connection.executemany("""insert into totals (metric, callback, stage, sum, count) values (?, ?, ?, ?, ?)
+                on conflict (metric, callback, stage) do update set sum = sum + excluded.sum, count = count + excluded.count;""", [key + tuple(total) for key, total in totals.items()])
+            connection.execute("update counters set value = value + ? where name = 'flush_errors';", (flush_errors,))
+            connection.execute('commit;')
+        except Exception as e:
+            print(f"Could not write the metrics: '{e}'")
+            if connection is not None and connection.in_transaction:
+                connection.execute('rollback;')
+            # Written at the next flush rather than lost: there are only so many keys to keep.
+            with self.lock:
+                self.buckets.update(buckets)
+                for key, (total, count) in totals.items():
+                    self.totals[key][0] += total
+                    self.totals[key][1] += count
+                self.flush_errors += flush_errors + 1
+
+    def close(self, timeout=5.0):
+        if self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.flush()
+
+    def dump(self, name, seconds, stacks):
+        os.makedirs(self.profile_path, exist_ok=True)
+        now = time.time()
+        path = os.path.join(self.profile_path, '{}.{:03d}-{}-{}-{:.0f}ms.folded'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(1000 * now) % 1000, os.getpid(), name, 1000 * seconds))
+        with open(path, 'w') as f:
+            for stack, count in stacks.items():
+                f.write('{} {}\n'.format(stack, count))
+
+    # The Prometheus text exposition format.
+    def render(self):
+        connection = self.connection()
+        counts = collections.defaultdict(dict)
+        for metric, callback, stage, le, count in connection.execute('select metric, callback, stage, le, count from buckets;'):
+            counts[metric, callback, stage][le] = count
+        totals = {(metric, callback, stage): (total, count) for metric, callback, stage, total, count in connection.execute('select metric, callback, stage, sum, count from totals;')}
+        flush_errors = connection.execute("select value from counters where name = 'flush_errors';").fetchone()[0]
+        lines = []
+        for metric, (name, help, buckets) in METRICS.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} histogram'.format(name))
+            for (_, callback, stage), (total, count) in sorted(item for item in totals.items() if item[0][0] == metric):
+                labels = 'callback="{}",stage="{}"'.format(callback, stage)
+                cumulative = 0
+                for le in [repr(le) for le in buckets] + ['+Inf']:
+                    cumulative += counts[metric, callback, stage].get(le, 0)
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, le, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(name, labels, total))
+                lines.append('{}_count{{{}}} {}'.format(name, labels, count))
+        lines.append('# HELP gutensearch_metrics_flush_errors_total Failed writes of the metrics, retried at the next flush.')
+        lines.append('# TYPE gutensearch_metrics_flush_errors_total counter')
+        lines.append('gutensearch_metrics_flush_errors_total {}'.format(flush_errors))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,113 @@
+# Reading books from a local Project Gutenberg rsync mirror, for server-ingest.py.
+#
+# The mirror keeps each book in a directory named after its number, under one directory per
+# leading digit: 12345 is in 1/2/3/4/12345/, 7 in 0/7/. The text comes as 12345-0.txt (UTF-8),
+# 12345.txt (ASCII) or 12345-8.txt (Latin-1), and the metadata as an RDF file,
+# cache/epub/12345/pg12345.rdf, from the RDF feed (rsync gutenberg.pglaf.org::gutenberg-epub).
+#
+# Books are read into the same shape as the Gutenberg Dammit corpus the tables were first built
+# from: metadata_columns rows, and text with the Project Gutenberg header and licence removed.
+
+import hashlib
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+# Preferred first.
+TEXT_FILES = [('{}-0.txt', 'utf-8'), ('{}.txt', 'us-ascii'), ('{}-8.txt', 'iso-8859-1')]
+
+NAMESPACES = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'dcam': 'http://purl.org/dc/dcam/',
+    'pgterms': 'http://www.gutenberg.org/2009/pgterms/',
+}
+
+# RDF language codes, as the language names the metadata uses elsewhere (and pg_ts_config matches).
+LANGUAGES = {
+    'ar': 'Arabic', 'ca': 'Catalan', 'cs': 'Czech', 'da': 'Danish', 'de': 'German', 'el': 'Greek',
+    'en': 'English', 'eo': 'Esperanto', 'es': 'Spanish', 'fi': 'Finnish', 'fr': 'French', 'ga': 'Irish',
+    'hu': 'Hungarian', 'id': 'Indonesian', 'it': 'Italian', 'la': 'Latin', 'lt': 'Lithuanian', 'nl': 'Dutch',
+    'no': 'Norwegian', 'pl': 'Polish', 'pt': 'Portuguese', 'ro': 'Romanian', 'ru': 'Russian', 'sv': 'Swedish',
+    'ta': 'Tamil', 'tr': 'Turkish', 'zh': 'Chinese',
+}
+
+START = re.compile(r'^\*\*\*\s*START OF (THE|THIS) PROJECT GUTENBERG EBOOK.*$', re.IGNORECASE | re.MULTILINE)
+END = re.compile(r'^\*\*\*\s*END OF (THE|THIS) PROJECT GUTENBERG EBOOK.*$', re.IGNORECASE | re.MULTILINE)
+
+def book_dir(num):
+    digits = str(num)
+    parents = list(digits[:-1]) if len(digits) > 1 else ['0']
+    return os.path.join(*parents, digits)
+
+# Relative to the cache/epub directory.
+def rdf_path(num):
+    return os.path.join(str(num), 'pg{}.rdf'.format(num))
+
+# Yields (num, path relative to the mirror, charset) for every book with a text file.
+def books(root):
+    for directory, subdirectories, files in os.walk(root):
+        # Only the digit directories lead to books: cache/, 12345-h/, old/ and the like are skipped.
+        subdirectories[:] = sorted(d for d in subdirectories if d.isdigit())
+        name = os.path.basename(directory)
+        if not name.isdigit() or os.path.relpath(directory, root) != book_dir(int(name)):
+            continue
+        for pattern, charset in TEXT_FILES:
+            if pattern.format(name) in files:
+                yield int(name), os.path.relpath(os.path.join(directory, pattern.format(name)), root), charset
+                break
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+def strip_headers(text):
+    start = START.search(text)
+    if start:
+        text = text[start.end():]
+    end = END.search(text)
+    if end:
+        text = text[:end.start()]
+    return text.strip()
+
+def decode_text(raw, charset):
+    # Postgres text cannot hold NUL characters.
+    return strip_headers(raw.decode(charset, errors='replace').replace('\r\n', '\n').replace('\x00', ''))
+
+def first(element, path):
+    found = element.find(path, NAMESPACES)
+    return found.text.strip() if found is not None and found.text else None
+
+def subjects(ebook, scheme):
+    for description in ebook.findall('dcterms:subject/rdf:Description', NAMESPACES):
+        member = description.find('dcam:memberOf', NAMESPACES)
+        if member is not None and member.get('{%s}resource' % NAMESPACES['rdf'], '').endswith('/' + scheme):
+            yield first(description, 'rdf:value')
+
+# "Scott, Walter, Sir" -> ("Walter Scott", "Walter", "Scott")
+def author_name(name):
+    parts = [part.strip() for part in name.split(',')]
+    if len(parts) < 2 or not parts[1]:
+        return name, None, parts[0]
+    return '{} {}'.format(parts[1], parts[0]), parts[1], parts[0]
+
+# Returns a dict of the metadata_columns fields, without num, gd_path and charset.
+def read_metadata(raw):
+    ebook = ElementTree.fromstring(raw).find('pgterms:ebook', NAMESPACES)
+    agent = ebook.find('dcterms:creator/pgterms:agent', NAMESPACES)
+    author = author_given = author_surname = birth = death = None
+    if agent is not None and first(agent, 'pgterms:name'):
+        author, author_given, author_surname = author_name(first(agent, 'pgterms:name'))
+        birth, death = first(agent, 'pgterms:birthdate'), first(agent, 'pgterms:deathdate')
+    language = first(ebook, 'dcterms:language/rdf:Description/rdf:value')
+    return {
+        'author': author,
+        'author_birth': birth,
+        'author_death': death,
+        'author_given': author_given,
+        'author_surname': author_surname,
+        'copyright_status': first(ebook, 'dcterms:rights'),
+        'language': LANGUAGES.get(language, language),
+        'loc_class': next(subjects(ebook, 'LCC'), None),
+        'subject': next(subjects(ebook, 'LCSH'), None),
+        'title': first(ebook, 'dcterms:title'),
+    }
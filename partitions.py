@@ -0,0 +1,121 @@
+# Layout of gutenberg.paragraphs: list-partitioned by language, one partition per text search
+# configuration in use (gutenberg.paragraphs_english, ...) and a default partition for books in
+# unsupported languages, whose language is null.
+#
+# Every search filters on language, so Postgres only scans the partition, and the GIN index, of that
+# language. Partitions can also be rebuilt, vacuumed or analyzed one language at a time. Used by
+# server-build-paragraphs.py, server-ingest.py, synthetic.py and server-check-pruning.py.
+
+import json
+
+PARENT = """create table if not exists gutenberg.{table}
+  (num integer
+    , paragraph text
+    , paragraph_length integer
+    , textsearchable_index_col tsvector
+    , language regconfig)
+  partition by list (language);"""
+
+# Same columns, as a plain table that becomes a partition once it's built.
+STANDALONE = """create table if not exists gutenberg.{table}
+  (num integer
+    , paragraph text
+    , paragraph_length integer
+    , textsearchable_index_col tsvector
+    , language regconfig);"""
+
+# The longest paragraph that made it into the original build. Paragraphs still longer after splitting
+# on E'.\n' are split again on single newlines, and whatever is still too long after that (blocks of
+# digits like books 127, 744, 812 or 2583) is dropped.
+MAX_PARAGRAPH_LENGTH = 721212
+
+# Splits the books of all_data matching {where} into paragraphs, with their regconfig and tsvector.
+SPLIT = """insert into gutenberg.{table} (num, paragraph, paragraph_length, textsearchable_index_col, language)
+with books as (
+    select a.num, a.content, b.cfgname::regconfig as language
+    from gutenberg.all_data a
+    left join pg_ts_config b on lower(a.language) = b.cfgname
+    where {where}
+)
+, split as (
+    select num, language, unnest(string_to_array(content, E'.\\n')) as paragraph from books
+)
+, resplit as (
+    select num, language, paragraph from split where length(paragraph) <= %(max_length)s
+    union all
+    select num, language, unnest(string_to_array(paragraph, E'\\n')) as paragraph from split where length(paragraph) > %(max_length)s
+)
+select
+num
+, paragraph
+, length(paragraph) as paragraph_length
+, case when language is not null then to_tsvector(language, coalesce(paragraph, ' ')) end as textsearchable_index_col
+, language
+from resplit
+where length(paragraph) <= %(max_length)s;
+"""
+
+LANGUAGES = """select distinct b.cfgname::text from gutenberg.all_data a inner join pg_ts_config b on lower(a.language) = b.cfgname order by 1;"""
+
+# Named {table}_... so that renaming a table renames its indexes with it (see rename).
+INDEXES = [
+    """create index if not exists {table}_num_idx on gutenberg.{table} (num);""",
+    """create index if not exists {table}_paragraph_length_idx on gutenberg.{table} (paragraph_length);""",
+    """create index if not exists {table}_textsearch_idx on gutenberg.{table} using gin (textsearchable_index_col);""",
+]
+
+# The table, its partitions and the indexes of both, with their relkind.
+TREE = """with tables as (
+    select %(table)s::regclass as oid
+    union all
+    select inhrelid from pg_inherits where inhparent = %(table)s::regclass
+)
+select c.relname, c.relkind from tables t inner join pg_class c on c.oid = t.oid
+union all
+select c.relname, c.relkind from tables t inner join pg_index i on i.indrelid = t.oid inner join pg_class c on c.oid = i.indexrelid;"""
+
+def partition(table, config):
+    return '{}_{}'.format(table, config)
+
+def languages(cursor):
+    cursor.execute(LANGUAGES)
+    return [row[0] for row in cursor]
+
+# Creates the parent table and its partitions, and returns the partition names.
+def create(cursor, table):
+    cursor.execute(PARENT.format(table=table))
+    names = []
+    for config in languages(cursor):
+        names.append(partition(table, config))
+        cursor.execute("""create table if not exists gutenberg.{} partition of gutenberg.{} for values in (%s);""".format(names[-1], table), (config,))
+    names.append(partition(table, 'default'))
+    cursor.execute("""create table if not exists gutenberg.{} partition of gutenberg.{} default;""".format(names[-1], table))
+    return names
+
+# Renames a table with its partitions and indexes: names starting with the table's name get the new
+# one instead, others (indexes from older builds) are prefixed with it.
+def rename(cursor, table, new_table):
+    cursor.execute(TREE, {'table': 'gutenberg.' + table})
+    for name, relkind in cursor.fetchall():
+        new_name = new_table + name[len(table):] if name.startswith(table) else '{}_{}'.format(new_table, name)
+        cursor.execute("""alter {} gutenberg.{} rename to {};""".format('index' if relkind in ('i', 'I') else 'table', name, new_name))
+
+def relations(plan):
+    found = []
+    if 'Relation Name' in plan:
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found.extend(relations(child))
+    return found
+
+# The partitions of gutenberg.paragraphs a query's plan still reads, from EXPLAIN (format json).
+# Partitions pruned at executor startup (the regconfig cast is only stable) are left out of the
+# plan as well.
+def scanned_partitions(connection, query, params, table='paragraphs'):
+    with connection.cursor() as cursor:
+        cursor.execute('explain (format json) ' + query, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    connection.rollback()
+    return sorted(set(name for name in relations(plan[0]['Plan']) if name == table or name.startswith(table + '_')))
@@ -0,0 +1,102 @@
+# Database connections of the request path.
+#
+# Every gunicorn worker gets its own pool of max_connections // workers connections (Pool in
+# dbconfig.yml), so all the workers together stay under what Postgres is set up for. Connections are
+# pinged before use and recycled after recycle_seconds, and each worker opens `warm` of them as soon
+# as it's forked (or on its first request without --preload) rather than on its first searches.
+#
+# fetch() runs the search queries on the plain DB-API cursor and returns tuples, which is all the
+# callbacks build their records from. Each query text is prepared once per connection (PREPARE, with
+# the pyformat parameters numbered) and executed by name after that, so Postgres parses and analyses
+# it once. plan_cache_mode stays force_custom_plan: a generic plan wouldn't see the search terms,
+# and how many paragraphs they match is what decides the plan.
+
+import os
+import re
+import threading
+
+import psycopg2
+from sqlalchemy import create_engine, event
+
+PARAMETER = re.compile(r'%\((\w+)\)s')
+
+# Per connection. The results table's sorts and filters make a few variants of the page query.
+MAX_PREPARED = 64
+
+class Pool:
+    def __init__(self, constring, workers=17, max_connections=68, warm=2, timeout_seconds=30, recycle_seconds=1800, plan_cache_mode='force_custom_plan'):
+        self.size = max(1, max_connections // workers)
+        self.warm_connections = min(warm, self.size)
+        self.engine = create_engine(constring, pool_size=self.size, max_overflow=0, pool_timeout=timeout_seconds, pool_recycle=recycle_seconds, pool_pre_ping=True)
+        self.warmed = None
+        self.lock = threading.Lock()
+        if plan_cache_mode:
+            @event.listens_for(self.engine, 'connect')
+            def configure(dbapi_connection, record):
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute('set plan_cache_mode = %s;', (plan_cache_mode,))
+                dbapi_connection.commit()
+        os.register_at_fork(after_in_child=self.warm)
+
+    # Opens warm_connections in the background, once per process.
+    def warm(self):
+        with self.lock:
+            if self.warmed == os.getpid():
+                return
+            self.warmed = os.getpid()
+        threading.Thread(target=self.open, name='pool-warmer', daemon=True).start()
+
+    def open(self):
+        connections = []
+        try:
+            for _ in range(self.warm_connections):
+                connections.append(self.engine.connect())
+        except Exception as e:
+            print(f"Could not warm the connection pool: '{e}'")
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def stats(self):
+        pool = self.engine.pool
+        return {'size': self.size, 'checked_out': pool.checkedout(), 'checked_in': pool.checkedin(), 'warmed': self.warmed == os.getpid()}
+
+# Returns (name, parameter names) for the prepared query, or None if it can't be prepared (a
+# parameter whose type Postgres can't infer), in which case it's run as is.
+def prepare(cursor, name, query):
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '${}'.format(names.index(match.group(1)) + 1)
+
+    # Run without parameters, so psycopg2 leaves %% alone.
+    body = PARAMETER.sub(number, query).replace('%%', '%').strip().rstrip(';')
+    cursor.execute('savepoint gutensearch_prepare;')
+    try:
+        cursor.execute('prepare {} as {}'.format(name, body))
+    except psycopg2.Error:
+        cursor.execute('rollback to savepoint gutensearch_prepare;')
+        return None
+    cursor.execute('release savepoint gutensearch_prepare;')
+    return name, names
+
+# Runs query with params on a SQLAlchemy connection's DB-API cursor, in its current transaction, and
+# returns the rows as tuples.
+def fetch(connection, query, params):
+    # Cleared by SQLAlchemy when the DB-API connection is closed or invalidated, like the statements.
+    statements = connection.info.setdefault('prepared', {})
+    cursor = connection.connection.cursor()
+    try:
+        if query not in statements and len(statements) < MAX_PREPARED:
+            statements[query] = prepare(cursor, 'gutensearch_{}'.format(len(statements)), query)
+        prepared = statements.get(query)
+        if prepared is None:
+            cursor.execute(query, params)
+        else:
+            name, names = prepared
+            cursor.execute('execute {} ({})'.format(name, ', '.join(['%s'] * len(names))) if names else 'execute {}'.format(name), [params[n] for n in names])
+        return cursor.fetchall()
+    finally:
+        cursor.close()
@@ -0,0 +1,103 @@
+# Writes gutenberg.query_log in the background instead of on the request path.
+#
+# Callbacks put rows on an in-process queue. A daemon thread drains it with one multi-row insert
+# every batch_rows rows or flush_interval seconds, whichever comes first. The queue is bounded:
+# when Postgres can't keep up, rows are dropped and counted rather than slowing searches down.
+# Whatever is queued is flushed when the worker exits.
+
+import atexit
+import datetime
+import os
+import queue
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+import db
+
+INSERT = """insert into gutenberg.query_log (tab, time, language, query, rows_returned_aka_limit, start_row_aka_offset, execution_ms, rows_returned) values %s;"""
+ROW_TEMPLATE = """(%s, %s, %s::regconfig, %s, %s, %s, %s, %s)"""
+
+class QueryLogWriter:
+    def __init__(self, constring, batch_rows=100, flush_interval=2.0, max_queued_rows=10000):
+        self.constring = constring
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.max_queued_rows = max_queued_rows
+        self.lock = threading.Lock()
+        self.pid = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    # Threads don't survive gunicorn's fork, so each worker starts its own on first use.
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = queue.Queue(self.max_queued_rows)
+            self.stopping = threading.Event()
+            self.connection = None
+            self.thread = threading.Thread(target=self.run, name='query-log-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def log(self, tab, language, query, limit, offset, execution_ms, rows_returned):
+        self.start()
+        row = (tab, datetime.datetime.now(datetime.timezone.utc), language, query, limit, offset, execution_ms, rows_returned)
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch:
+                self.write(batch)
+
+    def write(self, batch):
+        try:
+            if self.connection is None or self.connection.closed:
+                self.connection = db.connect(self.constring)
+            with self.connection.cursor() as cursor:
+                execute_values(cursor, INSERT, batch, template=ROW_TEMPLATE, page_size=len(batch))
+            self.connection.commit()
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            # Losing log rows must never take a worker down.
+            print(f"Could not write {len(batch)} query_log rows: '{e}'")
+            self.failed += len(batch)
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def close(self, timeout=5.0):
+        if self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        if self.connection is not None:
+            self.connection.close()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self.pid == os.getpid() else 0,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
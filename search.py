@@ -0,0 +1,375 @@
+# Search queries used by the Dash callbacks and the benchmarks.
+#
+# Searching happens in two phases. The first ranks books using only the GIN index and
+# ts_rank_cd, and keeps the requested page of book nums. The second runs ts_headline, by far
+# the most expensive part, on the top paragraphs of those books only.
+
+import functools
+import re
+
+# Headlines are built for this many paragraphs per book. Only the first 10,000 characters
+# of the aggregated headlines are ever shown.
+PARAGRAPHS_PER_BOOK = 5
+
+# Second phase, shared by the queries below: headlines for the top paragraphs of the books in ranked.
+SNIPPETS = """        , snippets as (
+            select
+            r.num
+            , string_agg(distinct ts_headline(%(language)s::regconfig, t.paragraph, phraseto_tsquery(%(language)s::regconfig, %(search_terms)s), 'MaxFragments=1000, StartSel=**, StopSel=**'), E'\n[...]\n') as highlighted_results
+            from ranked r
+            cross join lateral (
+                select paragraph
+                from gutenberg.paragraphs p
+                where p.num = r.num and p.language = %(language)s::regconfig and p.textsearchable_index_col @@ phraseto_tsquery(%(language)s::regconfig, %(search_terms)s)
+                order by ts_rank_cd(p.textsearchable_index_col, phraseto_tsquery(%(language)s::regconfig, %(search_terms)s), 32) desc
+                limit %(paragraphs_per_book)s
+            ) t
+            group by r.num
+        )
+"""
+
+# {cap} is empty, or limits ranking to the first matching paragraphs for searches that admission.py
+# considers too heavy to run in full.
+SEARCH_TEMPLATE = """with ranked as (
+            select
+            num
+            , avg(ts_rank_cd(textsearchable_index_col, phraseto_tsquery(%(language)s::regconfig, %(search_terms)s), 32)) as rank
+            from (
+                select num, textsearchable_index_col
+                from gutenberg.paragraphs
+                where language = %(language)s::regconfig and textsearchable_index_col @@ phraseto_tsquery(%(language)s::regconfig, %(search_terms)s)
+                {cap}
+            ) matches
+            group by num
+            order by rank desc, num asc
+            limit %(limit)s offset %(offset)s
+        )
+""" + SNIPPETS + """        select b.author
+        , '[' || b.title::text || '](https://www.gutenberg.org/ebooks/' || b.num::text || ')' as title
+        , '  ...' || substr(s.highlighted_results, 1, 10000) || E'...  ' as relevant_paragraphs
+        , to_char(100*r.rank, '99D9') as rank
+        from ranked r
+        inner join snippets s on r.num = s.num
+        inner join gutenberg.all_data b on r.num = b.num
+        order by r.rank desc, r.num asc;
+"""
+
+CAP = 'limit %(max_paragraphs)s'
+BOOKS = 'and num = any(%(books)s::integer[])'
+SEARCH_QUERY = SEARCH_TEMPLATE.format(cap='')
+CAPPED_SEARCH_QUERY = SEARCH_TEMPLATE.format(cap=CAP)
+
+# The results table is paged on the server (see update_page in app.py). Pages are fetched by keyset:
+# the sort key and num of the last row of the previous page, rather than an OFFSET. Matching books
+# are joined to all_data before paging so they can be filtered and sorted by author and title.
+#
+# Metadata filters (bookfilters.py) come as the nums of the books they allow. A few of them are
+# matched before ranking, so that Postgres can combine the num index with the GIN index; many are
+# only hash joined to the ranked books, which costs about as much as no filter.
+PAGE_TEMPLATE = """with matches as (
+            select
+            num
+            , avg(ts_rank_cd(textsearchable_index_col, phraseto_tsquery(%(language)s::regconfig, %(search_terms)s), 32)) as rank
+            from (
+                select num, textsearchable_index_col
+                from gutenberg.paragraphs
+                where language = %(language)s::regconfig and textsearchable_index_col @@ phraseto_tsquery(%(language)s::regconfig, %(search_terms)s) {books}
+                {cap}
+            ) matches
+            group by num
+        )
+        , ranked as (
+            select m.num, m.rank, {key} as sort_key
+            from matches m
+            inner join gutenberg.all_data b on m.num = b.num
+            {books_join}
+            where true {where}
+            order by {key} {direction}, m.num {direction}
+            limit %(limit)s {offset}
+        )
+""" + SNIPPETS + """        select b.author
+        , '[' || b.title::text || '](https://www.gutenberg.org/ebooks/' || b.num::text || ')' as title
+        , '  ...' || substr(s.highlighted_results, 1, 10000) || E'...  ' as relevant_paragraphs
+        , to_char(100*r.rank, '99D9') as rank
+        , r.num
+        , r.sort_key
+        from ranked r
+        inner join snippets s on r.num = s.num
+        inner join gutenberg.all_data b on r.num = b.num
+        order by r.sort_key {direction}, r.num {direction};
+"""
+
+# Columns the results table can be sorted by, with the type their keyset values are passed as.
+SORT_KEYS = {
+    'rank': ('m.rank', 'float8'),
+    'author': ("coalesce(b.author, '')", 'text'),
+    'title': ("coalesce(b.title, '')", 'text'),
+}
+FILTER_COLUMNS = {
+    'author': "coalesce(b.author, '')",
+    'title': "coalesce(b.title, '')",
+}
+FILTER_OPERATORS = {
+    'contains': 'ilike', 'icontains': 'ilike', 'scontains': 'like',
+    '=': '=', 'eq': '=', 's=': '=', 'i=': '=',
+    '!=': '<>', 'ne': '<>', 's!=': '<>', 'i!=': '<>',
+}
+
+# Parses the filter_query of a DataTable with filter_action='custom' into [column, operator, value]
+# lists. Filters on other columns (the headlines only exist once a page is built) are ignored.
+def parse_filter_query(filter_query):
+    filters = []
+    for part in (filter_query or '').split(' && '):
+        match = re.match(r'^\{(\w+)\}\s+(\S+)\s+(.*)$', part.strip())
+        if not match or match.group(1) not in FILTER_COLUMNS or match.group(2) not in FILTER_OPERATORS:
+            continue
+        value = match.group(3).strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        filters.append([match.group(1), match.group(2), value])
+    return filters
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Builds the query for one page. view is {'sort': column, 'descending': bool, 'filters': [...]},
+# after the [sort_key, num] of the last row of the previous page, or None for the first page or
+# when jumping to a page whose predecessor was never fetched, in which case offset is used. books
+# are the nums metadata filters allow, if any, matched before ranking with pushdown. mode is one of
+# EXPORT_MODES: plain matches like Discovery mode, and ranks the same way.
+def page_query(params, view, after=None, offset=0, max_paragraphs=None, books=None, pushdown=False, mode='phrase'):
+    params = dict(params, max_paragraphs=max_paragraphs)
+    if books is not None:
+        params['books'] = [int(num) for num in books]
+    key, cast = SORT_KEYS.get(view['sort'], SORT_KEYS['rank'])
+    descending = view['descending']
+    where = []
+    for i, (column, operator, value) in enumerate(view['filters']):
+        sql_operator = FILTER_OPERATORS[operator]
+        name = 'filter_{}'.format(i)
+        where.append('and {} {} %({})s'.format(FILTER_COLUMNS[column], sql_operator, name))
+        params[name] = '%{}%'.format(escape_like(value)) if 'like' in sql_operator else value
+    if after is not None:
+        where.append('and ({}, m.num) {} (%(after_key)s::{}, %(after_num)s)'.format(key, '<' if descending else '>', cast))
+        params['after_key'], params['after_num'] = after
+    query = PAGE_TEMPLATE.format(
+        cap=CAP if max_paragraphs else '',
+        books=BOOKS if books is not None and pushdown else '',
+        books_join='inner join unnest(%(books)s::integer[]) as f(num) on f.num = m.num' if books is not None else '',
+        key=key,
+        where=' '.join(where),
+        direction='desc' if descending else 'asc',
+        offset='offset %(page_offset)s' if after is None and offset else '')
+    params['page_offset'] = offset
+    return query.replace('phraseto_tsquery(', EXPORT_MODES[mode] + '('), params
+
+def view_from_table(sort_by, filter_query):
+    sort = sort_by[0] if sort_by else {}
+    if sort.get('column_id') in SORT_KEYS:
+        return {'sort': sort['column_id'], 'descending': sort.get('direction') == 'desc', 'filters': parse_filter_query(filter_query)}
+    return {'sort': 'rank', 'descending': True, 'filters': parse_filter_query(filter_query)}
+
+# A page of books ranked by the inverted index (invindex.py, Search: backend: index): Postgres only
+# builds their headlines. The nums and ranks come in the page's order.
+INDEX_PAGE_QUERY = """with ranked as (
+            select num, rank, rank as sort_key, ordinality
+            from unnest(%(nums)s::integer[], %(ranks)s::float8[]) with ordinality as r(num, rank, ordinality)
+        )
+""" + SNIPPETS + """        select b.author
+        , '[' || b.title::text || '](https://www.gutenberg.org/ebooks/' || b.num::text || ')' as title
+        , '  ...' || substr(s.highlighted_results, 1, 10000) || E'...  ' as relevant_paragraphs
+        , to_char(100*r.rank, '99D9') as rank
+        , r.num
+        , r.sort_key
+        from ranked r
+        inner join snippets s on r.num = s.num
+        inner join gutenberg.all_data b on r.num = b.num
+        order by r.ordinality;
+"""
+
+def index_page_params(params, nums, ranks):
+    return dict(params, nums=[int(num) for num in nums], ranks=[float(rank) for rank in ranks])
+
+# Paragraphs sharded across several databases (shards.py, Shards: in dbconfig.yml). Each shard
+# returns its top books for the ranked view, after the keyset of the last row shown if there is one;
+# the headlines of the books that make the page come from their shards, and the metadata from the
+# main database.
+SHARD_RANK_TEMPLATE = """select num, rank from (
+            select
+            num
+            , avg(ts_rank_cd(textsearchable_index_col, phraseto_tsquery(%(language)s::regconfig, %(search_terms)s), 32)) as rank
+            from (
+                select num, textsearchable_index_col
+                from gutenberg.paragraphs
+                where language = %(language)s::regconfig and textsearchable_index_col @@ phraseto_tsquery(%(language)s::regconfig, %(search_terms)s)
+                {cap}
+            ) matches
+            group by num
+        ) ranked
+        {after}
+        order by rank desc, num desc
+        limit %(top)s;
+"""
+
+SHARD_HEADLINES_QUERY = """with ranked as (
+            select unnest(%(nums)s::integer[]) as num
+        )
+""" + SNIPPETS + """        select num, highlighted_results from snippets;
+"""
+
+SHARDED_PAGE_QUERY = """select b.author
+        , '[' || b.title::text || '](https://www.gutenberg.org/ebooks/' || b.num::text || ')' as title
+        , '  ...' || substr(r.highlighted_results, 1, 10000) || E'...  ' as relevant_paragraphs
+        , to_char(100*r.rank, '99D9') as rank
+        , r.num
+        , r.rank as sort_key
+        from unnest(%(nums)s::integer[], %(ranks)s::float8[], %(headlines)s::text[]) with ordinality as r(num, rank, highlighted_results, ordinality)
+        inner join gutenberg.all_data b on r.num = b.num
+        order by r.ordinality;
+"""
+
+def shard_rank_query(params, top, after=None, max_paragraphs=None):
+    query = SHARD_RANK_TEMPLATE.format(
+        cap=CAP if max_paragraphs else '',
+        after='where (rank, num) < (%(after_key)s::float8, %(after_num)s::integer)' if after is not None else '')
+    params = dict(params, top=top, max_paragraphs=max_paragraphs)
+    if after is not None:
+        params['after_key'], params['after_num'] = after
+    return query, params
+
+# The same queries over the deduplicated paragraphs (dedup.py, Search: dedup: true). A row of
+# gutenberg.unique_paragraphs holds a paragraph once with the nums of every book it's in, a num
+# repeated as many times as the book has that paragraph, so unnesting nums gives back the rows of
+# gutenberg.paragraphs and the same ranks. A book's own paragraphs are found with the GIN index on nums.
+DEDUP_REWRITES = [
+    (re.compile(r'select (distinct )?num(, textsearchable_index_col)?(\s+)from gutenberg\.paragraphs\b'), r'select \1unnest(nums) as num\2\3from gutenberg.unique_paragraphs'),
+    (re.compile(r'from gutenberg\.paragraphs p(\s+)where p\.num = (\w+)\.num\b'), r'from gutenberg.unique_paragraphs p\1where p.nums @> array[\2.num]'),
+    # Paragraphs of other books that come along are left out by the join on books after ranking.
+    (re.compile(re.escape(BOOKS)), 'and nums && %(books)s::integer[]'),
+]
+
+@functools.lru_cache(maxsize=256)
+def dedup_query(query):
+    for pattern, replacement in DEDUP_REWRITES:
+        query = pattern.sub(replacement, query)
+    if 'gutenberg.paragraphs' in query:
+        raise ValueError('No deduplicated version of: {}'.format(query))
+    return query
+
+# offset is 1-based in the UI
+def search_params(language, search_terms, limit, offset, paragraphs_per_book=PARAGRAPHS_PER_BOOK, max_paragraphs=None):
+    return {
+        'language': language,
+        'search_terms': search_terms,
+        'limit': limit,
+        'offset': offset - 1,
+        'paragraphs_per_book': paragraphs_per_book,
+        'max_paragraphs': max_paragraphs,
+    }
+
+# Discovery mode shows a random sample of the matching books, picked in two steps: sample book nums
+# first, then build headlines for the chosen books only. Queries that match few paragraphs list the
+# matching nums through the index and shuffle them. Broad ones read a TABLESAMPLE of the paragraphs
+# sized from the admission estimate, so their cost doesn't grow with the number of matches; books
+# are then picked in proportion to how many of their paragraphs match.
+DISCOVERY_BOOKS = 30
+
+# With a cap, the books are picked among the first max_paragraphs matches only.
+DISCOVERY_ALL_TEMPLATE = """select num from (
+            select distinct num from (
+                select num
+                from gutenberg.paragraphs
+                where language = %(language)s::regconfig and textsearchable_index_col @@ plainto_tsquery(%(language)s::regconfig, %(search_terms)s)
+                {cap}
+            ) capped
+        ) matches
+        order by random()
+        limit %(books)s;
+"""
+DISCOVERY_ALL_QUERY = DISCOVERY_ALL_TEMPLATE.format(cap='')
+CAPPED_DISCOVERY_ALL_QUERY = DISCOVERY_ALL_TEMPLATE.format(cap=CAP)
+
+DISCOVERY_SAMPLE_QUERY = """select num from (
+            select distinct num
+            from gutenberg.paragraphs tablesample system (%(percent)s)
+            where language = %(language)s::regconfig and textsearchable_index_col @@ plainto_tsquery(%(language)s::regconfig, %(search_terms)s)
+        ) matches
+        order by random()
+        limit %(books)s;
+"""
+
+DISCOVERY_QUERY = """select b.author
+        , '[' || b.title::text || '](https://www.gutenberg.org/ebooks/' || b.num::text || ')' as title
+        , '  ...' || substr(s.highlighted_results, 1, 10000) || '...  ' as relevant_paragraphs
+        , random() as rand
+        from unnest(%(nums)s::integer[]) as c(num)
+        inner join gutenberg.all_data b on c.num = b.num
+        cross join lateral (
+            select string_agg(distinct ts_headline(%(language)s::regconfig, t.paragraph, plainto_tsquery(%(language)s::regconfig, %(search_terms)s), 'MaxFragments=1000, StartSel=**, StopSel=**'), E'\n[...]\n') as highlighted_results
+            from (
+                select paragraph
+                from gutenberg.paragraphs p
+                where p.num = c.num and p.language = %(language)s::regconfig and p.textsearchable_index_col @@ plainto_tsquery(%(language)s::regconfig, %(search_terms)s)
+                order by ts_rank_cd(p.textsearchable_index_col, plainto_tsquery(%(language)s::regconfig, %(search_terms)s), 32) desc
+                limit %(paragraphs_per_book)s
+            ) t
+        ) s
+        order by rand desc;
+"""
+
+def discovery_params(language, search_terms, books=DISCOVERY_BOOKS, paragraphs_per_book=PARAGRAPHS_PER_BOOK, nums=None, percent=None, max_paragraphs=None):
+    return {'language': language, 'search_terms': search_terms, 'books': books, 'paragraphs_per_book': paragraphs_per_book, 'nums': nums, 'percent': percent, 'max_paragraphs': max_paragraphs}
+
+# Percentage of the paragraphs table to sample so that about target_paragraphs of the estimated
+# matches are read, at most max_percent: a sample evaluates the tsquery on every row it reads.
+def sample_percent(estimate, target_paragraphs, max_percent=100.0):
+    return min(max_percent, 100.0 * target_paragraphs / max(estimate, 1))
+
+# Every matching book for the /export route, ranked like the Search tab ('phrase') or matched like
+# the Discovery tab ('plain'). The headlines are a scalar subquery that doesn't feed the sort, so
+# Postgres only builds them as rows are fetched from the cursor, after sorting the book nums.
+EXPORT_TEMPLATE = """with ranked as (
+            select
+            num
+            , avg(ts_rank_cd(textsearchable_index_col, {tsquery}(%(language)s::regconfig, %(search_terms)s), 32)) as rank
+            from (
+                select num, textsearchable_index_col
+                from gutenberg.paragraphs
+                where language = %(language)s::regconfig and textsearchable_index_col @@ {tsquery}(%(language)s::regconfig, %(search_terms)s)
+                {cap}
+            ) matches
+            group by num
+        )
+        select r.num
+        , b.author
+        , b.title
+        , 'https://www.gutenberg.org/ebooks/' || r.num::text as url
+        , round((100*r.rank)::numeric, 1) as rank
+        , (
+            select string_agg(distinct ts_headline(%(language)s::regconfig, t.paragraph, {tsquery}(%(language)s::regconfig, %(search_terms)s), 'MaxFragments=1000, StartSel=**, StopSel=**'), E'\n[...]\n')
+            from (
+                select paragraph
+                from gutenberg.paragraphs p
+                where p.num = r.num and p.language = %(language)s::regconfig and p.textsearchable_index_col @@ {tsquery}(%(language)s::regconfig, %(search_terms)s)
+                order by ts_rank_cd(p.textsearchable_index_col, {tsquery}(%(language)s::regconfig, %(search_terms)s), 32) desc
+                limit %(paragraphs_per_book)s
+            ) t
+        ) as relevant_paragraphs
+        from ranked r
+        inner join gutenberg.all_data b on r.num = b.num
+        order by r.rank desc, r.num asc;
+"""
+
+EXPORT_COLUMNS = ['num', 'author', 'title', 'url', 'rank', 'relevant_paragraphs']
+EXPORT_MODES = {'phrase': 'phraseto_tsquery', 'plain': 'plainto_tsquery'}
+
+def export_query(mode, max_paragraphs=None):
+    return EXPORT_TEMPLATE.format(tsquery=EXPORT_MODES[mode], cap=CAP if max_paragraphs else '')
+
+def export_params(language, search_terms, paragraphs_per_book=PARAGRAPHS_PER_BOOK, max_paragraphs=None):
+    return {'language': language, 'search_terms': search_terms, 'paragraphs_per_book': paragraphs_per_book, 'max_paragraphs': max_paragraphs}
+
+# The normalised tsquery is what the index is actually searched with, so it makes a better cache
+# key than the raw search terms.
+NORMALIZE_QUERY = """select phraseto_tsquery(%(language)s::regconfig, %(search_terms)s)::text;"""
+DISCOVERY_NORMALIZE_QUERY = """select plainto_tsquery(%(language)s::regconfig, %(search_terms)s)::text;"""
@@ -0,0 +1,227 @@
+# Runs the searches of the Search and Discovery tabs, the batch API and /export: the result cache,
+# the hot searches, the backends (Postgres, the inverted index, the shards) and admission control,
+# in the order the app uses them. app.py builds one Searcher from dbconfig.yml and
+# benchmark-replay.py another, without the result cache, so the replay runs the app's own code.
+# Importing it connects to nothing.
+
+from contextlib import ExitStack, nullcontext
+
+import numpy as np
+
+import export
+import hotsearches
+import invindex
+from admission import TooBroad, Busy, Timeout
+from pool import fetch
+from search import DISCOVERY_QUERY, DISCOVERY_ALL_QUERY, CAPPED_DISCOVERY_ALL_QUERY, DISCOVERY_SAMPLE_QUERY, NORMALIZE_QUERY, DISCOVERY_NORMALIZE_QUERY, search_params, discovery_params, sample_percent, page_query, dedup_query, INDEX_PAGE_QUERY, index_page_params, SHARDED_PAGE_QUERY, export_query, export_params, EXPORT_COLUMNS
+
+# Discovery in dbconfig.yml.
+DISCOVERY = {'books': 30, 'sample_above_paragraphs': 20000, 'sample_paragraphs': 1000, 'sample_attempts': 3, 'max_sample_percent': 2}
+
+def no_stage(name):
+    return nullcontext()
+
+def ranked_view(view):
+    return view['sort'] == 'rank' and view['descending'] and not view['filters']
+
+def records(rows):
+    return [{'author': row[0], 'title': row[1], 'relevant_paragraphs': row[2]} for row in rows]
+
+class Searcher:
+    # cache is a ResultCache, or None to search every time. stage times the steps of a search, like
+    # Metrics.stage.
+    def __init__(self, admission, discovery=DISCOVERY, cache=None, stage=no_stage, book_filters=None, search_index=None, shards=None, dedup=False, hot_searches=False, pushdown_books=5000):
+        self.admission = admission
+        self.discovery = discovery
+        self.discovery_books = discovery['books']
+        self.cache = cache
+        self.stage = stage
+        self.book_filters = book_filters
+        self.search_index = search_index
+        self.shards = shards
+        self.dedup = dedup
+        self.hot_searches = hot_searches
+        self.pushdown_books = pushdown_books
+
+    # ------------- Deduplicated paragraphs -----------------
+    # With Search: dedup: true, searches read gutenberg.unique_paragraphs, built by
+    # server-dedup-paragraphs.py, instead of gutenberg.paragraphs (see dedup.py).
+    def paragraphs_query(self, query):
+        return dedup_query(query) if self.dedup else query
+
+    # The normalised tsquery of the search terms, the cache key of a search.
+    def normalize(self, connection, mode, params):
+        return fetch(connection, NORMALIZE_QUERY if mode == 'phrase' else DISCOVERY_NORMALIZE_QUERY, params)[0][0]
+
+    # Discovery mode: picks the books (see DISCOVERY_ALL_QUERY and DISCOVERY_SAMPLE_QUERY), then
+    # builds headlines for those only. A sample that turns up too few books is retried, larger, a few
+    # times.
+    def fetch_discovery(self, connection, language, search_terms):
+        with self.stage('normalize'):
+            normalized = self.normalize(connection, 'plain', discovery_params(language, search_terms))
+        with self.stage('cache'):
+            key = self.cache.key('Discovery', language, normalized, self.discovery_books, 0) if self.cache is not None else None
+            cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached['records']
+        with self.stage('hot'):
+            results = self.fetch_hot_discovery(connection, language, normalized) if self.hot_searches else None
+        if results is None:
+            with self.stage('sql'):
+                results = self.sample_discovery(connection, language, search_terms)
+        with self.stage('records'):
+            dict_results = records(results)
+        if self.cache is not None:
+            with self.stage('cache_write'):
+                self.cache.put(key, {'records': dict_results})
+        return dict_results
+
+    def sample_discovery(self, connection, language, search_terms):
+        estimate = self.admission.estimate(connection, language, search_terms)
+        params = discovery_params(language, search_terms, books=self.discovery_books)
+        with self.admission.timed(connection):
+            if estimate < self.discovery['sample_above_paragraphs']:
+                nums = [row[0] for row in fetch(connection, self.paragraphs_query(DISCOVERY_ALL_QUERY), params)]
+            else:
+                nums = []
+                target = self.discovery['sample_paragraphs']
+                max_percent = self.discovery['max_sample_percent']
+                for attempt in range(self.discovery['sample_attempts']):
+                    params['percent'] = sample_percent(estimate, target, max_percent)
+                    nums = [row[0] for row in fetch(connection, self.paragraphs_query(DISCOVERY_SAMPLE_QUERY), params)]
+                    if len(nums) >= self.discovery_books or params['percent'] >= max_percent:
+                        break
+                    target *= 4
+        if len(nums) < self.discovery_books and estimate >= self.discovery['sample_above_paragraphs']:
+            nums = self.list_discovery(connection, language, search_terms, params, nums)
+        if not nums:
+            return []
+        params['nums'] = nums
+        with self.admission.timed(connection):
+            return fetch(connection, self.paragraphs_query(DISCOVERY_QUERY), params)
+
+    # The estimate only bounds the matches from above: words that are each common but rarely
+    # together match far fewer paragraphs, which a sample doesn't find but the index lists quickly.
+    # Listing them is admitted like a search, capped if heavy, and when it's refused or times out
+    # the books the sample found are shown.
+    def list_discovery(self, connection, language, search_terms, params, sampled):
+        try:
+            with self.admission.admit(connection, language, search_terms) as max_paragraphs:
+                query = CAPPED_DISCOVERY_ALL_QUERY if max_paragraphs else DISCOVERY_ALL_QUERY
+                nums = [row[0] for row in fetch(connection, self.paragraphs_query(query), dict(params, max_paragraphs=max_paragraphs))]
+        except (TooBroad, Busy, Timeout):
+            return sampled
+        return nums if len(nums) > len(sampled) else sampled
+
+    # ------------- Hot searches -----------------------------
+    # With HotSearches: serve: true, the most frequent searches are served from the results that
+    # server-hot-searches.py precomputed (see hotsearches.py): the default view of the Search tab as
+    # far as it was ranked, and Discovery mode from its pool of books. Anything else is searched live.
+    def fetch_hot_page(self, connection, language, normalized, limit, after, offset):
+        entry = fetch(connection, hotsearches.ENTRY_QUERY, hotsearches.entry_params('Search', language, normalized))
+        if not entry:
+            return None
+        query, params = hotsearches.page_query(language, normalized, limit, after, offset)
+        rows = fetch(connection, query, params)
+        return rows if hotsearches.servable(entry[0], rows, limit) else None
+
+    def fetch_hot_discovery(self, connection, language, normalized):
+        entry = fetch(connection, hotsearches.ENTRY_QUERY, hotsearches.entry_params('Discovery', language, normalized))
+        if not entry or (entry[0][0] < self.discovery_books and not entry[0][1]):
+            return None
+        return fetch(connection, hotsearches.DISCOVERY_QUERY, dict(hotsearches.entry_params('Discovery', language, normalized), books=self.discovery_books))
+
+    # ------------- Inverted index backend --------------------
+    # With Search: backend: index, the index built by server-build-index.py ranks the default view
+    # (by rank, unfiltered) of the languages it has been built for, and Postgres only builds the
+    # headlines of the page. Other views and languages are ranked by Postgres as before.
+    def index_for(self, language, view):
+        if self.search_index is None or not ranked_view(view):
+            return None
+        return self.search_index.language(language)
+
+    def fetch_index_page(self, connection, language_index, params, after, offset, books=None):
+        terms = invindex.query_terms(fetch(connection, invindex.QUERY_TERMS, params)[0][0])
+        estimate = language_index.estimate(terms)
+        if estimate >= self.admission.too_broad_paragraphs:
+            raise TooBroad(estimate)
+        nums, ranks = language_index.search(terms)
+        if books is not None:
+            allowed = np.isin(nums, books)
+            nums, ranks = nums[allowed], ranks[allowed]
+        if after is not None:
+            # Rows are ordered by rank, then num, both descending: skip up to the last row shown.
+            offset = int(np.sum((ranks > after[0]) | ((ranks == after[0]) & (nums >= after[1]))))
+        nums, ranks = nums[offset:offset + params['limit']], ranks[offset:offset + params['limit']]
+        if not len(nums):
+            return []
+        with self.admission.timed(connection):
+            return fetch(connection, self.paragraphs_query(INDEX_PAGE_QUERY), index_page_params(params, nums, ranks))
+
+    # ------------- Sharded paragraphs -----------------------
+    # With Shards: constrings in dbconfig.yml, the ranked view is ranked on every shard in parallel
+    # and its headlines built on the shards that own the books shown (see shards.py). Admission still
+    # runs on the main database, and each shard query gets its statement timeout.
+    def fetch_sharded_page(self, connection, params, after, offset, max_paragraphs):
+        def timed(shard_connection):
+            return self.admission.timed(shard_connection, self.admission.timeout_ms(max_paragraphs is not None))
+        ranked = self.shards.rank(params, offset + params['limit'], after, max_paragraphs, timed)[offset:]
+        if not ranked:
+            return []
+        nums, ranks = [num for num, _ in ranked], [rank for _, rank in ranked]
+        headlines = self.shards.headlines(params, nums, timed)
+        return fetch(connection, SHARDED_PAGE_QUERY, dict(params, nums=nums, ranks=ranks, headlines=headlines))
+
+    # Pages are cached by their view, metadata filters and keyset, so a prefetched page is served
+    # from the cache. mode plain (the batch API only) matches like Discovery mode and is ranked by
+    # Postgres.
+    def fetch_page(self, connection, language, search_terms, page_size, view, after, offset, filters=None, mode='phrase'):
+        params = search_params(language, search_terms, page_size, 1)
+        with self.stage('cache'):
+            normalized = self.normalize(connection, mode, params)
+            key = self.cache.key('Search' if mode == 'phrase' else 'Search plain', language, normalized, page_size, [view, filters or {}, after, offset]) if self.cache is not None else None
+            cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached
+        with self.stage('hot'):
+            max_paragraphs = None
+            rows = self.fetch_hot_page(connection, language, normalized, page_size, after, offset) if self.hot_searches and mode == 'phrase' and ranked_view(view) and not filters else None
+        if rows is None:
+            with self.stage('filters'):
+                books, share = self.book_filters.books(language, filters) if filters else (None, 1.0)
+                # Few enough books to match before ranking, which makes the search that much cheaper.
+                pushdown = books is not None and len(books) <= self.pushdown_books
+            with self.stage('sql'):
+                language_index = self.index_for(language, view) if mode == 'phrase' else None
+                if books is not None and not len(books):
+                    rows = []
+                elif language_index is not None:
+                    rows = self.fetch_index_page(connection, language_index, params, after, offset, books)
+                else:
+                    with self.admission.admit(connection, language, search_terms, share if pushdown else 1.0) as max_paragraphs:
+                        if self.shards is not None and ranked_view(view) and books is None and mode == 'phrase':
+                            rows = self.fetch_sharded_page(connection, params, after, offset, max_paragraphs)
+                        else:
+                            query, params = page_query(params, view, after, offset, max_paragraphs, books, pushdown, mode)
+                            rows = fetch(connection, self.paragraphs_query(query), params)
+        with self.stage('records'):
+            page = {
+                'records': records(rows),
+                'last': [rows[-1][5], rows[-1][4]] if rows else None,
+                'capped': max_paragraphs,
+            }
+        if self.cache is not None:
+            with self.stage('cache_write'):
+                self.cache.put(key, page)
+        return page
+
+    # ------------- Export -----------------------------------
+    # Admits the export and returns (body, finish, max_paragraphs): the chunks to stream, and the
+    # export.Finish to call when the response closes. Raises TooBroad, Busy or Timeout like admit,
+    # leaving the connection to the caller.
+    def export(self, connection, language, search_terms, mode, format, chunk_rows=100, on_close=None):
+        stack = ExitStack()
+        max_paragraphs = stack.enter_context(self.admission.admit(connection, language, search_terms))
+        finish = export.Finish(connection, stack, on_close=on_close)
+        body = export.stream(connection, finish, self.paragraphs_query(export_query(mode, max_paragraphs)), export_params(language, search_terms, max_paragraphs=max_paragraphs), EXPORT_COLUMNS, format, chunk_rows=chunk_rows)
+        return body, finish, max_paragraphs
@@ -0,0 +1,38 @@
+# Builds the inverted index (see invindex.py) from gutenberg.paragraphs, one language at a time, into
+# the Search: index_path of dbconfig.yml. Each language is read in one pass over its partition and
+# replaces the previous index of that language once it's complete. The app's workers pick it up when
+# they restart.
+#
+# Rebuild after server-build-paragraphs.py or server-ingest.py changed the paragraphs: until then,
+# searches ranked by the index miss the new books.
+
+import argparse
+
+import db
+import invindex
+import partitions
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the inverted index of gutenberg.paragraphs.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--path', help='index directory (default: Search: index_path in --config)')
+    parser.add_argument('--language', action='append', help='language to build, e.g. English (default: all of them)')
+    parser.add_argument('--workers', type=int, default=4, help='processes parsing tsvectors')
+    parser.add_argument('--chunk-paragraphs', type=int, default=50000, help='paragraphs per run file')
+    args = parser.parse_args()
+
+    cfg = db.load_config(args.config)
+    connection = db.connect(cfg['Postgres']['constring'])
+    with connection.cursor() as cursor:
+        languages = [language.lower() for language in args.language] if args.language else partitions.languages(cursor)
+        batch = db.ingest_version(cursor)
+    connection.rollback()
+    for language in languages:
+        invindex.build(connection, args.path or cfg['Search']['index_path'], language, workers=args.workers, chunk_paragraphs=args.chunk_paragraphs)
+        with connection.cursor() as cursor:
+            db.record_build(cursor, 'index:' + language, batch)
+        connection.commit()
+    connection.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# Builds gutenberg.paragraphs from gutenberg.all_data in parallel. This replaces the paragraph
+# build of server-process-2.sql.
+#
+# Books are processed in num-range chunks over several connections. Each chunk splits its books
+# into paragraphs and computes the regconfig and tsvector in a single INSERT ... SELECT into a
+# fresh table, so no row is ever rewritten. A chunk and its row in the build log are committed
+# together, so an interrupted build resumes with the chunks that are left. Indexes are built once
+# all chunks are in, one partition per connection, then the new table replaces the old one.
+#
+# The table is partitioned by language (see partitions.py). --language rebuilds a single language
+# into a standalone table (paragraphs_rebuild_<language>), indexes it and swaps it in as that
+# language's partition, leaving the others alone.
+#
+# The split itself, shared with server-ingest.py, is partitions.SPLIT.
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+import partitions
+
+SETUP = """create table if not exists gutenberg.paragraphs_build_log
+  (build text
+    , chunk_start integer
+    , chunk_stop integer
+    , books integer
+    , paragraphs integer
+    , seconds double precision
+    , finished_at timestamptz default now()
+    , primary key (build, chunk_start));
+"""
+
+# The previous table is renamed to paragraphs_old (dropped unless --keep-old), with its partitions.
+def swap_all(cursor):
+    cursor.execute("""alter table gutenberg.paragraphs_build add foreign key (num) references gutenberg.all_data (num);""")
+    cursor.execute("""drop table if exists gutenberg.paragraphs_old;""")
+    for config in partitions.languages(cursor) + ['default']:
+        # Partitions kept by --language --keep-old.
+        cursor.execute("""drop table if exists gutenberg.{};""".format(partitions.partition('paragraphs_old', config)))
+    cursor.execute("""select to_regclass('gutenberg.paragraphs') is not null;""")
+    if cursor.fetchone()[0]:
+        partitions.rename(cursor, 'paragraphs', 'paragraphs_old')
+    partitions.rename(cursor, 'paragraphs_build', 'paragraphs')
+
+# The check constraint lets ATTACH PARTITION skip scanning the new partition.
+def swap_language(cursor, config):
+    table, old = partitions.partition('paragraphs', config), partitions.partition('paragraphs_old', config)
+    build = partitions.partition('paragraphs_rebuild', config)
+    cursor.execute("""alter table gutenberg.{} add constraint language_check check (language is not null and language = %s::regconfig);""".format(build), (config,))
+    cursor.execute("""alter table gutenberg.{} add foreign key (num) references gutenberg.all_data (num);""".format(build))
+    cursor.execute("""drop table if exists gutenberg.{};""".format(old))
+    cursor.execute("""select to_regclass(%s) is not null;""", ('gutenberg.' + table,))
+    if cursor.fetchone()[0]:
+        cursor.execute("""alter table gutenberg.paragraphs detach partition gutenberg.{};""".format(table))
+        partitions.rename(cursor, table, old)
+    partitions.rename(cursor, build, table)
+    cursor.execute("""alter table gutenberg.paragraphs attach partition gutenberg.{} for values in (%s);""".format(table), (config,))
+    return old
+
+def log(message):
+    print('{} {}'.format(time.strftime('%H:%M:%S'), message), flush=True)
+
+def chunks(connection, build, chunk_size):
+    with connection.cursor() as cursor:
+        cursor.execute("""select min(num), max(num) from gutenberg.all_data;""")
+        first, last = cursor.fetchone()
+        cursor.execute("""select chunk_start from gutenberg.paragraphs_build_log where build = %s;""", (build,))
+        done = set(row[0] for row in cursor)
+    return [(start, start + chunk_size) for start in range(first, last + 1, chunk_size) if start not in done], len(done)
+
+class Builder:
+    def __init__(self, constring, max_length, table, config=None):
+        self.constring = constring
+        self.max_length = max_length
+        self.table = table
+        self.config = config
+        self.build = config or 'all'
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = db.connect(self.constring)
+        return self.local.connection
+
+    def build_chunk(self, chunk):
+        start, stop = chunk
+        connection = self.connection()
+        begin = time.perf_counter()
+        with connection.cursor() as cursor:
+            only = 'and b.cfgname = %(language)s' if self.config else ''
+            cursor.execute(partitions.SPLIT.format(table=self.table, where='a.num >= %(start)s and a.num < %(stop)s ' + only), {'start': start, 'stop': stop, 'max_length': self.max_length, 'language': self.config})
+            paragraphs = cursor.rowcount
+            cursor.execute("""select count(*) from gutenberg.all_data a left join pg_ts_config b on lower(a.language) = b.cfgname where a.num >= %(start)s and a.num < %(stop)s {only};""".format(only=only), {'start': start, 'stop': stop, 'language': self.config})
+            books = cursor.fetchone()[0]
+            seconds = time.perf_counter() - begin
+            cursor.execute("""insert into gutenberg.paragraphs_build_log (build, chunk_start, chunk_stop, books, paragraphs, seconds) values (%s, %s, %s, %s, %s, %s);""", (self.build, start, stop, books, paragraphs, seconds))
+        connection.commit()
+        return start, stop, books, paragraphs, seconds
+
+    def index(self, table, maintenance_work_mem):
+        for statement in partitions.INDEXES:
+            timed(self.connection(), statement.format(table=table), maintenance_work_mem)
+        return table
+
+def timed(connection, statement, maintenance_work_mem):
+    begin = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute("""set maintenance_work_mem = %s;""", (maintenance_work_mem,))
+        cursor.execute(statement)
+    connection.commit()
+    log('{} ({:.1f} s)'.format(statement.strip(), time.perf_counter() - begin))
+
+def main():
+    parser = argparse.ArgumentParser(description='Build gutenberg.paragraphs in parallel num-range chunks.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--workers', type=int, default=4, help='parallel connections')
+    parser.add_argument('--chunk-size', type=int, default=250, help='width of each num range')
+    parser.add_argument('--max-length', type=int, default=partitions.MAX_PARAGRAPH_LENGTH)
+    parser.add_argument('--maintenance-work-mem', default='800MB', help='for the index builds')
+    parser.add_argument('--keep-old', action='store_true', help='keep the previous table (or partition) as gutenberg.paragraphs_old(_<language>)')
+    parser.add_argument('--language', help='rebuild only this language\'s partition, e.g. English')
+    args = parser.parse_args()
+
+    constring = db.load_config(args.config)['Postgres']['constring']
+    connection = db.connect(constring)
+    config = args.language.lower() if args.language else None
+    with connection.cursor() as cursor:
+        cursor.execute(SETUP)
+        if config is None:
+            table = 'paragraphs_build'
+            tables = partitions.create(cursor, table)
+        else:
+            if config not in partitions.languages(cursor):
+                raise SystemExit('No books in {} with a text search configuration.'.format(args.language))
+            cursor.execute("""select relkind from pg_class where oid = to_regclass('gutenberg.paragraphs');""")
+            if cursor.fetchone() != ('p',):
+                raise SystemExit('gutenberg.paragraphs is not partitioned yet, run a full build first.')
+            table = partitions.partition('paragraphs_rebuild', config)
+            cursor.execute(partitions.STANDALONE.format(table=table))
+            tables = [table]
+    connection.commit()
+
+    builder = Builder(constring, args.max_length, table, config)
+    todo, done = chunks(connection, builder.build, args.chunk_size)
+    if done:
+        log('Resuming: {} chunks already built, {} to go.'.format(done, len(todo)))
+    begin = time.perf_counter()
+    total_books = total_paragraphs = 0
+    with ThreadPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(builder.build_chunk, chunk) for chunk in todo]
+        for i, future in enumerate(as_completed(futures), 1):
+            start, stop, books, paragraphs, seconds = future.result()
+            total_books += books
+            total_paragraphs += paragraphs
+            elapsed = time.perf_counter() - begin
+            log('chunk {}-{}: {} books, {} paragraphs in {:.1f} s ({}/{}, {:.1f} books/s overall)'.format(
+                start, stop - 1, books, paragraphs, seconds, i, len(todo), total_books / max(elapsed, 1e-9)))
+    log('Paragraphs done: {} books, {} paragraphs in {:.1f} s'.format(total_books, total_paragraphs, time.perf_counter() - begin))
+
+    # Each partition is indexed on its own connection. The indexes on the parent then only attach them.
+    with ThreadPoolExecutor(args.workers) as pool:
+        for future in as_completed([pool.submit(builder.index, name, args.maintenance_work_mem) for name in tables]):
+            log('{} indexed.'.format(future.result()))
+    if config is None:
+        for statement in partitions.INDEXES:
+            timed(connection, statement.format(table=table), args.maintenance_work_mem)
+    with connection.cursor() as cursor:
+        if config is None:
+            swap_all(cursor)
+            old, analyze = 'paragraphs_old', 'paragraphs'
+        else:
+            old, analyze = swap_language(cursor, config), partitions.partition('paragraphs', config)
+        if not args.keep_old:
+            cursor.execute("""drop table if exists gutenberg.{};""".format(old))
+        cursor.execute("""delete from gutenberg.paragraphs_build_log where build = %s;""", (builder.build,))
+    connection.commit()
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("""analyze gutenberg.{};""".format(analyze))
+    log('gutenberg.{} is ready.'.format(analyze))
+    connection.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Builds the paragraph shards listed under Shards: constrings in dbconfig.yml from the main
+# database (see shards.py). Each shard gets the books whose num % (number of shards) is its position
+# in the list, replacing whatever it held, and the shards are built in parallel.
+#
+# Changing the number of shards moves most books, so rebuild them all; --shard rebuilds one, e.g.
+# after restoring it. Run server-build-paragraphs.py or server-ingest.py on the main database first.
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import shards
+
+def log(message):
+    print('{} {}'.format(time.strftime('%H:%M:%S'), message), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the paragraph shards from the main database.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--shard', type=int, action='append', help='position of the shard to build in the list (default: all of them)')
+    parser.add_argument('--chunk-size', type=int, default=250, help='width of the num ranges copied at a time')
+    args = parser.parse_args()
+
+    cfg = db.load_config(args.config)
+    constrings = cfg['Shards']['constrings']
+    if not constrings:
+        raise SystemExit('No shards under Shards: constrings in {}.'.format(args.config))
+    if cfg['Postgres']['constring'] in constrings:
+        raise SystemExit('The main database cannot be one of its shards.')
+
+    def build(shard):
+        main_connection, connection = db.connect(cfg['Postgres']['constring']), db.connect(constrings[shard])
+        try:
+            with main_connection.cursor() as cursor:
+                batch = db.ingest_version(cursor)
+            main_connection.rollback()
+            books = shards.build(main_connection, connection, shard, len(constrings), chunk_size=args.chunk_size, log=log)
+            with main_connection.cursor() as cursor:
+                db.record_build(cursor, 'shard:{}'.format(shard), batch)
+            main_connection.commit()
+            return books
+        finally:
+            main_connection.close()
+            connection.close()
+
+    begin = time.perf_counter()
+    todo = args.shard if args.shard else range(len(constrings))
+    with ThreadPoolExecutor(len(todo)) as pool:
+        books = sum(pool.map(build, todo))
+    log('{} shards, {} books in {:.1f} s'.format(len(todo), books, time.perf_counter() - begin))
+
+if __name__ == '__main__':
+    main()
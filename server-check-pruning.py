@@ -0,0 +1,60 @@
+# Checks that the app's queries only read the partition of gutenberg.paragraphs for the language
+# searched, by looking at their plans (EXPLAIN, without running them). Prints the partitions each
+# query reads and exits with an error if any query reads another one. --dedup checks the queries of
+# Search: dedup: true, against the partitions of gutenberg.unique_paragraphs.
+
+import argparse
+import sys
+
+import db
+import partitions
+from search import SEARCH_QUERY, CAPPED_SEARCH_QUERY, DISCOVERY_QUERY, DISCOVERY_ALL_QUERY, DISCOVERY_SAMPLE_QUERY, search_params, discovery_params, page_query, shard_rank_query, export_query, export_params, dedup_query
+
+def queries(language, search_terms, dedup=False):
+    params = search_params(language, search_terms, 10, 1, max_paragraphs=100000)
+    first_page = {'sort': 'rank', 'descending': True, 'filters': []}
+    by_author = {'sort': 'author', 'descending': False, 'filters': [['title', 'contains', 'the']]}
+    yield 'Search', SEARCH_QUERY, params
+    yield 'Search, capped', CAPPED_SEARCH_QUERY, params
+    yield ('Search page',) + page_query(params, first_page)
+    yield ('Search page by keyset',) + page_query(params, first_page, after=[0.5, 100])
+    yield ('Search page by author, filtered, with offset',) + page_query(params, by_author, offset=20, max_paragraphs=100000)
+    yield ('Search page of a few books',) + page_query(params, first_page, books=[1, 2, 3], pushdown=True)
+    if not dedup:
+        # Shards have no unique_paragraphs.
+        yield ('Shard ranks',) + shard_rank_query(params, 10)
+        yield ('Shard ranks by keyset, capped',) + shard_rank_query(params, 10, after=[0.5, 100], max_paragraphs=50000)
+    yield 'Discovery books', DISCOVERY_ALL_QUERY, discovery_params(language, search_terms)
+    yield 'Discovery sample', DISCOVERY_SAMPLE_QUERY, discovery_params(language, search_terms, percent=1.0)
+    yield 'Discovery headlines', DISCOVERY_QUERY, discovery_params(language, search_terms, nums=[1, 2, 3])
+    for mode in ('phrase', 'plain'):
+        yield 'Export ({})'.format(mode), export_query(mode), export_params(language, search_terms)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that searches only read the partition of their language.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--dsn', help='connect here instead of the database in --config')
+    parser.add_argument('--language', action='append', help='language to check, e.g. English (default: all of them)')
+    parser.add_argument('--search-terms', default='bellows to mend')
+    parser.add_argument('--dedup', action='store_true', help='check the queries over gutenberg.unique_paragraphs instead')
+    args = parser.parse_args()
+
+    connection = db.connect(args.dsn or db.load_config(args.config)['Postgres']['constring'])
+    with connection.cursor() as cursor:
+        languages = [language.lower() for language in args.language] if args.language else partitions.languages(cursor)
+    connection.rollback()
+    table = 'unique_paragraphs' if args.dedup else 'paragraphs'
+    failed = 0
+    for language in languages:
+        expected = partitions.partition(table, language)
+        for label, query, params in queries(language, args.search_terms, args.dedup):
+            scanned = partitions.scanned_partitions(connection, dedup_query(query) if args.dedup else query, params, table)
+            ok = scanned == [expected]
+            failed += not ok
+            print('{:4} {:10} {:48} {}'.format('ok' if ok else 'FAIL', language, label, ', '.join(scanned) or '-'))
+    connection.close()
+    if failed:
+        sys.exit('{} queries read other partitions than their language\'s.'.format(failed))
+
+if __name__ == '__main__':
+    main()
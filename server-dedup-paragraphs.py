@@ -0,0 +1,100 @@
+# Builds gutenberg.unique_paragraphs (see dedup.py) from gutenberg.paragraphs: one language partition
+# per connection, then its indexes, then the new table replaces the previous one. Reports how many
+# paragraphs were duplicates, and the size of both tables and their indexes.
+#
+# Run it after server-build-paragraphs.py, and again after server-ingest.py: until then, searches with
+# Search: dedup: true miss the new books. --drop-search-index then drops the GIN index of
+# gutenberg.paragraphs, which the app no longer reads; server-ingest.py doesn't need it either.
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+import dedup
+import partitions
+
+def log(message):
+    print('{} {}'.format(time.strftime('%H:%M:%S'), message), flush=True)
+
+def megabytes(size):
+    return '{:,.0f} MB'.format(size / 1024 / 1024)
+
+def timed(constring, statements, work_mem, maintenance_work_mem):
+    connection = db.connect(constring)
+    begin = time.perf_counter()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""set work_mem = %s;""", (work_mem,))
+            cursor.execute("""set maintenance_work_mem = %s;""", (maintenance_work_mem,))
+            result = [statement(cursor) for statement in statements]
+        connection.commit()
+    finally:
+        connection.close()
+    return result, time.perf_counter() - begin
+
+def main():
+    parser = argparse.ArgumentParser(description='Build gutenberg.unique_paragraphs, each paragraph stored once.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--workers', type=int, default=4, help='parallel connections, one language at a time each')
+    parser.add_argument('--work-mem', default='1GB', help='for sorting each partition by paragraph')
+    parser.add_argument('--maintenance-work-mem', default='800MB', help='for the index builds')
+    parser.add_argument('--keep-old', action='store_true', help='keep the previous table as gutenberg.unique_paragraphs_old')
+    parser.add_argument('--drop-search-index', action='store_true', help='drop the GIN index of gutenberg.paragraphs once done')
+    args = parser.parse_args()
+
+    constring = db.load_config(args.config)['Postgres']['constring']
+    connection = db.connect(constring)
+    table = 'unique_paragraphs_build'
+    with connection.cursor() as cursor:
+        cursor.execute("""drop table if exists gutenberg.{};""".format(table))
+        dedup.create(cursor, table)
+        languages = partitions.languages(cursor)
+        batch = db.ingest_version(cursor)
+    connection.commit()
+
+    def fill(config):
+        name = partitions.partition(table, config)
+        (counts,), seconds = timed(constring, [lambda cursor: dedup.fill(cursor, table, config)], args.work_mem, args.maintenance_work_mem)
+        log('{}: {:,} paragraphs, {:,} unique ({:.1%} duplicates) in {:.1f} s'.format(name, counts[0], counts[1], 1 - counts[1] / max(counts[0], 1), seconds))
+        _, index_seconds = timed(constring, [lambda cursor, statement=statement: cursor.execute(statement.format(table=name)) for statement in dedup.INDEXES], args.work_mem, args.maintenance_work_mem)
+        log('{} indexed in {:.1f} s'.format(name, index_seconds))
+        return counts, seconds, index_seconds
+
+    begin = time.perf_counter()
+    total = kept = 0
+    fill_seconds = index_seconds = 0.0
+    with ThreadPoolExecutor(args.workers) as pool:
+        for future in as_completed([pool.submit(fill, config) for config in languages]):
+            (paragraphs, unique), seconds, indexed = future.result()
+            total, kept = total + paragraphs, kept + unique
+            fill_seconds, index_seconds = fill_seconds + seconds, index_seconds + indexed
+
+    # The indexes on the parent only attach those of the partitions.
+    with connection.cursor() as cursor:
+        for statement in dedup.INDEXES:
+            cursor.execute(statement.format(table=table))
+        cursor.execute("""drop table if exists gutenberg.unique_paragraphs_old;""")
+        if dedup.exists(cursor):
+            partitions.rename(cursor, 'unique_paragraphs', 'unique_paragraphs_old')
+        partitions.rename(cursor, table, 'unique_paragraphs')
+        if not args.keep_old:
+            cursor.execute("""drop table if exists gutenberg.unique_paragraphs_old;""")
+        db.record_build(cursor, 'unique_paragraphs', batch)
+    connection.commit()
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("""analyze gutenberg.unique_paragraphs;""")
+        if args.drop_search_index:
+            cursor.execute("""drop index if exists gutenberg.paragraphs_textsearch_idx;""")
+            log('gutenberg.paragraphs_textsearch_idx dropped.')
+        before, after = dedup.sizes(cursor, 'paragraphs'), dedup.sizes(cursor, 'unique_paragraphs')
+    connection.close()
+
+    log('gutenberg.unique_paragraphs is ready in {:.1f} s ({:.1f} s of sorting and copying, {:.1f} s of indexing, over {} connections).'.format(time.perf_counter() - begin, fill_seconds, index_seconds, args.workers))
+    log('{:,} paragraphs, {:,} unique: {:.1%} of the tsvectors and GIN entries were duplicates.'.format(total, kept, 1 - kept / max(total, 1)))
+    log('gutenberg.paragraphs: {} of tables, {} of indexes.'.format(megabytes(before[0]), megabytes(before[1])))
+    log('gutenberg.unique_paragraphs: {} of tables, {} of indexes.'.format(megabytes(after[0]), megabytes(after[1])))
+
+if __name__ == '__main__':
+    main()
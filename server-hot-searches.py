@@ -0,0 +1,98 @@
+# Precomputes the results of the most frequent searches of gutenberg.query_log into
+# gutenberg.hot_results (see hotsearches.py), which the app serves them from with
+# HotSearches: serve: true in dbconfig.yml.
+#
+# Each run counts the searches logged since the previous one, then rebuilds the entries of the top
+# searches per language and tab that are missing, were built before the books last changed, or are
+# older than --max-age-hours. Entries that fell out of the top are dropped. Run it from cron, or
+# with --every-minutes to keep it running.
+
+import argparse
+import time
+
+import psycopg2
+
+import db
+import hotsearches
+from search import page_query, search_params, view_from_table, DISCOVERY_ALL_QUERY, DISCOVERY_QUERY, discovery_params, dedup_query
+
+def log(message):
+    print('{} {}'.format(time.strftime('%H:%M:%S'), message), flush=True)
+
+def build(cursor, tab, language, search_terms, args, paragraphs_query):
+    cursor.execute("""set local statement_timeout = %s;""", (args.timeout_ms,))
+    if tab == 'Search':
+        # The default view of the Search tab, every matching paragraph ranked.
+        query, params = page_query(search_params(language, search_terms, args.books, 1), view_from_table([], None))
+        cursor.execute(paragraphs_query(query), params)
+        return cursor.fetchall(), args.books
+    params = discovery_params(language, search_terms, books=args.discovery_books)
+    cursor.execute(paragraphs_query(DISCOVERY_ALL_QUERY), params)
+    params['nums'] = [row[0] for row in cursor.fetchall()]
+    if not params['nums']:
+        return [], args.discovery_books
+    cursor.execute(paragraphs_query(DISCOVERY_QUERY), params)
+    return cursor.fetchall(), args.discovery_books
+
+def refresh(connection, args, paragraphs_query):
+    with connection.cursor() as cursor:
+        cursor.execute(hotsearches.SCHEMA)
+        counted = hotsearches.count(cursor)
+        connection.commit()
+        log('{:,} searches counted since the last run.'.format(counted))
+        cursor.execute(hotsearches.DATA_VERSION_QUERY)
+        data_version = '{}-{}'.format(cursor.fetchone()[0], db.ingest_version(cursor))
+        cursor.execute(hotsearches.TOP_QUERY, {'top': args.top})
+        top = cursor.fetchall()
+        cursor.execute(hotsearches.FRESH_QUERY, {'data_version': data_version, 'max_age': '{} hours'.format(args.max_age_hours)})
+        fresh = set(cursor.fetchall())
+    connection.commit()
+
+    built = failed = 0
+    for tab, language, normalized, search_terms in top:
+        if (tab, language, normalized) in fresh:
+            continue
+        start = time.perf_counter()
+        try:
+            with connection.cursor() as cursor:
+                rows, books = build(cursor, tab, language, search_terms, args, paragraphs_query)
+                hotsearches.store(cursor, tab, language, normalized, search_terms, rows, books, data_version)
+            connection.commit()
+        except psycopg2.Error as e:
+            connection.rollback()
+            failed += 1
+            log('{} {} "{}" failed: {}'.format(tab, language, search_terms, str(e).strip()))
+            continue
+        built += 1
+        log('{} {} "{}": {:,} books in {:.1f} s'.format(tab, language, search_terms, len(rows), time.perf_counter() - start))
+
+    with connection.cursor() as cursor:
+        dropped = hotsearches.prune(cursor, {(tab, language, normalized) for tab, language, normalized, _ in top})
+    connection.commit()
+    log('{} searches rebuilt, {} up to date, {} failed, {} dropped.'.format(built, len(top) - built - failed, failed, dropped))
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the results of the most frequent searches.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--top', type=int, default=50, help='searches kept per language, for each of the Search and Discovery tabs')
+    parser.add_argument('--books', type=int, default=100, help='ranked books kept per search, pages past them are searched live')
+    parser.add_argument('--discovery-books', type=int, default=300, help='books Discovery mode draws from per search')
+    parser.add_argument('--timeout-ms', type=int, default=600000, help='statement timeout of each search')
+    parser.add_argument('--max-age-hours', type=float, default=24)
+    parser.add_argument('--every-minutes', type=float, default=0, help='refresh again after this long, 0 to run once')
+    args = parser.parse_args()
+
+    cfg = db.load_config(args.config)
+    paragraphs_query = dedup_query if cfg['Search']['dedup'] else (lambda query: query)
+    connection = db.connect(cfg['Postgres']['constring'])
+    try:
+        while True:
+            refresh(connection, args, paragraphs_query)
+            if not args.every_minutes:
+                break
+            time.sleep(60 * args.every_minutes)
+    finally:
+        connection.close()
+
+if __name__ == '__main__':
+    main()
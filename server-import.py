@@ -1,49 +1,167 @@
+# Streams the text files into gutenberg_raw.content_raw.
+#
+# A pool of worker processes reads the books and prepares COPY data in batches, which the main
+# process streams into the table, one transaction per batch. Every committed batch is a
+# checkpoint: when restarted, books already in content_raw are skipped, so a crash halfway
+# through resumes where it stopped instead of starting over.
+#
+# The list of books comes from gutenberg_raw.metadata_columns by default. With --metadata it is
+# streamed straight from gutenberg-metadata.json instead, and --load-metadata also fills
+# gutenberg_raw.metadata_raw from it, which replaces the \set step of server-process-1.sql.
+
+import argparse
+import io
+import json
 import os
-import psycopg2
-from psycopg2 import OperationalError
-
-# change this path according to your setup
-os.chdir('/path/to/gutensearch/gutenberg-dammit-files-v002/gutenberg-dammit-files')
-print("Current working directory: {0}".format(os.getcwd()))
-
-def create_connection(db_name, db_user, db_password, db_host, db_port):
-    connection = None
-    try:
-        connection = psycopg2.connect(
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            host=db_host,
-            port=db_port,
-        )
-        print("Connection to PostgreSQL DB successful")
-    except OperationalError as e:
-        print(f"The error '{e}' occurred")
-    return connection
-
-# change this according to your database read-only user.
-connection = create_connection(
-    "gutensearch", "user", "password", "127.0.0.1", "port"
-)
-
-def execute_read_query(connection, query):
-    cursor = connection.cursor()
-    result = None
-    try:
-        cursor.execute(query)
-        result = cursor.fetchall()
-        return result
-    except Error as e:
-        print(f"The error '{e}' occurred")
-
-complete_select = """select (string_to_array(gd_path, '/'))[1]::text as directory, num, gd_path from gutenberg_raw.metadata_columns;"""
+import re
+import time
+from multiprocessing import Pool
+
+import db
 
 # change these paths according to your setup
-f=open("/path/to/gutensearch/content_insert.sql", "a+")
-files_complete = execute_read_query(connection, complete_select)
-for file in files_complete:
-    num =file[1]
-    gd_path = file[2]
-    f.write("""\set content `cat /path/to/gutensearch/gutenberg-dammit-files-v002/gutenberg-dammit-files/""" + gd_path + """`
-insert into gutenberg_raw.content_raw values (""" + str(num) + """, (:'content'));
-""")
\ No newline at end of file
+DATA_DIR = '/path/to/gutensearch/gutenberg-dammit-files-v002/gutenberg-dammit-files'
+
+# What follows an element of the array: its first non-blank character, if already read.
+NEXT_CHARACTER = re.compile(r'[ \t\r\n]*(.?)')
+
+# Yields the elements of a top-level JSON array without loading the whole file.
+def iter_json_array(path, chunk_size=1024 * 1024):
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        started = False
+        eof = False
+        while True:
+            buffer = buffer.lstrip(' \t\r\n,')
+            if not started:
+                if buffer.startswith('['):
+                    buffer = buffer[1:]
+                    started = True
+                    continue
+            elif buffer.startswith(']'):
+                return
+            if buffer and started:
+                try:
+                    element, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    # An element is only complete once the comma or bracket after it has been read:
+                    # a number cut at the end of a chunk ("1.5" read as "1") decodes all the same.
+                    if eof or NEXT_CHARACTER.match(buffer, end).group(1) in (',', ']'):
+                        yield element
+                        buffer = buffer[end:]
+                        continue
+            if eof:
+                if buffer.strip():
+                    raise ValueError('Unexpected end of {}'.format(path))
+                return
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer += chunk
+
+def books_from_metadata(path):
+    for metadata in iter_json_array(path):
+        if metadata.get('gd-path'):
+            yield int(metadata['Num']), metadata['gd-path']
+
+def books_from_table(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("""select num, gd_path from gutenberg_raw.metadata_columns where gd_path is not null order by num;""")
+        return cursor.fetchall()
+
+def loaded_books(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("""select num from gutenberg_raw.content_raw;""")
+        return set(row[0] for row in cursor)
+
+# Runs in the workers: read one batch of books and return it as COPY text.
+def read_batch(args):
+    data_dir, batch = args
+    buffer = io.StringIO()
+    size = 0
+    for num, gd_path in batch:
+        with open(os.path.join(data_dir, gd_path), 'rb') as f:
+            raw = f.read()
+        size += len(raw)
+        # Postgres text cannot hold NUL characters.
+        content = raw.decode('utf-8', errors='replace').replace('\x00', '')
+        buffer.write(db.copy_line((num, content)))
+    return len(batch), size, buffer.getvalue()
+
+def batches(books, batch_books):
+    batch = []
+    for book in books:
+        batch.append(book)
+        if len(batch) == batch_books:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_metadata(connection, path, batch_size=1000):
+    with connection.cursor() as cursor:
+        cursor.execute("""select exists (select 1 from gutenberg_raw.metadata_raw);""")
+        if cursor.fetchone()[0]:
+            print('gutenberg_raw.metadata_raw is not empty, skipping metadata.')
+            return
+        buffer = io.StringIO()
+        rows = 0
+        for rows, metadata in enumerate(iter_json_array(path), 1):
+            buffer.write(db.copy_line((json.dumps(metadata),)))
+            if rows % batch_size == 0:
+                buffer.seek(0)
+                cursor.copy_expert("""copy gutenberg_raw.metadata_raw (metadata) from stdin""", buffer)
+                buffer = io.StringIO()
+        buffer.seek(0)
+        cursor.copy_expert("""copy gutenberg_raw.metadata_raw (metadata) from stdin""", buffer)
+    connection.commit()
+    print('Inserted {} metadata rows.'.format(rows))
+
+def report(label, books, size, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    print('{}: {} books, {:.1f} MB in {:.1f} s ({:.1f} books/s, {:.2f} MB/s)'.format(
+        label, books, size / 1e6, elapsed, books / elapsed, size / 1e6 / elapsed), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load the Gutenberg text files into gutenberg_raw.content_raw.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--metadata', help='stream the book list from gutenberg-metadata.json instead of gutenberg_raw.metadata_columns')
+    parser.add_argument('--load-metadata', action='store_true', help='also fill gutenberg_raw.metadata_raw from --metadata')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-books', type=int, default=200, help='books per COPY transaction')
+    parser.add_argument('--report-every', type=int, default=10, help='batches between progress reports')
+    args = parser.parse_args()
+
+    connection = db.connect(db.load_config(args.config)['Postgres']['constring'])
+    if args.load_metadata:
+        if not args.metadata:
+            parser.error('--load-metadata needs --metadata')
+        load_metadata(connection, args.metadata)
+
+    books = books_from_metadata(args.metadata) if args.metadata else books_from_table(connection)
+    done = loaded_books(connection)
+    if done:
+        print('Resuming: {} books already loaded.'.format(len(done)))
+    todo = (book for book in books if book[0] not in done)
+
+    start = time.perf_counter()
+    total_books = total_size = 0
+    with Pool(args.workers) as pool, connection.cursor() as cursor:
+        work = ((args.data_dir, batch) for batch in batches(todo, args.batch_books))
+        for i, (count, size, data) in enumerate(pool.imap_unordered(read_batch, work), 1):
+            cursor.copy_expert("""copy gutenberg_raw.content_raw (num, content) from stdin""", io.StringIO(data))
+            connection.commit()
+            total_books += count
+            total_size += size
+            if i % args.report_every == 0:
+                report('Progress', total_books, total_size, time.perf_counter() - start)
+    report('Done', total_books, total_size, time.perf_counter() - start)
+    connection.close()
+
+if __name__ == '__main__':
+    main()
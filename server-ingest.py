@@ -0,0 +1,325 @@
+# Incremental ingest from a local Project Gutenberg rsync mirror (see mirror.py for the layout).
+#
+# Books whose text or RDF file changed since the last run, judged by size and modification time
+# first and then by SHA-256, are read by a pool of worker processes. Each batch of changed books
+# is then written in one transaction: gutenberg_raw.metadata_columns and content_raw,
+# gutenberg.all_data, their paragraphs (deleted and split again, see partitions.SPLIT),
+# gutenberg.lexeme_stats, and their author mentions with the gutenberg.mentioned_authors rows
+# of their authors. Indexes are maintained as rows change, so the cost follows the number of
+# changed books rather than the size of the corpus.
+#
+# What was ingested is remembered in gutenberg_raw.mirror_files. --baseline records the mirror as
+# it is for books already in all_data without reading them into the tables, for a first run after
+# the initial build. Books removed from the mirror are left in place.
+#
+# Each batch is also logged to gutenberg.ingest_log, whose last batch is part of the data version of
+# the app's snapshot and of the hot searches (see db.py). The hot searches are dropped with the first
+# batch, so the app searches them live until server-hot-searches.py runs again. What is built from the
+# paragraphs isn't updated here: once done, the script lists what is now behind the books, out of
+# gutenberg.unique_paragraphs (server-dedup-paragraphs.py), the inverted index
+# (server-build-index.py) and the shards (server-build-shards.py).
+
+import argparse
+import io
+import os
+import time
+from multiprocessing import Pool
+from xml.etree.ElementTree import ParseError
+
+from psycopg2.extras import execute_values
+
+import db
+import dedup
+import mentions
+import mirror
+import partitions
+
+SETUP = """create table if not exists gutenberg_raw.mirror_files
+  (num integer primary key
+    , gd_path text
+    , size bigint
+    , mtime double precision
+    , checksum text
+    , rdf_size bigint
+    , rdf_mtime double precision
+    , rdf_checksum text
+    , ingested_at timestamptz default now());
+"""
+
+METADATA_COLUMNS = ['num', 'author', 'author_birth', 'author_death', 'author_given', 'author_surname', 'copyright_status', 'language', 'loc_class', 'subject', 'title', 'charset', 'gd_num_padded', 'gd_path', 'href']
+FILE_COLUMNS = ['num', 'gd_path', 'size', 'mtime', 'checksum', 'rdf_size', 'rdf_mtime', 'rdf_checksum']
+
+def upsert(table, columns, extra='', key='num'):
+    return """insert into {} ({}) values %s on conflict ({}) do update set {}{};""".format(
+        table, ', '.join(columns), key, ', '.join('{0} = excluded.{0}'.format(column) for column in columns if column != key), extra)
+
+UPSERT_METADATA = upsert('gutenberg_raw.metadata_columns', METADATA_COLUMNS)
+UPSERT_FILES = upsert('gutenberg_raw.mirror_files', FILE_COLUMNS, extra=', ingested_at = now()')
+
+CONTENT = """create temp table ingest_content (num integer primary key, content text) on commit drop;"""
+
+UPSERT_CONTENT = """insert into gutenberg_raw.content_raw (num, content)
+select num, content from ingest_content
+on conflict (num) do update set content = excluded.content;
+insert into gutenberg.all_data ({columns}, length, content)
+select {prefixed}, length(c.content), c.content
+from ingest_content c
+inner join gutenberg_raw.metadata_columns m on c.num = m.num
+on conflict (num) do update set {updates}, length = excluded.length, content = excluded.content;
+""".format(
+    columns=', '.join(METADATA_COLUMNS),
+    prefixed=', '.join('m.' + column for column in METADATA_COLUMNS),
+    updates=', '.join('{0} = excluded.{0}'.format(column) for column in METADATA_COLUMNS if column != 'num'))
+
+# Adds (sign 1) or removes (sign -1) the lexemes of some paragraphs of one language.
+LEXEME_DELTA = """insert into gutenberg.lexeme_stats as s (language, word, ndoc, nentry)
+select %(language)s::regconfig, word, %(sign)s * ndoc, %(sign)s * nentry from ts_stat(%(query)s)
+on conflict (language, word) do update set ndoc = s.ndoc + excluded.ndoc, nentry = s.nentry + excluded.nentry;"""
+
+# As in server-mentioned-authors.py, books in unsupported languages are not scanned.
+MENTION_BOOKS = """select a.num, a.content from gutenberg.all_data a
+where a.num = any(%(nums)s) and a.content is not null and lower(a.language) in (select cfgname from pg_ts_config);"""
+
+MENTIONED_BY = """delete from gutenberg.mentioned_authors where mentioned_by = any(%(authors)s);
+insert into gutenberg.mentioned_authors (mentioned_author, mentioned_by, books_mentioned_in)
+select m.mentioned_author, a.author as mentioned_by, count(distinct m.num) as books_mentioned_in
+from gutenberg.mentions m
+inner join gutenberg.all_data a on m.num = a.num
+where a.author = any(%(authors)s)
+group by m.mentioned_author, a.author;"""
+
+def stat(path):
+    try:
+        result = os.stat(path)
+    except FileNotFoundError:
+        return None, None
+    return result.st_size, result.st_mtime
+
+# Runs in the workers: checksum one book and, if it changed, read it.
+def read_book(task):
+    root, rdf_dir, num, gd_path, charset, known_checksum, known_rdf_checksum = task
+    with open(os.path.join(root, gd_path), 'rb') as f:
+        raw = f.read()
+    rdf_path = os.path.join(rdf_dir, mirror.rdf_path(num))
+    rdf = None
+    if os.path.exists(rdf_path):
+        with open(rdf_path, 'rb') as f:
+            rdf = f.read()
+    size, mtime = stat(os.path.join(root, gd_path))
+    rdf_size, rdf_mtime = stat(rdf_path)
+    book = {'num': num, 'gd_path': gd_path, 'size': size, 'mtime': mtime, 'checksum': mirror.checksum(raw),
+            'rdf_size': rdf_size, 'rdf_mtime': rdf_mtime, 'rdf_checksum': mirror.checksum(rdf) if rdf is not None else None}
+    book['changed'] = (book['checksum'], book['rdf_checksum']) != (known_checksum, known_rdf_checksum)
+    if book['changed']:
+        book['content'] = mirror.decode_text(raw, charset)
+        book['metadata'] = None
+        if rdf is not None:
+            try:
+                book['metadata'] = dict(mirror.read_metadata(rdf), num=num, charset=charset, gd_num_padded='{:05d}'.format(num), gd_path=gd_path, href='/ebooks/{}'.format(num))
+            except ParseError:
+                print('Unreadable RDF file for book {}.'.format(num), flush=True)
+        book['bytes'] = len(raw)
+    return book
+
+def known_files(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("""select {} from gutenberg_raw.mirror_files;""".format(', '.join(FILE_COLUMNS)))
+        return {row[0]: dict(zip(FILE_COLUMNS, row)) for row in cursor}
+
+# Books whose files differ from the last run by size or modification time (or all with --checksum).
+def candidates(root, rdf_dir, known, checksum_all):
+    for num, gd_path, charset in mirror.books(root):
+        previous = known.get(num)
+        size, mtime = stat(os.path.join(root, gd_path))
+        rdf_size, rdf_mtime = stat(os.path.join(rdf_dir, mirror.rdf_path(num)))
+        if previous is not None and not checksum_all and (gd_path, size, mtime, rdf_size, rdf_mtime) == tuple(previous[column] for column in ('gd_path', 'size', 'mtime', 'rdf_size', 'rdf_mtime')):
+            continue
+        yield (root, rdf_dir, num, gd_path, charset, previous and previous['checksum'], previous and previous['rdf_checksum'])
+
+def batches(tasks, batch_books):
+    batch = []
+    for task in tasks:
+        batch.append(task)
+        if len(batch) == batch_books:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def read_batch(batch):
+    return [read_book(task) for task in batch]
+
+def table_exists(cursor, name):
+    cursor.execute("""select to_regclass(%s) is not null;""", (name,))
+    return cursor.fetchone()[0]
+
+def lexeme_delta(cursor, nums, sign):
+    cursor.execute("""select distinct language::text from gutenberg.paragraphs where num = any(%s) and language is not null;""", (nums,))
+    for language, in cursor.fetchall():
+        query = cursor.mogrify("""select textsearchable_index_col from gutenberg.paragraphs where language = %s::regconfig and num = any(%s)""", (language, nums)).decode()
+        cursor.execute(LEXEME_DELTA, {'language': language, 'sign': sign, 'query': query})
+
+def authors_of(cursor, nums):
+    cursor.execute("""select distinct author from gutenberg.all_data where num = any(%s) and author is not null;""", (nums,))
+    return set(row[0] for row in cursor)
+
+def scan_mentions(cursor, nums):
+    cursor.execute("""select distinct author from gutenberg.all_data where author is not null;""")
+    automaton = mentions.Automaton(sorted(author for author, in cursor if mentions.is_searchable(author)))
+    cursor.execute(MENTION_BOOKS, {'nums': nums})
+    found = []
+    for num, content in cursor.fetchall():
+        found.extend((automaton.names[i], num) for i in automaton.search_book(content))
+    return found
+
+class Ingest:
+    def __init__(self, connection):
+        self.connection = connection
+        with connection.cursor() as cursor:
+            self.has_lexeme_stats = table_exists(cursor, 'gutenberg.lexeme_stats')
+            self.has_mentions = table_exists(cursor, 'gutenberg.mentions')
+            self.has_hot_searches = table_exists(cursor, 'gutenberg.hot_searches')
+
+    # Writes one batch of changed books in one transaction and returns how many were written.
+    def write(self, books, unchanged):
+        with self.connection.cursor() as cursor:
+            missing = [book['num'] for book in books if book['metadata'] is None]
+            if missing:
+                # Text changed but no RDF file: keep the metadata we have.
+                cursor.execute("""select {} from gutenberg_raw.metadata_columns where num = any(%s);""".format(', '.join(METADATA_COLUMNS)), (missing,))
+                existing = {row[0]: dict(zip(METADATA_COLUMNS, row)) for row in cursor}
+                for book in books:
+                    if book['metadata'] is None and book['num'] in existing:
+                        book['metadata'] = dict(existing[book['num']], gd_path=book['gd_path'])
+                skipped = [book['num'] for book in books if book['metadata'] is None]
+                if skipped:
+                    print('No metadata for new books {}, skipped.'.format(', '.join(map(str, skipped))), flush=True)
+                books = [book for book in books if book['metadata'] is not None]
+            nums = [book['num'] for book in books]
+            if nums:
+                cursor.execute("""insert into gutenberg.ingest_log (nums) values (%s);""", (nums,))
+                if self.has_hot_searches:
+                    cursor.execute("""delete from gutenberg.hot_results;""")
+                    cursor.execute("""delete from gutenberg.hot_searches;""")
+                old_authors = authors_of(cursor, nums)
+                if self.has_lexeme_stats:
+                    lexeme_delta(cursor, nums, -1)
+                cursor.execute("""delete from gutenberg.paragraphs where num = any(%s);""", (nums,))
+
+                execute_values(cursor, UPSERT_METADATA, [tuple(book['metadata'][column] for column in METADATA_COLUMNS) for book in books])
+                cursor.execute(CONTENT)
+                cursor.copy_expert("""copy ingest_content (num, content) from stdin""", io.StringIO(''.join(db.copy_line((book['num'], book['content'])) for book in books)))
+                cursor.execute(UPSERT_CONTENT)
+
+                # A language seen for the first time gets its partition before its paragraphs arrive.
+                partitions.create(cursor, 'paragraphs')
+                cursor.execute(partitions.SPLIT.format(table='paragraphs', where='a.num = any(%(nums)s)'), {'nums': nums, 'max_length': partitions.MAX_PARAGRAPH_LENGTH})
+                if self.has_lexeme_stats:
+                    lexeme_delta(cursor, nums, 1)
+                    cursor.execute("""delete from gutenberg.lexeme_stats where ndoc <= 0;""")
+
+                if self.has_mentions:
+                    cursor.execute("""delete from gutenberg.mentions where num = any(%s);""", (nums,))
+                    found = scan_mentions(cursor, nums)
+                    if found:
+                        execute_values(cursor, """insert into gutenberg.mentions (mentioned_author, num) values %s on conflict do nothing;""", found)
+                    cursor.execute("""insert into gutenberg.mentions_scanned (num) select unnest(%s::integer[]) on conflict do nothing;""", (nums,))
+                    cursor.execute(MENTIONED_BY, {'authors': sorted(old_authors | authors_of(cursor, nums))})
+
+            files = books + unchanged
+            if files:
+                execute_values(cursor, UPSERT_FILES, [tuple(book[column] for column in FILE_COLUMNS) for book in files])
+        self.connection.commit()
+        return len(books)
+
+# The scripts to run for what is built from the paragraphs and is now behind the ingested books, out
+# of what is in use: a build that was never recorded counts as behind.
+def rebuilds(cursor, cfg):
+    batch = db.ingest_version(cursor)
+    steps = []
+    if dedup.exists(cursor) and db.builds(cursor, 'unique_paragraphs').get('unique_paragraphs', 0) < batch:
+        steps.append('server-dedup-paragraphs.py, for gutenberg.unique_paragraphs')
+    if cfg['Search']['backend'] == 'index':
+        built = db.builds(cursor, 'index:')
+        if not built or min(built.values()) < batch:
+            steps.append('server-build-index.py, for the inverted index')
+    if cfg['Shards']['constrings']:
+        built = db.builds(cursor, 'shard:')
+        if any(built.get('shard:{}'.format(shard), 0) < batch for shard in range(len(cfg['Shards']['constrings']))):
+            steps.append('server-build-shards.py, for the shards')
+    if table_exists(cursor, 'gutenberg.hot_searches'):
+        steps.append('server-hot-searches.py, for the hot searches')
+    return steps
+
+def baseline(connection, root, rdf_dir):
+    with connection.cursor() as cursor:
+        cursor.execute("""select num from gutenberg.all_data;""")
+        loaded = set(row[0] for row in cursor)
+    rows = []
+    for num, gd_path, charset in mirror.books(root):
+        if num in loaded:
+            rdf_path = os.path.join(rdf_dir, mirror.rdf_path(num))
+            with open(os.path.join(root, gd_path), 'rb') as f:
+                checksum = mirror.checksum(f.read())
+            rdf_checksum = None
+            if os.path.exists(rdf_path):
+                with open(rdf_path, 'rb') as f:
+                    rdf_checksum = mirror.checksum(f.read())
+            rows.append((num, gd_path) + stat(os.path.join(root, gd_path)) + (checksum,) + stat(rdf_path) + (rdf_checksum,))
+    with connection.cursor() as cursor:
+        execute_values(cursor, UPSERT_FILES, rows)
+    connection.commit()
+    print('Baseline: recorded {} books already in gutenberg.all_data.'.format(len(rows)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest new and changed books from a local Gutenberg rsync mirror.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--mirror', required=True, help='root of the rsync mirror')
+    parser.add_argument('--rdf-dir', help='directory of the RDF files (default: <mirror>/cache/epub)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-books', type=int, default=100, help='changed books per transaction')
+    parser.add_argument('--checksum', action='store_true', help='checksum every book, not only those whose size or modification time changed')
+    parser.add_argument('--baseline', action='store_true', help='record the books already in all_data as ingested, then stop')
+    args = parser.parse_args()
+
+    rdf_dir = args.rdf_dir or os.path.join(args.mirror, 'cache', 'epub')
+    cfg = db.load_config(args.config)
+    connection = db.connect(cfg['Postgres']['constring'])
+    with connection.cursor() as cursor:
+        cursor.execute(SETUP)
+        cursor.execute(db.INGEST_SETUP)
+    connection.commit()
+    if args.baseline:
+        baseline(connection, args.mirror, rdf_dir)
+        connection.close()
+        return
+
+    start = time.perf_counter()
+    ingest = Ingest(connection)
+    checked = written = size = 0
+    with Pool(args.workers) as pool:
+        tasks = candidates(args.mirror, rdf_dir, known_files(connection), args.checksum)
+        for books in pool.imap(read_batch, batches(tasks, args.batch_books)):
+            batch_start = time.perf_counter()
+            changed = [book for book in books if book['changed']]
+            count = ingest.write(changed, [book for book in books if not book['changed']])
+            checked += len(books)
+            written += count
+            size += sum(book['bytes'] for book in changed)
+            if count:
+                print('{} books written in {:.1f} s ({} so far, {:.1f} MB)'.format(count, time.perf_counter() - batch_start, written, size / 1e6), flush=True)
+    print('Done: {} books checked, {} new or changed written in {:.1f} s.'.format(checked, written, time.perf_counter() - start))
+    if written and ingest.has_mentions:
+        print('New author names are only looked for in the ingested books. Run server-mentioned-authors.py to look for them in the rest.')
+    if written:
+        with connection.cursor() as cursor:
+            steps = rebuilds(cursor, cfg)
+        connection.rollback()
+        if steps:
+            print('Behind the ingested books until rebuilt, run:')
+            for step in steps:
+                print('  ' + step)
+    connection.close()
+
+if __name__ == '__main__':
+    main()
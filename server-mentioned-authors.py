@@ -0,0 +1,177 @@
+# Builds gutenberg.mentioned_authors with one multi-pattern scan of the books (see mentions.py)
+# instead of joining every paragraph against every author name in SQL.
+#
+# Worker processes each take a range of book nums, read the books and record which author names
+# they mention in gutenberg.mentions. gutenberg.mentioned_authors, which the app's author graph is
+# built from, is then aggregated from that table. Scanned books and matched names are remembered,
+# so later runs only scan new books for every name and existing books for new names.
+#
+# --compare-sql also runs the original SQL build into a temporary table and reports both timings
+# and how far the results agree.
+
+import argparse
+import io
+import time
+from multiprocessing import Pool
+
+import db
+import mentions
+
+SETUP = """create table if not exists gutenberg.mentions
+  (mentioned_author text
+    , num integer
+    , primary key (mentioned_author, num));
+create table if not exists gutenberg.mentions_scanned
+  (num integer primary key);
+create table if not exists gutenberg.mention_patterns
+  (author text primary key);
+create table if not exists gutenberg.mentioned_authors
+  (mentioned_author text
+    , mentioned_by text
+    , books_mentioned_in bigint
+    , primary key (mentioned_author, mentioned_by));
+"""
+
+# Books in languages without a text search configuration have no tsvector, so the SQL version
+# never found mentions in them either.
+BOOKS = """select a.num, a.content from gutenberg.all_data a
+where a.num >= %(start)s and a.num < %(stop)s and a.content is not null and lower(a.language) in (select cfgname from pg_ts_config)
+{only}
+order by a.num;"""
+
+AGGREGATE = """delete from gutenberg.mentioned_authors;
+insert into gutenberg.mentioned_authors (mentioned_author, mentioned_by, books_mentioned_in)
+select m.mentioned_author, a.author as mentioned_by, count(distinct m.num) as books_mentioned_in
+from gutenberg.mentions m
+inner join gutenberg.all_data a on m.num = a.num
+where a.author is not null
+group by m.mentioned_author, a.author
+order by books_mentioned_in desc;
+"""
+
+# The build that used to be in server-process-2.sql, for --compare-sql.
+SQL_VERSION = """create temp table mentioned_authors_sql as
+select
+c.author as mentioned_author
+, a.author as mentioned_by
+, count(distinct a.num) as books_mentioned_in
+from gutenberg.all_data a inner join gutenberg.paragraphs b on a.num = b.num
+inner join (select author, count(distinct num) from gutenberg.all_data where author is not null and author not in ('Various', 'Unknown', 'Anonymous', 'Jr.', 'L.', 'Peer', 'Dom', 'British Museum', 'Clara', 'Morgan', 'Duchess', 'Baker', 'Elizabeth', 'Hale', 'R. H.', 'G. W.', 'W. B.', 'W. M.', 'Wang', 'Wu', 'V. M.', 'F.R.G.S.') group by author order by count desc) c
+on b.textsearchable_index_col @@ phraseto_tsquery('simple'::regconfig, c.author)
+where c.author is not null and a.author is not null
+group by c.author, a.author;
+"""
+
+worker = {}
+
+def init_worker(constring, names):
+    worker['connection'] = db.connect(constring)
+    worker['automaton'] = mentions.Automaton(names)
+
+# Runs in the workers: scan one num range, optionally only the given books.
+def scan(task):
+    start, stop, only = task
+    automaton = worker['automaton']
+    found = []
+    books = 0
+    with worker['connection'].cursor() as cursor:
+        cursor.execute(BOOKS.format(only='and a.num = any(%(only)s)' if only is not None else ''), {'start': start, 'stop': stop, 'only': only})
+        for num, content in cursor:
+            books += 1
+            found.extend((automaton.names[i], num) for i in automaton.search_book(content))
+    worker['connection'].rollback()
+    return start, books, found
+
+def names(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("""select distinct author from gutenberg.all_data where author is not null;""")
+        return sorted(author for author, in cursor if mentions.is_searchable(author))
+
+def fetch_set(connection, query):
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        return set(row[0] for row in cursor)
+
+def run_pass(connection, constring, pattern_names, tasks, workers, label):
+    begin = time.perf_counter()
+    books = pairs = 0
+    with Pool(workers, initializer=init_worker, initargs=(constring, pattern_names)) as pool, connection.cursor() as cursor:
+        for start, scanned, found in pool.imap_unordered(scan, tasks):
+            buffer = io.StringIO(''.join(db.copy_line(pair) for pair in found))
+            cursor.execute("""create temp table if not exists mentions_batch (mentioned_author text, num integer) on commit delete rows;""")
+            cursor.copy_expert("""copy mentions_batch (mentioned_author, num) from stdin""", buffer)
+            cursor.execute("""insert into gutenberg.mentions select * from mentions_batch on conflict do nothing;""")
+            connection.commit()
+            books += scanned
+            pairs += len(found)
+    print('{}: scanned {} books, {} mentions in {:.1f} s'.format(label, books, pairs, time.perf_counter() - begin), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build gutenberg.mentioned_authors with a multi-pattern scan.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=500, help='width of each num range')
+    parser.add_argument('--rebuild', action='store_true', help='forget previous runs and scan everything again')
+    parser.add_argument('--compare-sql', action='store_true', help='also time the original SQL build and compare results')
+    args = parser.parse_args()
+
+    constring = db.load_config(args.config)['Postgres']['constring']
+    connection = db.connect(constring)
+    begin = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(SETUP)
+        if args.rebuild:
+            cursor.execute("""truncate gutenberg.mentions, gutenberg.mentions_scanned, gutenberg.mention_patterns;""")
+        cursor.execute("""select min(num), max(num) from gutenberg.all_data;""")
+        first, last = cursor.fetchone()
+    connection.commit()
+
+    all_names = names(connection)
+    known_names = fetch_set(connection, """select author from gutenberg.mention_patterns;""")
+    scanned = fetch_set(connection, """select num from gutenberg.mentions_scanned;""")
+    all_books = fetch_set(connection, """select num from gutenberg.all_data;""")
+    new_books = sorted(all_books - scanned)
+    new_names = [name for name in all_names if name not in known_names]
+    ranges = [(start, start + args.chunk_size) for start in range(first, last + 1, args.chunk_size)]
+
+    # New books are scanned for every name.
+    if new_books:
+        if scanned:
+            tasks = [(start, stop, [num for num in new_books if start <= num < stop]) for start, stop in ranges]
+            tasks = [task for task in tasks if task[2]]
+        else:
+            tasks = [(start, stop, None) for start, stop in ranges]
+        run_pass(connection, constring, all_names, tasks, args.workers, 'New books')
+    # Books scanned before only need to be scanned for names that appeared since.
+    if scanned and new_names:
+        old_books = sorted(scanned & all_books)
+        tasks = [(start, stop, [num for num in old_books if start <= num < stop]) for start, stop in ranges]
+        run_pass(connection, constring, new_names, [task for task in tasks if task[2]], args.workers, 'New names')
+
+    with connection.cursor() as cursor:
+        cursor.execute("""insert into gutenberg.mentions_scanned (num) select unnest(%s::integer[]) on conflict do nothing;""", (new_books,))
+        cursor.execute("""insert into gutenberg.mention_patterns (author) select unnest(%s::text[]) on conflict do nothing;""", (new_names,))
+        cursor.execute(AGGREGATE)
+        cursor.execute("""select count(*) from gutenberg.mentioned_authors;""")
+        rows = cursor.fetchone()[0]
+    connection.commit()
+    elapsed = time.perf_counter() - begin
+    print('gutenberg.mentioned_authors: {} rows in {:.1f} s'.format(rows, elapsed), flush=True)
+
+    if args.compare_sql:
+        sql_begin = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute(SQL_VERSION)
+            sql_elapsed = time.perf_counter() - sql_begin
+            cursor.execute("""select
+                (select count(*) from mentioned_authors_sql)
+                , (select count(*) from mentioned_authors_sql s inner join gutenberg.mentioned_authors m using (mentioned_author, mentioned_by))
+                , (select count(*) from mentioned_authors_sql s inner join gutenberg.mentioned_authors m using (mentioned_author, mentioned_by, books_mentioned_in));""")
+            sql_rows, common, identical = cursor.fetchone()
+        connection.rollback()
+        print('SQL version: {} rows in {:.1f} s ({:.1f}x slower)'.format(sql_rows, sql_elapsed, sql_elapsed / max(elapsed, 1e-9)))
+        print('{} author pairs in both, {} with the same book count. The scan matches words as written, the SQL version matched against stemmed tsvectors.'.format(common, identical))
+    connection.close()
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ create table gutenberg_raw.metadata_raw
   (metadata json);
 
 -- Insert metadata ( https://stackoverflow.com/a/48396608 | https://www.postgresql.org/docs/current/app-psql.html#APP-PSQL-INTERPOLATION)
+-- Alternatively, skip this transaction, create content_raw at the end of this file, run server-import.py --metadata /path/to/gutenberg-metadata.json --load-metadata (which streams the file) and then come back for the insert into metadata_columns.
 -- Change this path to yours.
 begin;
 \set content `cat /path/to/gutensearch/gutenberg-dammit-files-v002/gutenberg-dammit-files/gutenberg-metadata.json`
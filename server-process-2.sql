@@ -13,8 +13,7 @@ alter default privileges in schema gutenberg grant select on sequences to gutens
 grant select on all tables in schema gutenberg to gutensearch_read_only;
 grant select on all sequences in schema gutenberg to gutensearch_read_only;
 
--- Change to your local path
-\i '/path/to/gutensearch/content_insert.sql'
+-- gutenberg_raw.content_raw is filled by server-import.py, which COPYs the text files in directly.
 
 create table gutenberg_raw.lengths as select num, length(content) as length from gutenberg_raw.content_raw;
 -- SELECT 50729
@@ -37,22 +36,12 @@ alter table gutenberg.all_data add primary key (num);
 create index on gutenberg.all_data (language);
 
 -- Because each book has too many unique lexemes and sometimes is just too long, we need to split books into paragraphs. A period followed by a newline is usually a new paragraph.
-create table gutenberg.paragraphs as
-with paragraphs as (select num, unnest(string_to_array(content, E'.\n')) as paragraph from gutenberg.all_data)
-select
-num
-, paragraph
-, length(paragraph) as paragraph_length
-from paragraphs;
--- SELECT 43845406
--- Time: 1462906.498 ms (24:22.906)
-
-create index on gutenberg.paragraphs (num); -- Time: 211714.656 ms (03:31.715)
-create index on gutenberg.paragraphs (paragraph_length); -- Time: 185284.889 ms (03:05.285)
-alter table gutenberg.paragraphs add foreign key (num) references gutenberg.all_data (num); -- Time: 97927.931 ms (01:37.928)
+-- Everything from here down to the indexes can instead be done in parallel, with resumable chunks, with:
+--   python3 server-build-paragraphs.py --config /path/to/gutensearch/dbconfig.yml --workers 4
+-- It builds the same partitioned table. Continue with lexeme_stats afterwards.
 
 /*
-This approach of splitting with E'.\n' leaves us only with these books to handle:
+Splitting with E'.\n' leaves us only with these books to handle:
 
 select a.num, a.title, a.language, case when language in ('English', 'French', 'German') then language else 'Other' end as language, b.paragraph_length from gutenberg.all_data a inner join gutenberg.paragraphs b on a.num = b.num where b.paragraph_length <> 0 order by paragraph_length desc limit 30;
 
@@ -67,69 +56,91 @@ select a.num, a.title, a.language, case when language in ('English', 'French', '
  49875 | History of the 2/6th (Rifle) Battn.      | English  | English  |           786276
     65 | The First 100,000 Prime Numbers          | English  | English  |           721213
 
-49875, 51155, 8294 can be split with ./n.
+49875, 51155, 8294 can be split with /n.
 127, 744, 812, 2583 are just a block of numbers, so we will ignore them.
 65 is a list of primes separated by /n, which can also be ignored.
+So paragraphs over 721212 characters are split again on single newlines, and whatever is still longer is dropped.
 */
 
-begin;
--- Insert the newly formed paragraphs:
-insert into gutenberg.paragraphs (num, paragraph, paragraph_length)
-  with paragraphs as (select num, unnest(string_to_array(paragraph, E'.\n')) as paragraph from gutenberg.paragraphs where num in (49875, 51155, 8294))
-  select 
-  num
-  , paragraph
-  , length(paragraph) as paragraph_length
-  from paragraphs;
--- Delete the old paragraphs:
-delete from gutenberg.paragraphs 
-  where paragraph_length > 721212;
-commit;
-
--- This fills in ts_vector values using the text language (if available for FTS). Longest to run, at almost 8 hours.
-alter table gutenberg.paragraphs
-add column textsearchable_index_col tsvector;
-update gutenberg.paragraphs
-set textsearchable_index_col = to_tsvector(b.cfgname::regconfig, coalesce(paragraph, ' '))
-from
-gutenberg.all_data a 
-inner join pg_ts_config b on lower(a.language) = b.cfgname 
-where gutenberg.paragraphs.num = a.num;
--- UPDATE 43222133
--- Time: 28745153.375 ms (07:59:05.153)
-
-create index textsearch_paragraph_idx on gutenberg.paragraphs using gin (textsearchable_index_col);
--- Time: 8567056.829 ms (02:22:47.057)
-
--- This denormalisation is necessary for fast querying.
-ALTER TABLE gutenberg.paragraphs
-ADD COLUMN language regconfig;
-UPDATE gutenberg.paragraphs
-SET language = b.cfgname::regconfig
-from
-gutenberg.all_data a 
-inner join pg_ts_config b on lower(a.language) = b.cfgname 
-where gutenberg.paragraphs.num = a.num;
-create index on gutenberg.paragraphs (language);
--- Time: 1071239.477 ms (17:51.239)
-
--- Query is the author, matching is 'simple'
-create table gutenberg.mentioned_authors as
+-- Paragraphs are list-partitioned by the denormalised language, which every search filters on, so a search only reads the partition (and GIN index) of its language. Books in languages without a text search configuration have a null language and go to the default partition.
+-- A single language can be vacuumed (vacuum analyze gutenberg.paragraphs_english;) or rebuilt (server-build-paragraphs.py --language English) on its own.
+create table gutenberg.paragraphs
+  (num integer
+    , paragraph text
+    , paragraph_length integer
+    , textsearchable_index_col tsvector
+    , language regconfig)
+  partition by list (language);
+do $$
+declare
+  config text;
+begin
+  for config in select distinct b.cfgname::text from gutenberg.all_data a inner join pg_ts_config b on lower(a.language) = b.cfgname loop
+    execute format('create table gutenberg.%I partition of gutenberg.paragraphs for values in (%L)', 'paragraphs_' || config, config);
+  end loop;
+end
+$$;
+create table gutenberg.paragraphs_default partition of gutenberg.paragraphs default;
+
+-- The split, tsvector and language in one pass, so no row is rewritten. The tsvector is the longest part to compute: the UPDATE that used to fill it in took almost 8 hours.
+insert into gutenberg.paragraphs (num, paragraph, paragraph_length, textsearchable_index_col, language)
+with books as (
+    select a.num, a.content, b.cfgname::regconfig as language
+    from gutenberg.all_data a
+    left join pg_ts_config b on lower(a.language) = b.cfgname
+)
+, split as (
+    select num, language, unnest(string_to_array(content, E'.\n')) as paragraph from books
+)
+, resplit as (
+    select num, language, paragraph from split where length(paragraph) <= 721212
+    union all
+    select num, language, unnest(string_to_array(paragraph, E'\n')) as paragraph from split where length(paragraph) > 721212
+)
 select
-c.author as mentioned_author
-, a.author as mentioned_by
-, count(distinct a.num) as books_mentioned_in
---, string_agg(distinct a.title, ', ') as books_mentioned_in_titles
-from gutenberg.all_data a inner join gutenberg.paragraphs b on a.num = b.num
-inner join (select author, count(distinct num) from gutenberg.all_data where author is not null and author not in ('Various', 'Unknown', 'Anonymous', 'Jr.', 'L.', 'Peer', 'Dom', 'British Museum', 'Clara', 'Morgan', 'Duchess', 'Baker', 'Elizabeth', 'Hale', 'R. H.', 'G. W.', 'W. B.', 'W. M.', 'Wang', 'Wu', 'V. M.', 'F.R.G.S.') group by author order by count desc) c 
-on b.textsearchable_index_col @@ phraseto_tsquery('simple'::regconfig, c.author)
-where c.author is not null and a.author is not null
-group by c.author, a.author
-order by books_mentioned_in desc;
--- Time: 617991.301 ms (10:17.991)
-
-alter table gutenberg.mentioned_authors add primary key (mentioned_author, mentioned_by);
--- Time: 2484.102 ms (00:02.484)
+num
+, paragraph
+, length(paragraph) as paragraph_length
+, case when language is not null then to_tsvector(language, coalesce(paragraph, ' ')) end as textsearchable_index_col
+, language
+from resplit
+where length(paragraph) <= 721212;
+
+-- Indexes on the parent are created on every partition. The unpartitioned GIN index took 2h22m to build.
+create index paragraphs_num_idx on gutenberg.paragraphs (num);
+create index paragraphs_paragraph_length_idx on gutenberg.paragraphs (paragraph_length);
+create index paragraphs_textsearch_idx on gutenberg.paragraphs using gin (textsearchable_index_col);
+alter table gutenberg.paragraphs add foreign key (num) references gutenberg.all_data (num);
+analyze gutenberg.paragraphs;
+
+-- Check that the app's queries only read one partition with:
+--   python3 server-check-pruning.py --config /path/to/gutensearch/dbconfig.yml
+
+-- Paragraphs repeated across editions can be stored once, in gutenberg.unique_paragraphs, for the app to search instead (Search: dedup: true, see dedup.py):
+--   python3 server-dedup-paragraphs.py --config /path/to/gutensearch/dbconfig.yml --workers 4
+
+-- Document frequency of every lexeme per language, used by the app to estimate how many paragraphs a search will match before running it (see admission.py).
+create table gutenberg.lexeme_stats
+  (language regconfig
+    , word text
+    , ndoc integer
+    , nentry integer
+    , primary key (language, word));
+do $$
+declare
+  config regconfig;
+begin
+  for config in select distinct b.cfgname::regconfig from gutenberg.all_data a inner join pg_ts_config b on lower(a.language) = b.cfgname loop
+    execute format('insert into gutenberg.lexeme_stats (language, word, ndoc, nentry) select %L::regconfig, word, ndoc, nentry from ts_stat(%L)', config, format('select textsearchable_index_col from gutenberg.paragraphs where language = %L::regconfig', config));
+  end loop;
+end
+$$;
+
+-- Authors mentioning other authors, for the Shortest Path graph. Run:
+--   python3 server-mentioned-authors.py --config /path/to/gutensearch/dbconfig.yml --workers 4
+-- It scans every book once for all author names and creates gutenberg.mentioned_authors (mentioned_author, mentioned_by, books_mentioned_in).
+-- Run it again after adding books: only new books, and new author names, are scanned.
+-- The original SQL build (a join of every paragraph with every author name, about 10 minutes) is kept in the script for --compare-sql.
 
 -- Table for logging
 create table gutenberg.query_log
@@ -138,7 +149,11 @@ create table gutenberg.query_log
     , language regconfig
     , query text
     , rows_returned_aka_limit integer
-    , start_row_aka_offset integer);
+    , start_row_aka_offset integer
+    , execution_ms double precision
+    , rows_returned integer);
+-- For a query_log created before execution_ms and rows_returned were added:
+-- alter table gutenberg.query_log add column execution_ms double precision, add column rows_returned integer;
 create index on gutenberg.query_log (time);    
 create index on gutenberg.query_log (tab);  
 create index on gutenberg.query_log (language);  
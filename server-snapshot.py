@@ -0,0 +1,26 @@
+# Builds the snapshot of datasets and figures the app loads at startup (see snapshot.py).
+# Run it after server-process-2.sql and whenever the data changes, so that workers never have to.
+
+import argparse
+import os
+import time
+
+from sqlalchemy import create_engine
+
+import db
+import snapshot
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the app startup snapshot.')
+    parser.add_argument('--config', default=db.CONFIG_PATH)
+    args = parser.parse_args()
+
+    cfg = db.load_config(args.config)
+    engine = create_engine(cfg['Postgres']['constring'])
+    path = cfg['Snapshot']['path']
+    start = time.perf_counter()
+    built = snapshot.refresh(engine, path)
+    print('Snapshot {} written to {} ({:.1f} MB) in {:.1f} s'.format(built['version'], path, os.path.getsize(path) / 1e6, time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Paragraphs sharded by book across several Postgres instances (Shards: constrings in dbconfig.yml),
+# which can be separate hosts or several clusters on one.
+#
+# Book num lives on shard num % len(constrings). A shard holds the gutenberg.all_data rows of its
+# books (num, language and content only) and its own gutenberg.paragraphs, partitioned by language
+# like the main one, built by server-build-shards.py. The Search tab's ranked view sends the
+# per-book rank query to every shard at once, each returning its own top books; those are merged by
+# rank, and the headlines of the books that make the page are fetched from the shards that own them.
+# The main database keeps the metadata and serves everything else (other sort orders and filters,
+# Discovery mode, export).
+
+import heapq
+import io
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from sqlalchemy import create_engine
+
+import partitions
+from search import SHARD_HEADLINES_QUERY, shard_rank_query
+
+SHARD_SCHEMA = """create schema if not exists gutenberg;
+create table if not exists gutenberg.all_data
+  (num integer primary key
+    , language text
+    , content text);"""
+
+class Shards:
+    def __init__(self, constrings):
+        self.engines = [create_engine(constring) for constring in constrings]
+        self.pool = ThreadPoolExecutor(max_workers=len(constrings))
+
+    def __len__(self):
+        return len(self.engines)
+
+    def shard(self, num):
+        return num % len(self.engines)
+
+    # Runs function(connection, *args) for each (shard, function, args) in parallel, and returns the
+    # results in the same order. timed(connection), e.g. admission.timed, wraps each call.
+    def run(self, calls, timed=None):
+        def call(shard, function, args):
+            with self.engines[shard].connect() as connection:
+                with (timed(connection) if timed else nullcontext()):
+                    return function(connection, *args)
+        futures = [self.pool.submit(call, shard, function, args) for shard, function, args in calls]
+        return [future.result() for future in futures]
+
+    # The top (num, rank) over all shards, ordered like the results table: by rank, then num, both
+    # descending. A capped search ranks its share of max_paragraphs on every shard.
+    def rank(self, params, top, after=None, max_paragraphs=None, timed=None):
+        cap = -(-max_paragraphs // len(self)) if max_paragraphs else None
+        query, shard_params = shard_rank_query(params, top, after, cap)
+
+        def fetch(connection):
+            return [(row[0], row[1]) for row in connection.execute(query, shard_params)]
+
+        results = self.run([(shard, fetch, ()) for shard in range(len(self))], timed)
+        merged = heapq.merge(*results, key=lambda row: (row[1], row[0]), reverse=True)
+        return list(itertools.islice(merged, top))
+
+    # Headlines of the given books, in the same order, each from the shard that owns it.
+    def headlines(self, params, nums, timed=None):
+        by_shard = {}
+        for num in nums:
+            by_shard.setdefault(self.shard(num), []).append(int(num))
+
+        def fetch(connection, shard_nums):
+            return [(row[0], row[1]) for row in connection.execute(SHARD_HEADLINES_QUERY, dict(params, nums=shard_nums))]
+
+        found = {}
+        for rows in self.run([(shard, fetch, (shard_nums,)) for shard, shard_nums in by_shard.items()], timed):
+            found.update(rows)
+        return [found.get(num) for num in nums]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+# ------------- Build -------------------------------------
+# Both connections are psycopg2 ones. Replaces whatever the shard held, copying the books of shard
+# `shard` of `count` from the main database in num ranges of chunk_size, then splits them into
+# paragraphs and indexes them there.
+def build(main, connection, shard, count, chunk_size=250, max_length=partitions.MAX_PARAGRAPH_LENGTH, log=print):
+    with connection.cursor() as cursor:
+        cursor.execute("""drop table if exists gutenberg.paragraphs cascade;""")
+        cursor.execute(SHARD_SCHEMA)
+        cursor.execute("""truncate gutenberg.all_data;""")
+    with main.cursor() as cursor:
+        cursor.execute("""select min(num), max(num) from gutenberg.all_data;""")
+        first, last = cursor.fetchone()
+    for start in range(first, last + 1, chunk_size):
+        data = io.BytesIO()
+        with main.cursor() as cursor:
+            cursor.copy_expert("""copy (select num, language, content from gutenberg.all_data where num >= {:d} and num < {:d} and num % {:d} = {:d}) to stdout;""".format(start, start + chunk_size, count, shard), data)
+        main.rollback()
+        data.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert("""copy gutenberg.all_data (num, language, content) from stdin;""", data)
+    with connection.cursor() as cursor:
+        cursor.execute("""select count(*) from gutenberg.all_data;""")
+        books = cursor.fetchone()[0]
+    log('shard {}: {} books copied'.format(shard, books))
+    with connection.cursor() as cursor:
+        partitions.create(cursor, 'paragraphs')
+        cursor.execute(partitions.SPLIT.format(table='paragraphs', where='true'), {'max_length': max_length})
+        log('shard {}: {} paragraphs'.format(shard, cursor.rowcount))
+        for statement in partitions.INDEXES:
+            cursor.execute(statement.format(table='paragraphs'))
+    connection.commit()
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("""analyze gutenberg.all_data;""")
+        cursor.execute("""analyze gutenberg.paragraphs;""")
+    connection.autocommit = False
+    log('shard {}: ready'.format(shard))
+    return books
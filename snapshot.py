@@ -0,0 +1,136 @@
+# Datasets and figures the tabs need, saved to disk once instead of being queried and built in
+# every gunicorn worker.
+#
+# The snapshot is a pickle tagged with a data version, which is a cheap fingerprint of the tables
+# it is built from. When the version in the file doesn't match the database, the snapshot is rebuilt
+# under a file lock, so only one process runs the queries. Run gunicorn with --preload to load it
+# once in the master, before the workers are forked.
+
+import fcntl
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+import db
+from authorgraph import AuthorGraph, NameIndex
+from bookfilters import BookFilters
+
+# Bump when the contents of the snapshot change.
+FORMAT = 4
+
+VERSION_QUERY = """select concat_ws('-', (select count(*) from gutenberg.all_data), (select max(num) from gutenberg.all_data), (select count(*) from gutenberg.mentioned_authors), (select sum(books_mentioned_in) from gutenberg.mentioned_authors));"""
+
+# With the last ingested batch, for books that changed but kept their num (see db.py).
+def data_version(engine):
+    ingested = engine.execute(db.INGEST_VERSION_QUERY).scalar() if engine.execute(db.INGEST_LOG_EXISTS).scalar() else 0
+    return '{}:{}-{}'.format(FORMAT, engine.execute(VERSION_QUERY).scalar(), ingested)
+
+def build(engine):
+    # ------------- Get data into Pandas dataframes ----------
+    supported_languages = pd.DataFrame(engine.execute("""select distinct language from gutenberg.all_data where lower(language) in (SELECT cfgname FROM pg_ts_config) order by language asc;"""))
+    supported_languages.columns =['language']
+    authors = pd.DataFrame(engine.execute("""select distinct author from gutenberg.all_data where lower(language) in (SELECT cfgname FROM pg_ts_config) order by author asc;"""))
+    authors.columns =['author']
+    unsupported_languages = pd.DataFrame(engine.execute("""with languages as (select distinct language from gutenberg.all_data where lower(language) not in (SELECT cfgname FROM pg_ts_config) order by language asc) select string_agg(language, ', ') as languages from languages;"""))
+    unsupported_languages.columns =['languages']
+
+    mentioned_authors = pd.DataFrame(engine.execute("""select mentioned_author, mentioned_by, books_mentioned_in from gutenberg.mentioned_authors;"""))
+    mentioned_authors.columns = ['mentioned_author', 'mentioned_by', 'books_mentioned_in']
+    author_graph = AuthorGraph.from_frame(mentioned_authors)
+    author_index = NameIndex(authors['author'].dropna().tolist(), weights=[author_graph.degree(author) for author in authors['author'].dropna()])
+
+    # Metadata of every searchable book, for the Search tab's filters.
+    book_filters = BookFilters.from_engine(engine)
+
+    book_length = pd.DataFrame(engine.execute("""select num, case when language in ('English', 'French', 'German') then language else 'Other' end as language, length from gutenberg.all_data where length <> 0;"""))
+    book_length.columns = ['num', 'language', 'length']
+
+    book_length['log_length'] = np.log10(book_length['length'])
+    book_length[' index'] = book_length['num']
+
+    # ------------- Create figures for Statistics tab --------
+    fig1 = px.histogram(book_length, x="log_length", color="language", facet_col="language", category_orders={"language": ["English", "French", "German", "Other"]}, labels={
+                         "log_length": "log(Total characters in book)",
+                         "count": "Count of books with this length",
+                         "language": "Language"
+                     })
+
+    # Books per (supported) language
+    books_per_language = pd.DataFrame(engine.execute("""select language, count(*) as books, case when lower(language) in (SELECT cfgname FROM pg_ts_config) then 'Yes' else 'No' end as supported from gutenberg.all_data where language is not null group by language order by books desc, supported desc, language asc;"""))
+    books_per_language.columns = ['language', 'books', 'supported']
+
+    trace1 = go.Bar(x=books_per_language[books_per_language.supported == 'Yes']['language'], y=books_per_language[books_per_language.supported == 'Yes']['books'], name='Supported languages')
+    trace2 = go.Bar(x=books_per_language[books_per_language.supported == 'No']['language'], y=books_per_language[books_per_language.supported == 'No']['books'], name='Unsupported languages')
+    df3 = [trace1, trace2]
+
+    updatemenus = list([
+        dict(active=1,
+             buttons=list([
+                dict(label='Log Scale',
+                     method='update',
+                     args=[{'visible': [True, True]},
+                           {'title': 'Number of books (log scale)',
+                            'yaxis': {'type': 'log'}}]),
+                dict(label='Linear Scale',
+                     method='update',
+                     args=[{'visible': [True, True]},
+                           {'title': 'Number of books (linear scale)',
+                            'yaxis': {'type': 'linear'}}])
+                ]),
+            )
+        ])
+
+    layout = dict(updatemenus=updatemenus, title='Number of books (Linear scale)')
+    fig3 = go.Figure(data=df3, layout=layout)
+
+    # Figures are kept as plain dicts, which dcc.Graph accepts as they are.
+    return {
+        'supported_languages': supported_languages,
+        'authors': authors,
+        'unsupported_languages': unsupported_languages,
+        'mentioned_authors': mentioned_authors,
+        'author_graph': author_graph,
+        'author_index': author_index,
+        'book_filters': book_filters,
+        'fig1': fig1.to_dict(),
+        'fig3': fig3.to_dict(),
+    }
+
+def save(snapshot, path):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def read(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def refresh(engine, path, version=None):
+    version = version or data_version(engine)
+    snapshot = build(engine)
+    snapshot['version'] = version
+    save(snapshot, path)
+    return snapshot
+
+def load(engine, path):
+    start = time.perf_counter()
+    version = data_version(engine)
+    snapshot = read(path)
+    if snapshot is None or snapshot.get('version') != version:
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have rebuilt it while we waited for the lock.
+            snapshot = read(path)
+            if snapshot is None or snapshot.get('version') != version:
+                snapshot = refresh(engine, path, version)
+    print('Snapshot {} loaded in {:.2f} s'.format(version, time.perf_counter() - start))
+    return snapshot
@@ -0,0 +1,261 @@
+# A reproducible, Gutenberg-like synthetic corpus for benchmarks.
+# Everything is created in the gutenberg schema of the database you connect to, so point this at a
+# scratch database and never at the real one.
+
+import collections
+import io
+import random
+
+import partitions
+from db import copy_line
+
+# (language in metadata, share of books)
+LANGUAGES = [('English', 0.80), ('French', 0.12), ('German', 0.08)]
+
+STOPWORDS = {
+    'English': ['the', 'of', 'and', 'to', 'a', 'in', 'that', 'it', 'was', 'he', 'for', 'on', 'with', 'as', 'his'],
+    'French': ['le', 'la', 'de', 'et', 'les', 'des', 'en', 'un', 'une', 'du', 'que', 'il', 'dans', 'est'],
+    'German': ['der', 'die', 'und', 'in', 'den', 'von', 'zu', 'das', 'mit', 'sich', 'des', 'auf', 'ist', 'nicht'],
+}
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ra', 'tu', 'be', 'sa', 'do', 'ri', 'po', 've', 'gu', 'th', 'an', 'er', 'el', 'is', 'or', 'un', 'st', 'ch']
+
+# Phrases planted in the text with a given probability per paragraph, from very common to rare,
+# so that benchmarks cover both the common-phrase timeouts and the usual quick lookups.
+PHRASES = {
+    'English': [('once upon a time', 0.02), ('bellows to mend', 0.001), ('call me ishmael', 0.0001)],
+    'French': [('il était une fois', 0.02), ('à la recherche du temps perdu', 0.0005)],
+    'German': [('es war einmal', 0.02), ('sturm und drang', 0.0005)],
+}
+
+SCHEMA = """create schema if not exists gutenberg;
+create table if not exists gutenberg.all_data
+  (
+    num integer primary key
+    , author text
+    , author_birth text
+    , author_death text
+    , author_given text
+    , author_surname text
+    , copyright_status text
+    , language text
+    , loc_class text
+    , subject text
+    , title text
+    , charset text
+    , gd_num_padded text
+    , gd_path text
+    , href text
+    , length integer
+    , content text
+  );
+create table if not exists gutenberg.query_log
+  (tab text
+    , time timestamptz
+    , language regconfig
+    , query text
+    , rows_returned_aka_limit integer
+    , start_row_aka_offset integer
+    , execution_ms double precision
+    , rows_returned integer);
+"""
+
+# Same result as the paragraph build of server-process-2.sql, into the table made by partitions.create.
+PARAGRAPHS = """insert into gutenberg.paragraphs (num, paragraph, paragraph_length, textsearchable_index_col, language)
+with paragraphs as (select num, unnest(string_to_array(content, E'.\\n')) as paragraph from gutenberg.all_data)
+select
+p.num
+, p.paragraph
+, length(p.paragraph) as paragraph_length
+, to_tsvector(b.cfgname::regconfig, coalesce(p.paragraph, ' ')) as textsearchable_index_col
+, b.cfgname::regconfig as language
+from paragraphs p
+inner join gutenberg.all_data a on p.num = a.num
+inner join pg_ts_config b on lower(a.language) = b.cfgname;
+"""
+
+def vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+# Cumulative Zipf weights: the word at rank r is drawn with probability proportional to 1/r^s.
+def zipf_weights(size, s=1.1):
+    total = 0.0
+    weights = []
+    for rank in range(1, size + 1):
+        total += 1.0 / rank ** s
+        weights.append(total)
+    return weights
+
+class Corpus:
+    # editions is the share of books that are another edition of a recent book in the same language:
+    # the same paragraphs, wrapped differently.
+    def __init__(self, books=2000, paragraphs_per_book=200, words_per_paragraph=60, vocabulary_size=20000, authors=500, seed=42, languages=LANGUAGES, editions=0.0):
+        self.books = books
+        self.paragraphs_per_book = paragraphs_per_book
+        self.words_per_paragraph = words_per_paragraph
+        self.vocabulary_size = vocabulary_size
+        self.authors = authors
+        self.seed = seed
+        self.languages = languages
+        self.editions = editions
+
+    def author_names(self, rng):
+        given = vocabulary(rng, 200)
+        surnames = vocabulary(rng, 1000)
+        return ['{} {}'.format(rng.choice(given).title(), rng.choice(surnames).title()) for _ in range(self.authors)]
+
+    # Drawn from rng right after the author names, so words() gets the same ones as rows().
+    def vocabularies(self, rng):
+        return {language: vocabulary(rng, self.vocabulary_size) for language, _ in self.languages}
+
+    # The vocabulary of every language, most frequent first, with the cumulative Zipf weights.
+    def words(self):
+        rng = random.Random(self.seed)
+        self.author_names(rng)
+        return self.vocabularies(rng), zipf_weights(self.vocabulary_size)
+
+    def paragraph(self, rng, language, words, weights):
+        length = max(1, int(rng.gauss(self.words_per_paragraph, self.words_per_paragraph / 3)))
+        tokens = [rng.choice(STOPWORDS[language]) if rng.random() < 0.35 else word for word in rng.choices(words, cum_weights=weights, k=length)]
+        for phrase, probability in PHRASES[language]:
+            if rng.random() < probability:
+                tokens.insert(rng.randrange(len(tokens) + 1), phrase)
+        return ' '.join(tokens)
+
+    # Some spaces become newlines or double spaces, which leaves the tsvector as it was.
+    def rewrap(self, rng, paragraph):
+        words = paragraph.split(' ')
+        return ''.join(word + (rng.choice(['\n', '  ']) if rng.random() < 0.1 else ' ') for word in words[:-1]) + words[-1]
+
+    # Yields all_data rows: the paragraphs of each book are joined with E'.\n' like the real texts.
+    def rows(self):
+        rng = random.Random(self.seed)
+        names = self.author_names(rng)
+        vocabularies = self.vocabularies(rng)
+        weights = zipf_weights(self.vocabulary_size)
+        languages = [language for language, _ in self.languages]
+        shares = [share for _, share in self.languages]
+        recent = collections.deque(maxlen=50)
+        for num in range(1, self.books + 1):
+            language = rng.choices(languages, weights=shares)[0]
+            author = names[int(rng.paretovariate(1.2)) % len(names)]
+            paragraphs = max(1, int(rng.expovariate(1.0 / self.paragraphs_per_book)))
+            earlier = [book for book_language, book in recent if book_language == language] if self.editions else []
+            if earlier and rng.random() < self.editions:
+                book = [self.rewrap(rng, paragraph) for paragraph in rng.choice(earlier)]
+            else:
+                book = [self.paragraph(rng, language, vocabularies[language], weights) for _ in range(paragraphs)]
+            if self.editions:
+                recent.append((language, book))
+            content = '.\n'.join(book) + '.\n'
+            title = ' '.join(rng.sample(vocabularies[language][:2000], 3)).title()
+            birth = rng.randint(1550, 1900)
+            yield {
+                'num': num,
+                'author': author,
+                'author_birth': str(birth),
+                'author_death': str(birth + rng.randint(25, 90)),
+                'language': language,
+                'title': title,
+                'gd_path': '{}/{:05d}.txt'.format(num // 1000, num),
+                'length': len(content),
+                'content': content,
+            }
+
+COLUMNS = ['num', 'author', 'author_birth', 'author_death', 'language', 'title', 'gd_path', 'length', 'content']
+
+def load(connection, corpus, batch=200):
+    with connection.cursor() as cursor:
+        cursor.execute(SCHEMA)
+        buffer = io.StringIO()
+        for i, row in enumerate(corpus.rows(), 1):
+            buffer.write(copy_line(row[column] for column in COLUMNS))
+            if i % batch == 0:
+                buffer.seek(0)
+                cursor.copy_expert('copy gutenberg.all_data ({}) from stdin'.format(', '.join(COLUMNS)), buffer)
+                buffer = io.StringIO()
+        buffer.seek(0)
+        cursor.copy_expert('copy gutenberg.all_data ({}) from stdin'.format(', '.join(COLUMNS)), buffer)
+    connection.commit()
+
+# The inputs of server-process-2.sql, as server-process-1.sql and server-import.py leave them.
+RAW_SCHEMA = """create schema if not exists gutenberg_raw;
+create table if not exists gutenberg_raw.metadata_columns
+  (
+    num integer primary key
+    , author text
+    , author_birth text
+    , author_death text
+    , author_given text
+    , author_surname text
+    , copyright_status text
+    , language text
+    , loc_class text
+    , subject text
+    , title text
+    , charset text
+    , gd_num_padded text
+    , gd_path text
+    , href text
+  );
+create table if not exists gutenberg_raw.content_raw
+  (num integer primary key, content text);
+"""
+
+RAW_COLUMNS = ['num', 'author', 'author_birth', 'author_death', 'language', 'title', 'gd_path']
+
+def load_raw(connection, corpus, batch=200):
+    with connection.cursor() as cursor:
+        cursor.execute(RAW_SCHEMA)
+        metadata, content = io.StringIO(), io.StringIO()
+        for i, row in enumerate(corpus.rows(), 1):
+            metadata.write(copy_line(row[column] for column in RAW_COLUMNS))
+            content.write(copy_line([row['num'], row['content']]))
+            if i % batch == 0:
+                metadata.seek(0)
+                content.seek(0)
+                cursor.copy_expert('copy gutenberg_raw.metadata_columns ({}) from stdin'.format(', '.join(RAW_COLUMNS)), metadata)
+                cursor.copy_expert('copy gutenberg_raw.content_raw (num, content) from stdin', content)
+                metadata, content = io.StringIO(), io.StringIO()
+        metadata.seek(0)
+        content.seek(0)
+        cursor.copy_expert('copy gutenberg_raw.metadata_columns ({}) from stdin'.format(', '.join(RAW_COLUMNS)), metadata)
+        cursor.copy_expert('copy gutenberg_raw.content_raw (num, content) from stdin', content)
+    connection.commit()
+
+def build_paragraphs(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('drop table if exists gutenberg.paragraphs;')
+        partitions.create(cursor, 'paragraphs')
+        cursor.execute(PARAGRAPHS)
+        for statement in partitions.INDEXES:
+            cursor.execute(statement.format(table='paragraphs'))
+        cursor.execute('analyze gutenberg.all_data;')
+        cursor.execute('analyze gutenberg.paragraphs;')
+    connection.commit()
+
+def drop(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('drop schema if exists gutenberg cascade;')
+    connection.commit()
+
+def exists(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("select to_regclass('gutenberg.paragraphs') is not null;")
+        return cursor.fetchone()[0]
+
+# Refuse to touch the production database by accident.
+def check_scratch(connection):
+    if connection.get_dsn_parameters().get('dbname') == 'gutensearch':
+        raise SystemExit('Refusing to build a synthetic corpus in the gutensearch database, use a scratch database.')
+
+def ensure(connection, corpus, rebuild=False):
+    check_scratch(connection)
+    if rebuild:
+        drop(connection)
+    if not exists(connection):
+        load(connection, corpus)
+        build_paragraphs(connection)
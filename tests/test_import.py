@@ -0,0 +1,48 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location('server_import', os.path.join(ROOT, 'server-import.py'))
+server_import = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server_import)
+
+ELEMENTS = [
+    {'Num': 1, 'gd-path': '000/00001.txt', 'Title': ['Title, with a comma'], 'Rating': 4.125},
+    1.5,
+    -0.000125,
+    12345,
+    6.02e23,
+    'a string with ] and , inside',
+    [1, [2.25, 3], {}],
+    None,
+    True,
+    {'Num': 2, 'gd-path': None},
+]
+
+@pytest.fixture
+def metadata(tmp_path):
+    path = tmp_path / 'metadata.json'
+    # Blanks between the elements, as pretty-printed files have.
+    path.write_text('[\n  ' + ' ,\n  '.join(json.dumps(element) for element in ELEMENTS) + '\n]\n', encoding='utf-8')
+    return str(path)
+
+@pytest.mark.parametrize('chunk_size', list(range(1, 24)) + [1024 * 1024])
+def test_iter_json_array_chunk_boundaries(metadata, chunk_size):
+    assert list(server_import.iter_json_array(metadata, chunk_size=chunk_size)) == ELEMENTS
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1024])
+def test_iter_json_array_number_last(tmp_path, chunk_size):
+    path = tmp_path / 'numbers.json'
+    path.write_text('[1.5,22.75, 333.125]', encoding='utf-8')
+    assert list(server_import.iter_json_array(str(path), chunk_size=chunk_size)) == [1.5, 22.75, 333.125]
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024])
+def test_iter_json_array_truncated(tmp_path, chunk_size):
+    path = tmp_path / 'truncated.json'
+    path.write_text('[{"Num": 1}, {"Num": 2', encoding='utf-8')
+    with pytest.raises(ValueError):
+        list(server_import.iter_json_array(str(path), chunk_size=chunk_size))